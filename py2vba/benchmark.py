@@ -0,0 +1,307 @@
+"""
+Converter throughput benchmarks.
+
+Generates synthetic Python input in several shapes and times the
+parse, walk and emit phases of a conversion separately. Results can
+be saved as a JSON baseline and later runs compared against it, failing
+when throughput drops by more than a threshold:
+
+    python -m py2vba.benchmark --save baseline.json
+    python -m py2vba.benchmark --baseline baseline.json --threshold 0.2
+
+--memory reports the bytes used per vbast node instead.
+
+"""
+import argparse
+import gc
+import json
+import multiprocessing
+import platform
+import sys
+import timeit
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from py2vba import convert, vbast
+
+BASELINE_VERSION = 1
+
+def gen_many_small_functions(n):
+    lines = []
+    for i in range(n):
+        lines += ['@vbmeta(x=Integer, y=Integer, rettype=Integer)',
+                  'def add%d(x, y):' % (i,),
+                  '    z = x * y + %d' % (i,),
+                  '    return z - x',
+                  '']
+    return '\n'.join(lines)
+
+def gen_huge_function(n):
+    lines = ['def huge(a, b):',
+             '    total = 0']
+    for i in range(n):
+        lines.append('    v%d = a * %d + b - total' % (i, i))
+        lines.append('    total += v%d' % (i,))
+    lines.append('    return total')
+    return '\n'.join(lines)
+
+def gen_nested_control_flow(n, depth=40):
+    lines = []
+    for i in range(n):
+        lines.append('def nested%d(x):' % (i,))
+        lines.append('    total = 0')
+        indent = '    '
+        for d in range(depth):
+            if d % 2:
+                lines.append('%sfor i%d in range(0, %d):' % (indent, d, d + 2))
+            else:
+                lines.append('%sif x > %d:' % (indent, d))
+            indent += '    '
+            lines.append('%stotal += %d' % (indent, d))
+        lines.append('    return total')
+        lines.append('')
+    return '\n'.join(lines)
+
+def gen_large_literals(n):
+    return '\n'.join([
+        'def literals():',
+        '    a = [%s]' % (', '.join(str(i) for i in range(n)),),
+        '    d = {%s}' % (', '.join("'k%d' : %d" % (i, i) for i in range(n)),),
+        '    r = [%s]' % (', '.join("{'name' : 'n%d', 'age' : %d}" % (i, i) for i in range(n)),),
+        '    return a[0] + d[\'k0\'] + r[0][\'age\']',
+        ''])
+
+def gen_many_classes(n):
+    lines = []
+    for i in range(n):
+        lines += ['class Record%d(object):' % (i,),
+                  '    @vbmeta(name=String, age=Integer)',
+                  '    def __init__(self, name, age):',
+                  '        self.name = name',
+                  '        self.age = age',
+                  '']
+    lines.append('@vbmeta(rettype=String)')
+    lines.append('def build():')
+    for i in range(n):
+        lines.append("    r%d = Record%d('n%d', %d)" % (i, i, i, i))
+    lines.append('    return r0.name')
+    return '\n'.join(lines)
+
+# name -> (generator, default size)
+SHAPES = {
+    'many_small_functions' : (gen_many_small_functions, 2000),
+    'huge_function' : (gen_huge_function, 5000),
+    'nested_control_flow' : (gen_nested_control_flow, 100),
+    'large_literals' : (gen_large_literals, 5000),
+    'many_classes' : (gen_many_classes, 500),
+}
+
+class _NullSink(object):
+    def __init__(self):
+        self.size = 0
+
+    def write(self, text):
+        self.size += len(text)
+
+def _emit(module):
+    sink = _NullSink()
+    modules = [module] + module.support_modules
+    if module.class_support_module:
+        modules.append(module.class_support_module)
+    for m in modules:
+        m.write(sink)
+    return sink.size
+
+def _timed(fcn, *args):
+    gc.collect()
+    start = timeit.default_timer()
+    value = fcn(*args)
+    return timeit.default_timer() - start, value
+
+def run_case(code, repeat=3):
+    """
+    Converts code repeat times, returning the best time for each
+    phase along with the sizes of the input and output.
+
+    """
+    timings = {'parse' : [], 'walk' : [], 'emit' : []}
+    for _ in range(repeat):
+        elapsed, tree = _timed(convert.build_ast_from_code, code)
+        timings['parse'].append(elapsed)
+        elapsed, module = _timed(convert.PythonASTWalker().walk, tree)
+        timings['walk'].append(elapsed)
+        elapsed, output_bytes = _timed(_emit, module)
+        timings['emit'].append(elapsed)
+        del tree, module
+
+    case = dict((phase, min(times)) for phase, times in timings.items())
+    case['source_bytes'] = len(code)
+    case['output_bytes'] = output_bytes
+    return case
+
+def _peak_rss_kb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak //= 1024
+    return peak
+
+def _run_case_in_child(args):
+    shape, scale, repeat = args
+    generator, size = SHAPES[shape]
+    case = run_case(generator(max(1, int(size * scale))), repeat)
+    case['peak_rss_kb'] = _peak_rss_kb()
+    return case
+
+def run_benchmarks(shapes=None, scale=1.0, repeat=3):
+    """
+    Runs each benchmark shape in a fresh child process so that peak
+    memory is attributable to a single shape.
+
+    """
+    shapes = sorted(shapes or SHAPES)
+    cases = {}
+    for shape in shapes:
+        pool = multiprocessing.Pool(1, maxtasksperchild=1)
+        try:
+            cases[shape] = pool.apply(_run_case_in_child, ((shape, scale, repeat),))
+        finally:
+            pool.close()
+            pool.join()
+    return {
+        'version' : BASELINE_VERSION,
+        'python' : platform.python_version(),
+        'scale' : scale,
+        'cases' : cases,
+    }
+
+def _instance_attributes(obj):
+    if hasattr(obj, '__dict__'):
+        for value in obj.__dict__.itervalues():
+            yield value
+    for cls in obj.__class__.__mro__:
+        for slot in cls.__dict__.get('__slots__', ()):
+            if hasattr(obj, slot):
+                yield getattr(obj, slot)
+
+def node_memory(module):
+    """
+    Returns (node count, bytes) for every vbast node reachable from
+    module, counting each node and its instance __dict__, if any.
+
+    """
+    seen = set()
+    pending = [module]
+    count = size = 0
+    while pending:
+        obj = pending.pop()
+        if id(obj) in seen:
+            continue
+        seen.add(id(obj))
+        if isinstance(obj, (list, tuple)):
+            pending.extend(obj)
+        elif isinstance(obj, dict):
+            pending.extend(obj.itervalues())
+        elif isinstance(obj, vbast.ASTNode):
+            count += 1
+            size += sys.getsizeof(obj)
+            if hasattr(obj, '__dict__'):
+                size += sys.getsizeof(obj.__dict__)
+            pending.extend(_instance_attributes(obj))
+    return count, size
+
+def run_memory_benchmarks(shapes=None, scale=1.0):
+    """
+    Returns {shape : (node count, bytes per node)} for the vbast
+    tree built from each shape.
+
+    """
+    report = {}
+    for shape in sorted(shapes or SHAPES):
+        generator, size = SHAPES[shape]
+        code = generator(max(1, int(size * scale)))
+        count, total = node_memory(convert.PythonASTWalker().walk(convert.build_ast_from_code(code)))
+        report[shape] = (count, float(total) / count)
+    return report
+
+def compare_to_baseline(results, baseline, threshold):
+    """
+    Returns a list of (shape, phase, slowdown) for every phase whose
+    throughput dropped by more than threshold relative to baseline.
+
+    """
+    if baseline.get('version') != BASELINE_VERSION:
+        raise ValueError('Unsupported benchmark baseline version %r.' % (baseline.get('version'),))
+    if baseline.get('scale') != results['scale']:
+        raise ValueError('Baseline was recorded at scale %r, not %r.' % (baseline.get('scale'), results['scale']))
+
+    regressions = []
+    for shape, case in sorted(results['cases'].items()):
+        base = baseline['cases'].get(shape)
+        if base is None:
+            continue
+        for phase in ('parse', 'walk', 'emit'):
+            if not base[phase]:
+                continue
+            throughput = base[phase] / max(case[phase], 1e-9)
+            if throughput < 1.0 - threshold:
+                regressions.append((shape, phase, 1.0 - throughput))
+    return regressions
+
+def format_results(results):
+    lines = ['%-22s %10s %10s %10s %12s %12s' % ('shape', 'parse s', 'walk s', 'emit s', 'KB/s', 'peak RSS KB')]
+    for shape, case in sorted(results['cases'].items()):
+        total = case['parse'] + case['walk'] + case['emit']
+        lines.append('%-22s %10.4f %10.4f %10.4f %12.1f %12s' % (
+            shape, case['parse'], case['walk'], case['emit'],
+            case['source_bytes'] / 1024.0 / max(total, 1e-9),
+            case['peak_rss_kb']))
+    return '\n'.join(lines)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark py2vba conversion throughput.')
+    parser.add_argument('--shape', action='append', choices=sorted(SHAPES),
+                        help='Benchmark shape to run, may be repeated (default: all).')
+    parser.add_argument('--scale', type=float, default=1.0,
+                        help='Multiplier applied to the size of each generated input.')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Number of timed runs per shape, the best is kept.')
+    parser.add_argument('--save', metavar='PATH',
+                        help='Write results to PATH as a JSON baseline.')
+    parser.add_argument('--baseline', metavar='PATH',
+                        help='Compare results against the JSON baseline at PATH.')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='Maximum tolerated fractional throughput drop (default: 0.2).')
+    parser.add_argument('--memory', action='store_true',
+                        help='Report vbast bytes per node instead of timing conversions.')
+    args = parser.parse_args(argv)
+
+    if args.memory:
+        print '%-22s %10s %14s' % ('shape', 'nodes', 'bytes/node')
+        for shape, (count, per_node) in sorted(run_memory_benchmarks(args.shape, args.scale).items()):
+            print '%-22s %10d %14.1f' % (shape, count, per_node)
+        return 0
+
+    results = run_benchmarks(args.shape, args.scale, args.repeat)
+    print format_results(results)
+
+    if args.save:
+        with open(args.save, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare_to_baseline(results, baseline, args.threshold)
+        for shape, phase, drop in regressions:
+            print 'REGRESSION: %s %s throughput dropped %.0f%%' % (shape, phase, drop * 100)
+        if regressions:
+            return 1
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
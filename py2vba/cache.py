@@ -0,0 +1,158 @@
+"""
+Persistent cache of converted top-level definitions.
+
+Each top-level FunctionDef/ClassDef is keyed by a hash of:
+
+ * its own source (as a normalised ast dump, so comments and
+   whitespace don't matter), which includes its vbmeta decorators,
+ * the converter fingerprint, which covers the types registered in
+   PythonASTWalker._types, the numeric policy and the options
+   changing how a definition is walked (list_arrays and
+   inline_comprehensions). fold_constants, inline_functions,
+   hoist_member_access, eliminate_common_subexpressions and
+   cache_literals are left out, since those passes run over the whole
+   module after cached definitions are restored,
+ * the source hashes of every top-level definition it transitively
+   references by name, and whether each was defined before it.
+
+The last rule is the invalidation rule for shape changes: code that
+constructs or calls into a class (or a function returning one) picks
+up the class's source hash, so changing a class's fields or
+constructor signature invalidates every definition that can observe
+it, while unrelated definitions keep hitting the cache.
+
+"""
+import ast, _ast
+import hashlib
+import os
+import cPickle as pickle
+
+CACHE_VERSION = 4
+
+DEFAULT_MAX_ENTRIES = 10000
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+ENTRY_EXTENSION = '.pickle'
+
+def _digest(*parts):
+    return hashlib.sha1(repr(parts)).hexdigest()
+
+def _referenced_names(node):
+    return set(n.id for n in ast.walk(node) if isinstance(n, _ast.Name))
+
+def definition_keys(module, fingerprint):
+    """
+    Returns a list with a cache key for each statement in the body
+    of module, or None for statements that aren't top-level
+    function or class definitions.
+
+    """
+    definitions = [(i, node) for i, node in enumerate(module.body)
+                   if isinstance(node, (_ast.FunctionDef, _ast.ClassDef))]
+    positions = dict((node.name, i) for i, node in definitions)
+    sources = dict((node.name, _digest(ast.dump(node))) for i, node in definitions)
+    direct = dict((node.name, _referenced_names(node) & set(positions))
+                  for i, node in definitions)
+
+    keys = [None] * len(module.body)
+    for i, node in definitions:
+        closure = set()
+        pending = [node.name]
+        while pending:
+            for name in direct[pending.pop()]:
+                if name not in closure:
+                    closure.add(name)
+                    pending.append(name)
+        dependencies = sorted((name, sources[name], positions[name] < i)
+                              for name in closure)
+        keys[i] = _digest(CACHE_VERSION, sources[node.name], fingerprint, dependencies)
+    return keys
+
+class ConversionCache(object):
+    """
+    On-disk store of converted definitions, one pickle file per key.
+
+    Entries are evicted least recently used first once the cache
+    holds more than max_entries files or max_bytes bytes.
+
+    """
+    def __init__(self, directory, max_entries=DEFAULT_MAX_ENTRIES, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _path(self, key):
+        return os.path.join(self.directory, key + ENTRY_EXTENSION)
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as f:
+                value = pickle.load(f)
+        except IOError:
+            self.misses += 1
+            return None
+        except Exception:
+            # Truncated or stale entry, treat as a miss.
+            self._remove(path)
+            self.misses += 1
+            return None
+
+        # Mark as recently used.
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        path = self._path(key)
+        tmppath = '%s.%d.tmp' % (path, os.getpid())
+        with open(tmppath, 'wb') as f:
+            pickle.dump(value, f, pickle.HIGHEST_PROTOCOL)
+        try:
+            os.rename(tmppath, path)
+        except OSError:
+            # Another process stored the same entry first.
+            self._remove(tmppath)
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def prune(self):
+        """
+        Evicts least recently used entries until the cache is
+        within its size bounds.
+
+        """
+        entries = []
+        for name in os.listdir(self.directory):
+            if not name.endswith(ENTRY_EXTENSION):
+                continue
+            path = os.path.join(self.directory, name)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            entries.append((st.st_mtime, st.st_size, path))
+
+        entries.sort(reverse=True)
+        count = total = 0
+        for mtime, size, path in entries:
+            count += 1
+            total += size
+            if count > self.max_entries or total > self.max_bytes:
+                self._remove(path)
+
+    def clear(self):
+        for name in os.listdir(self.directory):
+            if name.endswith(ENTRY_EXTENSION):
+                self._remove(os.path.join(self.directory, name))
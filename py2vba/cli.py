@@ -0,0 +1,200 @@
+"""
+Command line converter.
+
+Converts every Python file under the given paths into VBA modules,
+spreading the work across a process pool:
+
+    py2vba --jobs 8 -o build/vba src/
+
+Each file becomes a procedural module named after its path relative
+to the source root, e.g. reports/monthly.py becomes reports_monthly.bas,
+plus a .cls file per class and a <module>cls_support.bas file for
+class constructors.
+
+"""
+import argparse
+import multiprocessing
+import os
+import re
+import sys
+
+from py2vba import convert, export
+from py2vba.cache import ConversionCache
+from py2vba.profiling import Profile
+
+PYTHON_EXTENSION = '.py'
+
+# VBA identifiers are limited to 31 characters.
+MAX_MODULE_NAME_LENGTH = 31
+
+class ConversionError(Exception):
+    pass
+
+def find_sources(paths):
+    """
+    Returns a sorted list of (path, module name) for each Python
+    file in paths, descending into directories. Raises ConversionError
+    if two files would become modules of the same name.
+
+    """
+    sources = []
+    for root in paths:
+        if os.path.isfile(root):
+            sources.append((root, os.path.basename(root)))
+            continue
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                if filename.endswith(PYTHON_EXTENSION):
+                    path = os.path.join(dirpath, filename)
+                    sources.append((path, os.path.relpath(path, root)))
+    result = []
+    # VBA module names are case insensitive.
+    owners = {}
+    for path, relpath in sorted(sources):
+        name = module_name_for(relpath)
+        if name.lower() in owners:
+            raise ConversionError('%s and %s would both become module %s.'
+                                  % (owners[name.lower()], path, name))
+        owners[name.lower()] = path
+        result.append((path, name))
+    return result
+
+def module_name_for(relpath):
+    name = os.path.splitext(relpath)[0]
+    name = re.sub(r'[^A-Za-z0-9]+', '_', name).strip('_')
+    if not name or not name[0].isalpha():
+        name = 'Py' + name
+    if len(name) > MAX_MODULE_NAME_LENGTH:
+        raise ConversionError('Module name %r derived from %r is longer than %d characters.'
+                              % (name, relpath, MAX_MODULE_NAME_LENGTH))
+    return name
+
+def convert_file(task):
+    """
+    Converts a single source file, returning (path, outputs, error,
+    profile) where outputs is a list of (filename, code). Runs in a
+    worker process so it must only return picklable values.
+
+    """
+    path, module_name, cache_dir, profiling = task
+    profile = Profile() if profiling else None
+    try:
+        with open(path) as f:
+            code = f.read()
+        walker = convert.PythonASTWalker(
+            cache=ConversionCache(cache_dir) if cache_dir else None,
+            module_name=module_name,
+            profile=profile)
+        with _phase(profile, 'parse'):
+            tree = convert.build_ast_from_code(code)
+        with _phase(profile, 'walk'):
+            module = walker.walk(tree)
+        if not module.code and not module.support_modules:
+            return path, [], None, profile
+        # Including the modules for classes and their constructors.
+        for m in export.iter_modules(module):
+            if len(m.name) > MAX_MODULE_NAME_LENGTH:
+                raise ConversionError('Module name %r is longer than %d characters.'
+                                      % (m.name, MAX_MODULE_NAME_LENGTH))
+        with _phase(profile, 'emit'):
+            outputs = [(export.module_filename(m), m.as_code())
+                       for m in export.iter_modules(module)]
+        return path, outputs, None, profile
+    except Exception as e:
+        return path, [], '%s: %s' % (e.__class__.__name__, e), profile
+
+class _NoPhase(object):
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+def _phase(profile, name):
+    if profile is None:
+        return _NoPhase()
+    return profile.phase(name)
+
+def convert_sources(sources, jobs=1, cache_dir=None, profile=None):
+    """
+    Converts sources, a list of (path, module name), returning the
+    merged list of (filename, code). The result is in source order
+    no matter which worker finishes first. When profile is given the
+    statistics from every worker are merged into it.
+
+    """
+    tasks = [(path, module_name, cache_dir, profile is not None)
+             for path, module_name in sources]
+    if jobs == 1 or len(tasks) <= 1:
+        results = map(convert_file, tasks)
+    else:
+        pool = multiprocessing.Pool(jobs)
+        try:
+            results = pool.map(convert_file, tasks, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+    if profile is not None:
+        for path, outputs, error, file_profile in results:
+            profile.merge(file_profile)
+
+    errors = ['%s: %s' % (path, error) for path, outputs, error, file_profile in results if error]
+    if errors:
+        raise ConversionError('\n'.join(errors))
+
+    # VBA module names are case insensitive and share one namespace
+    # per project.
+    merged = []
+    owners = {}
+    for path, outputs, error, file_profile in results:
+        for filename, code in outputs:
+            key = filename.lower()
+            if key in owners:
+                raise ConversionError('%s: module %s is also generated from %s.'
+                                      % (path, filename, owners[key]))
+            owners[key] = path
+            merged.append((filename, code))
+    return merged
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Convert Python source trees into VBA modules.')
+    parser.add_argument('paths', nargs='+', metavar='PATH',
+                        help='Python file or directory tree to convert.')
+    parser.add_argument('-o', '--output', default='.',
+                        help='Directory to write .bas/.cls files to (default: current directory).')
+    parser.add_argument('-j', '--jobs', type=int, default=multiprocessing.cpu_count(),
+                        help='Number of worker processes (default: number of cores).')
+    parser.add_argument('--cache-dir',
+                        help='Directory for the incremental conversion cache.')
+    parser.add_argument('--profile', metavar='PATH',
+                        help='Write per-handler and per-phase timings to PATH (- for stderr).')
+    args = parser.parse_args(argv)
+
+    if args.jobs < 1:
+        parser.error('--jobs must be at least 1.')
+
+    profile = Profile() if args.profile else None
+    try:
+        outputs = convert_sources(find_sources(args.paths), args.jobs, args.cache_dir, profile)
+    except ConversionError as e:
+        sys.stderr.write('%s\n' % (e,))
+        return 1
+    finally:
+        if profile is not None:
+            if args.profile == '-':
+                profile.dump(sys.stderr)
+            else:
+                with open(args.profile, 'w') as f:
+                    profile.dump(f)
+
+    if not os.path.isdir(args.output):
+        os.makedirs(args.output)
+    for filename, code in outputs:
+        with open(os.path.join(args.output, filename), 'w') as f:
+            f.write(code)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
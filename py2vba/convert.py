@@ -1,6 +1,17 @@
-from nodewalker import NodeWalker, visitor, NodeWalkerError
+from nodewalker import NodeWalker, visitor, result, NodeWalkerError
 import _ast, ast
+import copy
 import vbast
+import cache
+import inference
+import folding
+import runtime
+import reachability
+import inlining
+import hoisting
+import cse
+import wrappers
+import literals
 
 class PythonASTWalkerError(NodeWalkerError):
     pass
@@ -21,15 +32,85 @@ COMPAREOP_MAP = {
     _ast.Lt : '<',
     _ast.GtE : '>=',
     _ast.LtE : '<=',
-    _ast.Eq : '=', 
+    _ast.Eq : '=',
+    _ast.NotEq : '<>',
+    _ast.Is : 'Is',
 }
 
+# Operators of expressions that are always Boolean.
+BOOLEAN_OPS = ('=', '<>', '<', '>', '<=', '>=', 'Is', 'And', 'Or')
+
 BOOLOP_MAP = {
     _ast.And : 'And',
     _ast.Or : 'Or',
 }
 
 VBMETA = 'vbmeta'
+VBCACHE = 'vbcache'
+
+# vbmeta() keywords that are flags rather than variable types.
+VBMETA_FLAGS = ('entry', 'udt', 'vectorize', 'fast_mode')
+
+# Flags adding wrappers around module level functions, vbcache()
+# included.
+WRAPPER_FLAGS = ('vectorize', 'fast_mode', VBCACHE)
+
+# Wrappers that take the function's name, which is converted with
+# wrappers.BODY_SUFFIX appended instead.
+RENAMING_FLAGS = ('fast_mode', VBCACHE)
+
+# Builtins lowered to a single loop over their argument.
+REDUCTIONS = ('sum', 'len', 'min', 'max', 'any', 'all')
+
+# Builtins and constants that are never variables.
+BUILTIN_NAMES = REDUCTIONS + ('range', 'xrange', 'sorted', 'True', 'False', 'None')
+
+# Builtins taking any number of arguments, or a single iterable.
+EXTREMES = {
+    'min' : 'PyMin',
+    'max' : 'PyMax',
+}
+
+EXIT_STATEMENTS = (vbast.ExitFunctionStatement, vbast.ExitSubStatement)
+
+# Initial capacity of arrays lowered from lists.
+MIN_ARRAY_CAPACITY = 8
+
+# Appended to the names of RangeData parameters, which take the Range
+# while the Python name refers to its values.
+RANGE_SUFFIX = '_range_'
+
+class NumericPolicy(object):
+    """
+    Decides which VBA types Python numbers lower to. Whole numbers
+    that don't fit int_type widen to Long, then Double.
+
+    """
+    def __init__(self, int_type=vbast.Long, float_type=vbast.Double):
+        if int_type not in vbast.INTEGER_RANGES:
+            raise ValueError('%r is not a VBA whole number type.' % (int_type,))
+        self.int_type = int_type
+        self.float_type = float_type
+
+    def __repr__(self):
+        return 'NumericPolicy(%r, %r)' % (self.int_type, self.float_type)
+
+    def literal(self, value):
+        if isinstance(value, float):
+            try:
+                return vbast.FloatLiteral(value, self.float_type)
+            except ValueError as e:
+                raise PythonASTWalkerError(str(e))
+        low, high = vbast.INTEGER_RANGES[self.int_type]
+        if low <= value <= high:
+            return vbast.IntegerLiteral(value, self.int_type)
+        return vbast.IntegerLiteral(value, max(self.int_type, vbast.literal_type(value),
+                                               key=inference.NUMERIC_TYPES.index))
+
+# Python ints as Long and floats as Double.
+NATIVE_WIDTH = NumericPolicy()
+# The 16-bit Integer of earlier releases.
+LEGACY_WIDTH = NumericPolicy(vbast.Integer)
 
 def vbmeta(**kwargs):
     def vbmeta_decorator(fcn):
@@ -37,13 +118,111 @@ def vbmeta(**kwargs):
         return fcn
     return vbmeta_decorator
 
+def vbcache(maxsize=None):
+    def vbcache_decorator(fcn):
+        fcn.vbcache = dict(maxsize=maxsize)
+        return fcn
+    return vbcache_decorator
+
+def _extract_vbcache_details(call):
+    """
+    Returns {'maxsize' : value} for the arguments of a vbcache()
+    decorator.
+
+    """
+    args = call.args + [kw.value for kw in call.keywords if kw.arg == 'maxsize']
+    if len(args) > 1 or len(call.args) + len(call.keywords) != len(args):
+        raise PythonASTWalkerError('vbcache only takes maxsize.')
+    try:
+        maxsize = ast.literal_eval(args[0]) if args else None
+    except ValueError:
+        raise PythonASTWalkerError('vbcache maxsize must be a constant.')
+    if maxsize is not None and (not isinstance(maxsize, (int, long)) or maxsize < 1):
+        raise PythonASTWalkerError('vbcache maxsize must be a positive whole number.')
+    return dict(maxsize=maxsize)
+
 def _extract_vbmeta_details(call):
-    return [(kw.arg, kw.value.id) for kw in
-                    call.keywords]
+    """
+    Returns ({variable : type name}, {flag : value}) for the keywords
+    of a vbmeta() decorator.
+
+    """
+    typenames = {}
+    flags = {}
+    for kw in call.keywords:
+        if kw.arg in VBMETA_FLAGS:
+            try:
+                flags[kw.arg] = ast.literal_eval(kw.value)
+            except ValueError:
+                raise PythonASTWalkerError('vbmeta %s must be a constant.' % (kw.arg,))
+        else:
+            typenames[kw.arg] = kw.value.id
+    return typenames, flags
+
+class _DefinitionFragment(object):
+    """
+    Everything that converting one top-level definition added to
+    the module being built, in a form that can be cached and later
+    replayed onto another module.
+
+    """
+    def __init__(self, walker, mark):
+        vbmodule = walker._in_vbmodule
+        code, declarations, support_modules, support_code, functions, classnames, udts = mark
+        self.code = vbmodule.code[code:]
+        self.declarations = vbmodule.declarations[declarations:]
+        self.support_modules = vbmodule.support_modules[support_modules:]
+        if vbmodule.class_support_module:
+            self.support_code = vbmodule.class_support_module.code[support_code:]
+        else:
+            self.support_code = []
+        self.function_namespace = dict((name, f) for name, f
+                                       in vbmodule.function_namespace.iteritems()
+                                       if name not in functions)
+        self.classnames = walker._classnames[classnames:]
+        self.udts = dict((name, t) for name, t in walker._udts.iteritems() if name not in udts)
+
+    @staticmethod
+    def mark(walker):
+        vbmodule = walker._in_vbmodule
+        support = vbmodule.class_support_module
+        return (len(vbmodule.code), len(vbmodule.declarations),
+                len(vbmodule.support_modules),
+                len(support.code) if support else 0,
+                set(vbmodule.function_namespace),
+                len(walker._classnames), set(walker._udts))
+
+    def apply(self, walker):
+        vbmodule = walker._in_vbmodule
+        vbmodule.code.extend(self.code)
+        vbmodule.declarations.extend(self.declarations)
+        vbmodule.support_modules.extend(self.support_modules)
+        if self.support_code:
+            walker._get_class_support_module().code.extend(self.support_code)
+        vbmodule.function_namespace.update(self.function_namespace)
+        walker._classnames.extend(self.classnames)
+        for udt in self.udts.itervalues():
+            walker._register_udt(udt)
 
 class PythonASTWalker(NodeWalker):
-    def __init__(self):
-        super(PythonASTWalker, self).__init__()
+    def __init__(self, iterative=True, cache=None, module_name='PyMain', profile=None,
+                 infer_types=True, numeric_policy=NATIVE_WIDTH, fold_constants=True,
+                 list_arrays=False, inline_comprehensions=False, inline_functions=True,
+                 hoist_member_access=True, eliminate_common_subexpressions=True,
+                 cache_literals=True):
+        super(PythonASTWalker, self).__init__(iterative, profile)
+
+        self._cache = cache
+        self._module_name = module_name
+        self._infer_types = infer_types
+        self._numeric_policy = numeric_policy
+        self._fold_constants = fold_constants
+        self._list_arrays = list_arrays
+        self._inline_comprehensions = inline_comprehensions
+        self._inline_functions = inline_functions
+        self._hoist_member_access = hoist_member_access
+        self._eliminate_common_subexpressions = eliminate_common_subexpressions
+        self._cache_literals = cache_literals
 
         # State
         self._in_vbfunction = None
@@ -53,41 +232,146 @@ class PythonASTWalker(NodeWalker):
         self._in_vbclassmodule = None
         self._selfname = None
 
+        # Locals of the current function lowered to arrays.
+        self._arrays = set()
+        self._temp_count = 0
+        # Statements that must run before the statement being converted.
+        self._preamble = []
+
         self._classnames = []
-        
+        # Classes declared with vbmeta(udt=True), by name.
+        self._udts = {}
+
         # Types
         self._types = {}
         for type in vbast.BUILTIN_TYPES:
             self.register_type(type)
+        self.register_type(vbast.RangeData, 'RangeData')
+
+    def register_type(self, typeobj, name=None):
+        self._types[name or typeobj.name] = typeobj
+
+    def _register_udt(self, udt):
+        self._udts[udt.name] = udt
+        self.register_type(udt)
 
-    def register_type(self, typeobj):
-        self._types[typeobj.name] = typeobj
+    def _cache_fingerprint(self):
+        """
+        Returns a value describing everything besides the source that
+        affects how a definition is converted.
+
+        """
+        types = sorted((name, t.__class__.__name__, t.name, t.is_object_type())
+                       for name, t in self._types.iteritems())
+        return (types, repr(self._numeric_policy), self._list_arrays,
+                self._inline_comprehensions)
 
     @visitor(_ast.Module)
     def visit_module(self, module):
-        vbmodule = vbast.ProceduralModule('PyMain')
+        vbmodule = vbast.ProceduralModule(self._module_name)
         self._in_vbmodule = vbmodule
-        for c in module.body:
-            if isinstance(c, _ast.FunctionDef):
-                vbmodule.code.append(self.walk(c))
-            elif isinstance(c, _ast.ClassDef):
-                self.walk(c)
-            else:
-                raise PythonASTWalkerError('Unrecognized Python AST node: %r', c)
 
-        vbmodule.raw_code.append(vbast.COLLECTION_LITERAL_HELPERS)
+        if self._cache:
+            keys = cache.definition_keys(module, self._cache_fingerprint())
+        else:
+            keys = [None] * len(module.body)
+
+        for c, key in zip(module.body, keys):
+            if not isinstance(c, (_ast.FunctionDef, _ast.ClassDef)):
+                raise PythonASTWalkerError('Unrecognized Python AST node: %r' % (c,))
+            self._walk_definition(c, key)
+
+        if self._cache:
+            self._cache.prune()
+
+        reachability.prune_unreachable(vbmodule)
+        if self._infer_types:
+            inference.infer_types(vbmodule)
+        if self._inline_functions:
+            inlining.inline_functions(vbmodule)
+            # Functions only called from where they were inlined
+            # are no longer reachable.
+            reachability.prune_unreachable(vbmodule)
+        if self._fold_constants:
+            folding.fold_constants(vbmodule)
+        if self._cache_literals:
+            literals.cache_constant_literals(vbmodule)
+        if self._hoist_member_access and self._infer_types:
+            hoisting.hoist_member_access(vbmodule)
+        if self._eliminate_common_subexpressions and self._infer_types:
+            cse.eliminate_common_subexpressions(vbmodule)
+
+        runtime.link(vbmodule)
         self._in_vbmodule = None
         return vbmodule
 
-    def _extract_typeinfo_from_functiondef(self, functiondef):
+    def _walk_definition(self, definition, key):
+        if key:
+            fragment = self._cache.get(key)
+            if fragment:
+                fragment.apply(self)
+                return
+
+        mark = _DefinitionFragment.mark(self)
+        if isinstance(definition, _ast.FunctionDef):
+            vbfunction = self.walk(definition)
+            self._in_vbmodule.code.append(vbfunction)
+            self._add_wrappers(definition, vbfunction)
+        else:
+            self.walk(definition)
+
+        if key:
+            self._cache.put(key, _DefinitionFragment(self, mark))
+
+    def _add_wrappers(self, functiondef, vbfunction):
+        """
+        Adds the wrappers the vbmeta and vbcache flags of functiondef
+        ask for around vbfunction to the module, innermost first.
+
+        """
+        typeinfo, flags = self._extract_vbmeta_from_functiondef(functiondef)
+        if flags.get('fast_mode') and (flags.get('vectorize') or flags.get(VBCACHE)):
+            raise PythonASTWalkerError('%s cannot be both a fast_mode macro and a worksheet '
+                                       'function.' % (functiondef.name,))
+        outer = vbfunction
+        try:
+            if flags.get(VBCACHE):
+                outer = self._add_wrapper(wrappers.cached(outer, functiondef.name,
+                                                          **flags[VBCACHE]))
+            if flags.get('fast_mode'):
+                outer = self._add_wrapper(wrappers.fast_mode(outer, functiondef.name))
+            if flags.get('vectorize'):
+                self._add_wrapper(wrappers.vectorized(outer))
+        except ValueError as e:
+            raise PythonASTWalkerError(str(e))
+
+    def _add_wrapper(self, wrapper):
+        if wrapper.name in self._in_vbmodule.function_namespace:
+            raise PythonASTWalkerError('%s is already defined.' % (wrapper.name,))
+        self._in_vbmodule.code.append(wrapper)
+        self._in_vbmodule.function_namespace[wrapper.name] = wrapper
+        return wrapper
+
+    def _extract_vbmeta_from_functiondef(self, functiondef):
+        """
+        Returns (typeinfo, flags) from the vbmeta decorators of
+        functiondef, or of a classdef.
+
+        """
         vbmeta_decorators = [d for d in functiondef.decorator_list if
                                 isinstance(d, _ast.Call) and
                                 d.func.id == VBMETA]
 
-        rawtypeinfo = set()
+        rawtypeinfo = {}
+        flags = {}
         for d in vbmeta_decorators:
-            rawtypeinfo.update(_extract_vbmeta_details(d))
-        return {varname:self._types[typename] for varname, typename in rawtypeinfo}
+            typenames, decorator_flags = _extract_vbmeta_details(d)
+            rawtypeinfo.update(typenames)
+            flags.update(decorator_flags)
+        for d in functiondef.decorator_list:
+            if isinstance(d, _ast.Call) and d.func.id == VBCACHE:
+                flags[VBCACHE] = _extract_vbcache_details(d)
+        return {varname:self._types[typename] for varname, typename in rawtypeinfo.iteritems()}, flags
 
     def _build_args(self, functiondef, typeinfo):
         if self._in_vbclassmodule:
@@ -106,14 +390,16 @@ class PythonASTWalker(NodeWalker):
     def _create_dim_statements(self, vardefs):
         return [vbast.DimDeclaration(name, type) for name,type in vardefs]
 
-    def _create_and_add_class_ctor(self, functiondef, vbfunction, typeinfo):
-        ctorname = self._in_vbclassmodule.name + '_ctor_'
-
+    def _get_class_support_module(self):
         if not self._in_vbmodule.class_support_module:
             self._in_vbmodule.class_support_module = \
                     vbast.ProceduralModule(self._in_vbmodule.name + 'cls_support')
+        return self._in_vbmodule.class_support_module
 
-        self._in_vbmodule.class_support_module.code.append(
+    def _create_and_add_class_ctor(self, functiondef, vbfunction, typeinfo):
+        ctorname = self._in_vbclassmodule.name + '_ctor_'
+
+        self._get_class_support_module().code.append(
             vbast.Function(
                 ctorname,
                 vbfunction.parameters,
@@ -154,22 +440,36 @@ class PythonASTWalker(NodeWalker):
         # Create instance variable declarations.
         self._in_vbclassmodule.declarations += [vbast.PublicVariableDeclaration(name, type) 
                                                 for name, type 
-                                                in instance_variables.iteritems()]
+                                                in sorted(instance_variables.iteritems())]
 
     @visitor(_ast.FunctionDef)
     def visit_functiondef(self, functiondef):
         assert not self._in_vbfunction, 'Cannot handle nested functiondefs at the moment,'
 
-        typeinfo = self._extract_typeinfo_from_functiondef(functiondef)
+        typeinfo, flags = self._extract_vbmeta_from_functiondef(functiondef)
+        if self._in_vbclassmodule and any(flags.get(f) for f in WRAPPER_FLAGS):
+            raise PythonASTWalkerError('Method %s cannot use %s or %s.' %
+                                       ((functiondef.name, ', '.join(WRAPPER_FLAGS[:-1]),
+                                         WRAPPER_FLAGS[-1])))
         rettype = typeinfo.get('rettype', vbast.Variant)
         args, self._selfname = self._build_args(functiondef, typeinfo)
 
         if functiondef.name == '__init__' and self._in_vbclassmodule:
             fname = 'init__'
+        elif any(flags.get(f) for f in RENAMING_FLAGS):
+            # The wrapper takes the function's name.
+            fname = functiondef.name + wrappers.BODY_SUFFIX
         else:
             fname = functiondef.name
         
+        ranges = [p.name.name for p in args if p.vbtype == vbast.RangeData]
+        args = [vbast.Parameter(vbast.SimpleNameExpression(p.name.name + RANGE_SUFFIX))
+                if p.vbtype == vbast.RangeData else p for p in args]
+
         vbfunction = vbast.Function(fname, args, rettype, [])
+        vbfunction.entry = bool(flags.get('entry')) and not self._in_vbclassmodule
+        for name in ranges:
+            vbfunction.locals[name] = vbast.RangeData
 
         if self._in_vbclassmodule:
             self._in_vbclassmodule.method_namespace[vbfunction.name] = vbfunction
@@ -180,42 +480,192 @@ class PythonASTWalker(NodeWalker):
             self._create_and_add_class_ctor(functiondef, vbfunction, typeinfo)
 
         self._in_vbfunction = vbfunction
-
-        body_statements = sum([self.walk(c) for c in functiondef.body], [])
-        dim_statements = self._create_dim_statements(vbfunction.locals.iteritems())
-
+        self._temp_count = 0
+        if self._list_arrays or self._udts:
+            self._arrays = _array_candidates(functiondef, self._inline_comprehensions)
+            if not self._list_arrays:
+                # Collections can't hold user-defined types.
+                self._arrays &= _udt_lists(functiondef, self._udts)
+
+        body_statements = self._walk_block(functiondef.body)
+        dim_statements = self._create_dim_statements(sorted(vbfunction.locals.iteritems()))
+
+        if ranges:
+            body_statements = self._range_values(functiondef, ranges, body_statements)
         vbfunction.statements = dim_statements + body_statements
 
         self._in_vbfunction = None
         self._selfname = None
+        self._arrays = set()
 
         return vbfunction
 
+    def _range_values(self, functiondef, ranges, statements):
+        """
+        Wraps statements to read each RangeData parameter's values in
+        one go on entry and, if any are assigned, write them back in
+        one go on every exit.
+
+        """
+        reads = [vbast.LetStatement(
+                    vbast.SimpleNameExpression(name),
+                    runtime.call('PyRangeValues', [vbast.SimpleNameExpression(name + RANGE_SUFFIX)]))
+                 for name in ranges]
+        writes = []
+        for name in _written_ranges(functiondef, ranges):
+            cells = vbast.SimpleNameExpression(name + RANGE_SUFFIX)
+            test = vbast.IndexExpression(vbast.SimpleNameExpression('IsObject'), [cells])
+            test.set_vbtype(vbast.Boolean)
+            # Arrays passed in by converted code are updated in place.
+            writes.append(vbast.IfStatement(
+                test,
+                [vbast.LetStatement(vbast.MemberAccessExpression(
+                                        cells, vbast.SimpleNameExpression('Value2')),
+                                    vbast.SimpleNameExpression(name))],
+                orelse=[vbast.LetStatement(cells, vbast.SimpleNameExpression(name))]))
+        if writes:
+            _insert_before_exits(statements, writes)
+            if not statements or not isinstance(statements[-1], EXIT_STATEMENTS):
+                statements = statements + copy.deepcopy(writes)
+        return reads + statements
+
     @visitor(_ast.Assign)
     def visit_assign(self, assign):
         if len(assign.targets) > 1:
             raise PythonASTWalkerError('Cannot handle more than 1 assignment target.')
 
-        lexpression = self.walk(assign.targets[0])
+        target = assign.targets[0]
+        if isinstance(target, _ast.Name) and target.id in self._arrays:
+            if isinstance(assign.value, _ast.ListComp):
+                return self._assign_array_comprehension(target.id, assign.value)
+            return self._assign_array(target.id, [self.walk(e) for e in assign.value.elts])
+
+        lexpression = self.walk(target)
         rhs = self.walk(assign.value)
         if isinstance(lexpression, vbast.SimpleNameExpression) and \
                 lexpression.name not in self._in_vbfunction.locals:
             self._in_vbfunction.locals[lexpression.name] = rhs.vbtype()
 
-        if rhs.vbtype().is_object_type():
-            assignment_statment = vbast.SetStatement
-        else:
-            assignment_statment = vbast.LetStatement
+        return [self._assignment(lexpression, rhs)]
 
-        return [assignment_statment(lexpression, rhs)]
+    def _assignment(self, lexpression, rhs):
+        if rhs.vbtype().is_object_type():
+            return vbast.SetStatement(lexpression, rhs)
+        return vbast.LetStatement(lexpression, rhs)
+
+    def _new_temp(self, vbtype):
+        """
+        Declares a new local of vbtype for intermediate values,
+        returning its name.
+
+        """
+        name = 'tmp%d_' % (self._temp_count,)
+        self._temp_count += 1
+        self._in_vbfunction.locals[name] = vbtype
+        return name
+
+    def _is_boolean(self, expression):
+        if isinstance(expression, vbast.BinOp):
+            return expression.binop in BOOLEAN_OPS
+        if isinstance(expression, vbast.UnaryOp):
+            return expression.op == 'Not '
+        if isinstance(expression, vbast.SimpleNameExpression) and \
+                expression.name in ('True', 'False'):
+            return True
+        return self._static_type(expression) == vbast.Boolean
+
+    def _static_type(self, expression):
+        """
+        Returns the type of expression as far as it is known while
+        converting, before type inference has run.
+
+        """
+        if isinstance(expression, vbast.SimpleNameExpression) and \
+                expression.name in self._in_vbfunction.locals:
+            return self._in_vbfunction.locals[expression.name]
+        return expression.vbtype()
+
+    def _array_length(self, name):
+        return vbast.SimpleNameExpression(name + '_len_')
+
+    def _assign_array(self, name, elements):
+        policy = self._numeric_policy
+        length = self._array_length(name)
+        self._in_vbfunction.locals[name] = vbast.ArrayType(vbast.Variant)
+        self._in_vbfunction.locals[length.name] = policy.int_type
+
+        capacity = max(len(elements), MIN_ARRAY_CAPACITY)
+        statements = [vbast.ReDimStatement(vbast.SimpleNameExpression(name),
+                                           policy.literal(capacity - 1))]
+        for i, element in enumerate(elements):
+            statements.append(self._assignment(
+                vbast.IndexExpression(vbast.SimpleNameExpression(name), [policy.literal(i)]),
+                element))
+        statements.append(vbast.LetStatement(length, policy.literal(len(elements))))
+        return statements
+
+    def _append_to_array(self, name, element, grow=True):
+        # Doubling the capacity whenever the array is full keeps
+        # appends amortized O(1).
+        policy = self._numeric_policy
+        growth = vbast.IfStatement(
+            vbast.BinOp('>', self._array_length(name),
+                        vbast.IndexExpression(vbast.SimpleNameExpression('UBound'),
+                                              [vbast.SimpleNameExpression(name)])),
+            [vbast.ReDimStatement(
+                vbast.SimpleNameExpression(name),
+                vbast.BinOp('-', vbast.BinOp('*', policy.literal(2), self._array_length(name)),
+                            policy.literal(1)),
+                preserve=True)])
+        return ([growth] if grow else []) + [
+                self._assignment(vbast.IndexExpression(vbast.SimpleNameExpression(name),
+                                                       [self._array_length(name)]),
+                                 element),
+                vbast.LetStatement(self._array_length(name),
+                                   vbast.BinOp('+', self._array_length(name), policy.literal(1)))]
+
+    @visitor(_ast.Expr)
+    def visit_expr(self, expr):
+        value = expr.value
+        if isinstance(value, _ast.Str):
+            # Docstring
+            return []
+        if not isinstance(value, _ast.Call):
+            raise PythonASTWalkerError('Only calls can be used as statements.')
+
+        func = value.func
+        if isinstance(func, _ast.Attribute) and func.attr == 'append' and len(value.args) == 1:
+            if isinstance(func.value, _ast.Name) and func.value.id in self._arrays:
+                return self._append_to_array(func.value.id, self.walk(value.args[0]))
+            owner = self.walk(func.value)
+            if self._static_type(owner) == vbast.Collection:
+                element = self.walk(value.args[0])
+                self._check_storable(element)
+                return [vbast.CallStatement(
+                    vbast.MemberAccessExpression(owner, vbast.SimpleNameExpression('Add')),
+                    [element])]
+
+        call = self.walk(value)
+        return [vbast.CallStatement(call.lexpression, call.args)]
 
     @visitor(_ast.Dict)
     def visit_dict(self, dict):
-        return vbast.DictLiteral([(self.walk(k), self.walk(v)) for k,v in zip(dict.keys, dict.values)])
+        items = []
+        for k, v in zip(dict.keys, dict.values):
+            key = yield k
+            value = yield v
+            self._check_storable(value)
+            items.append((key, value))
+        yield result(vbast.DictLiteral(items))
 
     @visitor(_ast.List)
     def visit_list(self, list):
-        return vbast.ListLiteral([self.walk(e) for e in list.elts])
+        elements = []
+        for e in list.elts:
+            element = yield e
+            self._check_storable(element)
+            elements.append(element)
+        yield result(vbast.ListLiteral(elements))
 
     @visitor(_ast.Str)
     def visit_str(self, str):
@@ -223,19 +673,79 @@ class PythonASTWalker(NodeWalker):
 
     @visitor(_ast.Num)
     def visit_num(self, num):
-        return vbast.IntegerLiteral(num.n)
+        if isinstance(num.n, complex):
+            raise PythonASTWalkerError('VBA has no complex numbers.')
+        return self._numeric_policy.literal(num.n)
+
+    def _is_range_data(self, node):
+        return isinstance(node, _ast.Name) and self._in_vbfunction and \
+               self._in_vbfunction.locals.get(node.id) == vbast.RangeData
+
+    def _range_index(self, values, index, dimension):
+        """
+        Returns the 1-based index of a Value2 array along dimension
+        for a Python index.
+
+        """
+        policy = self._numeric_policy
+        if isinstance(index, _ast.Num) and index.n < 0:
+            upper = vbast.IndexExpression(vbast.SimpleNameExpression('UBound'),
+                                          [values, policy.literal(dimension)])
+            upper.set_vbtype(vbast.Long)
+            if index.n == -1:
+                return upper
+            return vbast.BinOp('-', upper, policy.literal(-index.n - 1))
+        return vbast.BinOp('+', self.walk(index), policy.literal(1))
+
+    def _range_length(self, values, dimension):
+        length = vbast.IndexExpression(vbast.SimpleNameExpression('UBound'),
+                                       [values, self._numeric_policy.literal(dimension)])
+        length.set_vbtype(vbast.Long)
+        return length
 
     @visitor(_ast.Subscript)
     def visit_subscript(self, ss):
-        lexpression = self.walk(ss.value)
-        if isinstance(ss.slice.value, _ast.Num):
-            return vbast.IndexExpression(lexpression,
-                    [vbast.BinOp('+', vbast.IntegerLiteral(ss.slice.value.n), 
-                                             vbast.IntegerLiteral(1))])
-        elif isinstance(ss.slice.value, _ast.Str):
-            return vbast.IndexExpression(lexpression, [vbast.StringLiteral(ss.slice.value.s)])
+        if not isinstance(ss.slice, _ast.Index):
+            raise PythonASTWalkerError('Slicing is not supported.')
+        if self._is_range_data(ss.value):
+            raise PythonASTWalkerError('RangeData can only be indexed as %s[row][column].' %
+                                       (ss.value.id,))
+        if isinstance(ss.value, _ast.Subscript) and self._is_range_data(ss.value.value):
+            row = ss.value
+            if not isinstance(row.slice, _ast.Index):
+                raise PythonASTWalkerError('Slicing is not supported.')
+            values = yield row.value
+            yield result(vbast.IndexExpression(values, [
+                self._range_index(values, row.slice.value, 1),
+                self._range_index(values, ss.slice.value, 2)]))
+            return
+        lexpression = yield ss.value
+        index = ss.slice.value
+        policy = self._numeric_policy
+
+        if isinstance(ss.value, _ast.Name) and ss.value.id in self._arrays:
+            # Arrays are 0-based, like Python lists.
+            if isinstance(index, _ast.Num) and index.n < 0:
+                key = vbast.BinOp('-', self._array_length(ss.value.id), policy.literal(-index.n))
+            else:
+                key = yield index
+        elif isinstance(index, _ast.Num) and index.n < 0 and \
+                self._static_type(lexpression) == vbast.Collection:
+            count = self._length(ss.value, lexpression)
+            key = vbast.BinOp('+', count, policy.literal(index.n + 1))
+        elif isinstance(index, _ast.Num):
+            key = vbast.BinOp('+', policy.literal(index.n), policy.literal(1))
+        elif isinstance(index, _ast.Str):
+            key = vbast.StringLiteral(index.s)
         else:
-            raise PythonASTWalkerError('Can only handle Integer and String array indexing.')
+            owner_type = self._static_type(lexpression)
+            key = yield index
+            if owner_type == vbast.Collection:
+                key = vbast.BinOp('+', key, policy.literal(1))
+            elif owner_type != vbast.Dictionary:
+                raise PythonASTWalkerError('Can only index by expressions into Collections, '
+                                           'Dictionaries and arrays.')
+        yield result(vbast.IndexExpression(lexpression, [key]))
 
     @visitor(_ast.Return)
     def visit_return(self, ret):
@@ -255,54 +765,272 @@ class PythonASTWalker(NodeWalker):
     @visitor(_ast.BinOp)
     def visit_binop(self, binop):
         if binop.op.__class__ in BINOP_MAP:
-            return vbast.BinOp(BINOP_MAP[binop.op.__class__],
-                    self.walk(binop.left), 
-                    self.walk(binop.right))
+            left = yield binop.left
+            right = yield binop.right
+            yield result(vbast.BinOp(BINOP_MAP[binop.op.__class__], left, right))
         else:
             raise PythonASTWalkerError('Unhandled binary operation %s.' % (binop.op,))
 
     @visitor(_ast.UnaryOp)
     def visit_unaryop(self, unaryop):
-        return vbast.UnaryOp(UNARYOP_MAP[unaryop.op.__class__],
-                self.walk(unaryop.operand))
+        operand = yield unaryop.operand
+        yield result(vbast.UnaryOp(UNARYOP_MAP[unaryop.op.__class__], operand))
 
     @visitor(_ast.Call)
     def visit_call(self, call):
-        if call.func.id in self._classnames:
-            expression = vbast.IndexExpression(
-                    vbast.SimpleNameExpression(call.func.id + '_ctor_'),
-                    [self.walk(a) for a in call.args])
-            expression.set_vbtype(vbast.NamedObjectType(call.func.id))
+        func = getattr(call.func, 'id', None)
+        if func == 'len' and call.args and isinstance(call.args[0], _ast.GeneratorExp):
+            raise PythonASTWalkerError('Generators have no len(), use a list comprehension.')
+        if func in REDUCTIONS and self._is_reduction(call):
+            yield result(self._reduce(func, call))
+        elif func == 'len' and len(call.args) == 1 and isinstance(call.args[0], _ast.Subscript) \
+                and self._is_range_data(call.args[0].value):
+            # Every row of a Range has the same length.
+            yield result(self._range_length((yield call.args[0].value), 2))
         else:
-            expression = vbast.IndexExpression(
-                    self.walk(call.func),
-                    [self.walk(a) for a in call.args])
-
-        return expression
+            args = []
+            for a in call.args:
+                args.append((yield a))
+
+            if func == 'len' and len(args) == 1:
+                expression = self._length(call.args[0], args[0])
+                if expression is None:
+                    if self._static_type(args[0]) == vbast.String:
+                        expression = vbast.IndexExpression(vbast.SimpleNameExpression('Len'), args)
+                        expression.set_vbtype(vbast.Long)
+                    else:
+                        expression = runtime.call('PyLen', args)
+            elif func in ('range', 'xrange') and _is_range_call(call):
+                policy = self._numeric_policy
+                if len(args) == 1:
+                    args.insert(0, policy.literal(0))
+                if len(args) == 2:
+                    args.append(policy.literal(1))
+                expression = runtime.call('PyRange', args)
+            elif func == 'sorted' and len(args) == 1:
+                reverse = [kw.value for kw in call.keywords if kw.arg == 'reverse']
+                if len(reverse) != len(call.keywords):
+                    raise PythonASTWalkerError('sorted() only supports the reverse keyword.')
+                for value in reverse:
+                    args.append((yield value))
+                expression = runtime.call('PySorted', args)
+            elif func in EXTREMES and args:
+                expression = runtime.call(EXTREMES[func], args)
+            elif func in self._classnames:
+                expression = vbast.IndexExpression(
+                        vbast.SimpleNameExpression(call.func.id + '_ctor_'),
+                        args)
+                expression.set_vbtype(self._udts.get(func) or vbast.NamedObjectType(func))
+            elif isinstance(call.func, _ast.Attribute) and call.func.attr == 'join' and len(args) == 1:
+                separator = yield call.func.value
+                if self._static_type(separator) == vbast.String:
+                    expression = runtime.call('PyJoin', [separator] + args)
+                else:
+                    expression = vbast.IndexExpression(
+                            vbast.MemberAccessExpression(separator, vbast.SimpleNameExpression('join')),
+                            args)
+            else:
+                expression = vbast.IndexExpression((yield call.func), args)
+
+            yield result(expression)
+
+    @visitor(_ast.GeneratorExp)
+    def visit_generatorexp(self, generatorexp):
+        # Anything besides a reduction consumes the whole generator,
+        # so it may as well be a list.
+        return self._inline_listcomp(generatorexp)
+
+    def _is_reduction(self, call):
+        if call.keywords or call.starargs or call.kwargs or not call.args:
+            return False
+        arg = call.args[0]
+        if len(call.args) > (2 if call.func.id == 'sum' else 1):
+            return False
+        if isinstance(arg, (_ast.GeneratorExp, _ast.ListComp)):
+            return True
+        # len() of a list is already cheap.
+        if call.func.id == 'len' or not isinstance(arg, _ast.Name):
+            return False
+        return arg.id in self._arrays or \
+               self._static_type(self.walk(arg)) == vbast.Collection
+
+    def _reduce(self, func, call):
+        """
+        Lowers a builtin reduction over a generator, comprehension or
+        list to a single accumulating loop ahead of the current
+        statement, returning the accumulator.
+
+        """
+        policy = self._numeric_policy
+        arg = call.args[0]
+        if isinstance(arg, (_ast.GeneratorExp, _ast.ListComp)):
+            generators, elt = arg.generators, arg.elt
+        else:
+            element = self._new_temp(vbast.Variant)
+            generators = [_ast.comprehension(_ast.Name(element, _ast.Store()), arg, [])]
+            elt = _ast.Name(element, _ast.Load())
+
+        # Type inference works out the accumulator's type, besides any
+        # and all's.
+        acc = self._new_temp(vbast.Boolean if func in ('any', 'all') else vbast.Variant)
+        def ref(n):
+            return vbast.SimpleNameExpression(n)
+        exit = [vbast.ExitForStatement()]
+        # Outer loops stop once an inner one has, i.e. once the
+        # result is known.
+        stop = None
+
+        after = []
+        if func in ('sum', 'len'):
+            start = self.walk(call.args[1]) if len(call.args) > 1 else policy.literal(0)
+            init = [self._assignment(ref(acc), start)]
+            def accumulate():
+                if func == 'len':
+                    value = policy.literal(1)
+                else:
+                    value = self.walk(elt)
+                return [vbast.LetStatement(ref(acc), vbast.BinOp('+', ref(acc), value))]
+        elif func in ('min', 'max'):
+            first = self._new_temp(vbast.Boolean)
+            value = self._new_temp(vbast.Variant)
+            init = [vbast.LetStatement(ref(first), ref('True'))]
+            def accumulate():
+                return [self._assignment(ref(value), self.walk(elt)),
+                        vbast.IfStatement(
+                            vbast.BinOp('Or', ref(first),
+                                        vbast.BinOp('<' if func == 'min' else '>',
+                                                    ref(value), ref(acc))),
+                            [self._assignment(ref(acc), ref(value)),
+                             vbast.LetStatement(ref(first), ref('False'))])]
+            after = [vbast.IfStatement(ref(first), [vbast.CallStatement(
+                vbast.MemberAccessExpression(ref('Err'), ref('Raise')),
+                [policy.literal(5), vbast.StringLiteral(func),
+                 vbast.StringLiteral('arg is an empty sequence')])])]
+        elif func == 'any':
+            init = [vbast.LetStatement(ref(acc), ref('False'))]
+            def accumulate():
+                return [vbast.IfStatement(self.walk(elt),
+                                          [vbast.LetStatement(ref(acc), ref('True'))] + exit)]
+            def stop():
+                return [vbast.IfStatement(ref(acc), [vbast.ExitForStatement()])]
+        else:
+            init = [vbast.LetStatement(ref(acc), ref('True'))]
+            def accumulate():
+                # Not is bitwise on numbers, so test with an empty
+                # If branch instead.
+                failed = [vbast.LetStatement(ref(acc), ref('False'))] + exit
+                return [vbast.IfStatement(self.walk(elt), [], orelse=failed)]
+            def stop():
+                return [vbast.IfStatement(ref(acc), [], orelse=[vbast.ExitForStatement()])]
+
+        self._preamble.extend(init)
+        self._preamble.extend(self._comprehension_loops(generators, accumulate, stop))
+        self._preamble.extend(after)
+        return ref(acc)
+
+    def _length(self, pyarg, arg):
+        if isinstance(pyarg, _ast.Name) and pyarg.id in self._arrays:
+            return self._array_length(pyarg.id)
+        if self._is_range_data(pyarg):
+            return self._range_length(arg, 1)
+        if self._static_type(arg) in (vbast.Collection, vbast.Dictionary):
+            count = vbast.MemberAccessExpression(arg, vbast.SimpleNameExpression('Count'))
+            count.set_vbtype(vbast.Long)
+            return count
+        return None
 
     @visitor(_ast.Attribute)
     def visit_attribute(self, attribute):
-        return vbast.MemberAccessExpression(
-                self.walk(attribute.value),
-                vbast.SimpleNameExpression(attribute.attr))
+        value = yield attribute.value
+        yield result(vbast.MemberAccessExpression(
+                value,
+                vbast.SimpleNameExpression(attribute.attr)))
 
     @visitor(_ast.ClassDef)
     def visit_classdef(self, classdef):
+        typeinfo, flags = self._extract_vbmeta_from_functiondef(classdef)
+        if flags.get('udt'):
+            return self._udt_classdef(classdef)
+
         self._in_vbclassmodule = vbast.ClassModule(classdef.name)
         self._classnames.append(classdef.name)
         self._in_vbmodule.support_modules.append(self._in_vbclassmodule)
         self._in_vbclassmodule.code.extend([self.walk(c) for c in classdef.body])
         self._in_vbclassmodule = None
     
+    def _udt_classdef(self, classdef):
+        """
+        Lowers a class whose __init__ only assigns its parameters to
+        fields to a Public Type, along with a constructor function
+        returning a filled in copy.
+
+        """
+        body = [c for c in classdef.body if not _is_docstring(c)]
+        if len(body) != 1 or not isinstance(body[0], _ast.FunctionDef) or \
+                body[0].name != '__init__':
+            raise PythonASTWalkerError('udt class %s may only define __init__.' % (classdef.name,))
+        init = body[0]
+        typeinfo, flags = self._extract_vbmeta_from_functiondef(init)
+        selfname = init.args.args[0].id
+        parameters = [a.id for a in init.args.args[1:]]
+
+        fields = {}
+        for stmt in init.body:
+            if _is_docstring(stmt):
+                continue
+            target = stmt.targets[0] if isinstance(stmt, _ast.Assign) and \
+                                        len(stmt.targets) == 1 else None
+            if not (isinstance(target, _ast.Attribute) and isinstance(target.value, _ast.Name) and
+                    target.value.id == selfname and isinstance(stmt.value, _ast.Name) and
+                    stmt.value.id in parameters):
+                raise PythonASTWalkerError('udt class %s may only assign parameters to '
+                                           'fields in __init__.' % (classdef.name,))
+            fields[target.attr] = typeinfo.get(stmt.value.id, vbast.Variant)
+
+        declaration = vbast.TypeDeclaration(classdef.name, sorted(fields.iteritems()))
+        udt = declaration.vbtype()
+        self._in_vbmodule.declarations.append(declaration)
+        self._register_udt(udt)
+        self._classnames.append(classdef.name)
+
+        ctorname = classdef.name + '_ctor_'
+        instance = vbast.SimpleNameExpression('instance_')
+        statements = [vbast.DimDeclaration(instance.name, udt)]
+        for name, vbtype in sorted(fields.iteritems()):
+            field = vbast.MemberAccessExpression(instance, vbast.SimpleNameExpression(name))
+            value = vbast.SimpleNameExpression(name)
+            value.set_vbtype(vbtype)
+            statements.append(self._assignment(field, value))
+        statements.append(vbast.LetStatement(vbast.SimpleNameExpression(ctorname), instance))
+
+        ctor = vbast.Function(
+                ctorname,
+                [vbast.Parameter(vbast.SimpleNameExpression(name),
+                                 typeinfo.get(name, vbast.Variant))
+                 for name in parameters],
+                udt, statements)
+        ctor.locals[instance.name] = udt
+        self._get_class_support_module().code.append(ctor)
+
+    def _check_storable(self, element):
+        vbtype = self._static_type(element)
+        if isinstance(vbtype, vbast.UserDefinedType):
+            raise PythonASTWalkerError('%s instances can only be kept in local lists, which '
+                                       'become arrays.' % (vbtype.name,))
+
     @visitor(_ast.Name)
     def visit_name(self, name):
         if name.id == self._selfname:
             expression = vbast.SimpleNameExpression('Me')
+        elif name.id == 'None':
+            expression = vbast.SimpleNameExpression('Empty')
         else:
             expression = vbast.SimpleNameExpression(name.id)
             if self._in_vbfunction:
                 if name.id in self._in_vbfunction.parameters_names:
                     expression.set_vbtype(self._in_vbfunction.get_parameter_type(name.id))
+                elif self._is_range_data(name):
+                    expression.set_vbtype(vbast.RangeData)
 
         return expression
 
@@ -315,29 +1043,121 @@ class PythonASTWalker(NodeWalker):
 
     @visitor(_ast.Compare)
     def visit_compare(self, compare):
-        return vbast.BinOp(
-                COMPAREOP_MAP[compare.ops[0].__class__],
-                self.walk(compare.left),
-                self.walk(compare.comparators[0]))
+        left = yield compare.left
+        right = yield compare.comparators[0]
+        op = compare.ops[0].__class__
+        if op in (_ast.In, _ast.NotIn):
+            yield result(self._contains(left, right, negate=op is _ast.NotIn))
+        elif op in (_ast.Is, _ast.IsNot):
+            yield result(self._identity(compare.left, left, compare.comparators[0], right,
+                                        negate=op is _ast.IsNot))
+        else:
+            yield result(vbast.BinOp(COMPAREOP_MAP[op], left, right))
+
+    def _identity(self, left_node, left, right_node, right, negate=False):
+        """
+        Returns an expression testing if left is right, where either
+        one may be None.
+
+        """
+        if _is_none(left_node):
+            left, right_node = right, left_node
+        if _is_none(right_node):
+            vbtype = self._static_type(left)
+            if vbtype.is_object_type():
+                expression = vbast.BinOp('Is', left, vbast.SimpleNameExpression('Nothing'))
+            elif vbtype == vbast.Variant:
+                expression = runtime.call('PyIsNone', [left])
+            else:
+                # Numbers, strings and the like are never None.
+                expression = vbast.SimpleNameExpression('False')
+        else:
+            for operand in (left, right):
+                vbtype = self._static_type(operand)
+                if not vbtype.is_object_type() and vbtype != vbast.Variant:
+                    raise PythonASTWalkerError('is can only compare objects, or with None.')
+            expression = vbast.BinOp('Is', left, right)
+        expression.set_vbtype(vbast.Boolean)
+        if negate:
+            expression = vbast.UnaryOp('Not ', expression)
+            expression.set_vbtype(vbast.Boolean)
+        return expression
+
+    def _contains(self, item, container, negate=False):
+        if self._static_type(container) == vbast.Dictionary:
+            expression = vbast.IndexExpression(
+                    vbast.MemberAccessExpression(container, vbast.SimpleNameExpression('Exists')),
+                    [item])
+            expression.set_vbtype(vbast.Boolean)
+        else:
+            expression = runtime.call('PyContains', [container, item])
+        if negate:
+            expression = vbast.UnaryOp('Not ', expression)
+            expression.set_vbtype(vbast.Boolean)
+        return expression
 
     @visitor(_ast.For)
     def visit_for(self, forstmt):
-        # Currently only support interpreting range
-        # with 2 arguments.
-        assert forstmt.iter.func.id == 'range'
-        assert len(forstmt.iter.args) == 2
-        
-        ifrom = forstmt.iter.args[0].n
-        ito = forstmt.iter.args[1].n - 1
+        if forstmt.orelse:
+            raise PythonASTWalkerError('for loops with else blocks are not supported.')
+        return self._loop(forstmt.target, forstmt.iter, self._walk_block(forstmt.body))
+
+    def _loop(self, target, iterable, body):
+        """
+        Returns the statements running body once for each element of
+        the Python iterable, bound to target.
+
+        """
+        if not isinstance(target, _ast.Name):
+            raise PythonASTWalkerError('Loop targets must be simple names.')
+
+        if _is_range_call(iterable):
+            return self._range_loop(target, iterable, body)
+        if isinstance(iterable, _ast.Name) and iterable.id in self._arrays:
+            return self._array_loop(target, iterable.id, body)
+        if self._is_range_data(iterable):
+            raise PythonASTWalkerError('Loop over range(len(%s)) to index RangeData.' %
+                                       (iterable.id,))
+
+        # For Each control variables must be Variants.
+        self._in_vbfunction.locals[target.id] = vbast.Variant
+        return [vbast.ForEachStatement(self.walk(target), self.walk(iterable), body)]
+
+    def _array_loop(self, target, name, body):
+        policy = self._numeric_policy
+        index = self._new_temp(policy.int_type)
+        target = self.walk(target)
+        self._in_vbfunction.locals.setdefault(target.name, vbast.Variant)
+
+        element = vbast.IndexExpression(vbast.SimpleNameExpression(name),
+                                        [vbast.SimpleNameExpression(index)])
+        return [vbast.ForStatement(
+            vbast.SimpleNameExpression(index),
+            [self._assignment(target, element)] + body,
+            policy.literal(0),
+            vbast.BinOp('-', self._array_length(name), policy.literal(1)))]
+
+    def _range_loop(self, target, call, body):
+        policy = self._numeric_policy
+        args = [self.walk(a) for a in call.args]
+        if len(args) == 1:
+            args.insert(0, policy.literal(0))
+
+        # range() excludes its stop value, VBA includes it.
+        if len(args) == 3:
+            sign = _constant_sign(call.args[2])
+            if not sign:
+                raise PythonASTWalkerError('range() step must be a non-zero constant.')
+            step = args[2]
+        else:
+            sign = 1
+            step = None
+        ito = vbast.BinOp('-' if sign > 0 else '+', args[1], policy.literal(1))
 
-        if forstmt.target.id not in self._in_vbfunction.locals:
-            self._in_vbfunction.locals[forstmt.target.id] = vbast.Integer
+        if target.id not in self._in_vbfunction.locals:
+            self._in_vbfunction.locals[target.id] = policy.int_type
 
-        return [vbast.ForStatement(
-            self.walk(forstmt.target),
-            self._walk_block(forstmt.body),
-            vbast.IntegerLiteral(ifrom),
-            vbast.IntegerLiteral(ito))]
+        return [vbast.ForStatement(self.walk(target), body, args[0], ito, step)]
 
     @visitor(_ast.AugAssign)
     def visit_augassign(self, augassign):
@@ -349,18 +1169,51 @@ class PythonASTWalker(NodeWalker):
 
     @visitor(_ast.BoolOp)
     def visit_boolop(self, boolop):
-        expr = vbast.BinOp(
-                BOOLOP_MAP[boolop.op.__class__],
-                self.walk(boolop.values[0]),
-                self.walk(boolop.values[1]))
-        for i in range(2, len(boolop.values)):
-            expr = vbast.BinOp(
-                    BOOLOP_MAP[boolop.op.__class__],
-                    expr, self.walk(boolop.values[i]))
-        return expr
+        op = BOOLOP_MAP[boolop.op.__class__]
+        first = self.walk(boolop.values[0])
+        rest = [self._capture(lambda value=value: self.walk(value))
+                for value in boolop.values[1:]]
+
+        # VBA's And and Or always evaluate both operands, which is
+        # only harmless when the later operands are cheap and can't fail.
+        if all(not preamble and _is_cheap(value)
+               for (preamble, _), value in zip(rest, boolop.values[1:])):
+            expr = first
+            for preamble, value in rest:
+                expr = vbast.BinOp(op, expr, value)
+            return expr
+        return self._short_circuit(op, first, rest)
+
+    def _short_circuit(self, op, first, rest):
+        """
+        Evaluates the operands of a boolean operator into a temporary
+        ahead of the current statement, each one only if the previous
+        ones didn't already decide the result.
+
+        """
+        acc = self._new_temp(vbast.Variant)
+        operands = [first] + [value for preamble, value in rest]
+        nested = []
+        for i in reversed(range(len(rest))):
+            preamble, value = rest[i]
+            body = preamble + [self._assignment(vbast.SimpleNameExpression(acc), value)] + nested
+            # The temporary holds the previous operand, whatever its type.
+            test = vbast.SimpleNameExpression(acc)
+            if not self._is_boolean(operands[i]):
+                test = runtime.call('PyTruth', [test])
+            if op == 'And':
+                nested = [vbast.IfStatement(test, body)]
+            else:
+                nested = [vbast.IfStatement(test, [], orelse=body)]
+        self._preamble.append(self._assignment(vbast.SimpleNameExpression(acc), first))
+        self._preamble.extend(nested)
+        return vbast.SimpleNameExpression(acc)
 
     @visitor(_ast.ListComp)
     def visit_listcomp(self, listcomp):
+        if self._inline_comprehensions:
+            return self._inline_listcomp(listcomp)
+
         assert len(listcomp.generators) == 1, 'List comp conversion only supports a single generator.'
         assert len(listcomp.generators[0].ifs) <= 1
         itervars = { self.walk(listcomp.generators[0].iter) }
@@ -369,40 +1222,55 @@ class PythonASTWalker(NodeWalker):
 
         # Determine if there are any other variables to include as
         # as closure.
+        stored = { n.id for n in ast.walk(listcomp)
+                     if isinstance(n, _ast.Name) and isinstance(n.ctx, _ast.Store) }
         othervars = { self.walk(n) for n in ast.walk(listcomp) 
                         if isinstance(n, _ast.Name) and
                            n.id not in itervarnames and
-                           n.id != target.name }
+                           n.id not in stored and
+                           not self._is_global_name(n.id) }
 
         fname = '%s_listcomp_%i' % (self._in_vbfunction.name, len(self._in_vbfunction.listcomps))
 
-        vbfunctionlocals = {p.name : p.vbtype for p in self._in_vbfunction.parameters}
+        vbfunctionlocals = {p.name.name : p.vbtype for p in self._in_vbfunction.parameters}
         vbfunctionlocals.update(self._in_vbfunction.locals)
 
-        parameters = [vbast.Parameter(n, vbfunctionlocals.get(n.name, vbast.Variant))
-                        for n in othervars | itervars] 
+        # One parameter per distinct name, in a stable order.
+        closure = {}
+        for n in othervars | itervars:
+            closure.setdefault(n.name, n)
+        parameters = [vbast.Parameter(closure[name], vbfunctionlocals.get(name, vbast.Variant))
+                        for name in sorted(closure)]
 
         assert len(itervars) == 1
         itervar = list(itervars)[0]
 
-        compexpr = self.walk(listcomp.elt)
-
         vbfunction = vbast.Function(fname, parameters, vbast.Collection, scope=vbast.PRIVATE)
-        bodystmt = vbast.CallStatement(
-                        vbast.MemberAccessExpression(
-                            vbast.SimpleNameExpression(fname),
-                            vbast.SimpleNameExpression('Add')),
-                        [compexpr])
-
-        if listcomp.generators[0].ifs:
-            bodystmt = vbast.IfStatement(self.walk(listcomp.generators[0].ifs[0]),
-                                         [bodystmt])
-
+        vbfunction.locals[target.name] = vbast.Variant
+
+        # The element and test are evaluated within the helper, along
+        # with anything they need to run first.
+        outer, temp_count = self._in_vbfunction, self._temp_count
+        self._in_vbfunction, self._temp_count = vbfunction, 0
+        try:
+            preamble, compexpr = self._capture(lambda: self.walk(listcomp.elt))
+            bodystmts = preamble + [vbast.CallStatement(
+                            vbast.MemberAccessExpression(
+                                vbast.SimpleNameExpression(fname),
+                                vbast.SimpleNameExpression('Add')),
+                            [compexpr])]
+
+            if listcomp.generators[0].ifs:
+                preamble, test = self._capture(lambda: self.walk(listcomp.generators[0].ifs[0]))
+                bodystmts = preamble + [vbast.IfStatement(test, bodystmts)]
+        finally:
+            self._in_vbfunction, self._temp_count = outer, temp_count
+
+        vbfunction.statements += self._create_dim_statements(sorted(vbfunction.locals.iteritems()))
         vbfunction.statements += [
-                                  vbast.DimDeclaration(target.name, vbast.Variant),
                                   vbast.SetStatement(vbast.SimpleNameExpression(fname),
                                                      vbast.NewExpression(vbast.Collection)),
-                                  vbast.ForEachStatement(target, itervar, [bodystmt])]
+                                  vbast.ForEachStatement(target, itervar, bodystmts)]
         self._in_vbfunction.listcomps.append(vbfunction)
 
         expr =  vbast.IndexExpression(vbast.SimpleNameExpression(vbfunction.name),
@@ -410,8 +1278,273 @@ class PythonASTWalker(NodeWalker):
         expr.set_vbtype(vbast.Collection)
         return expr
 
+    def _is_global_name(self, name):
+        return name in BUILTIN_NAMES or name in self._classnames or \
+               name in self._in_vbmodule.function_namespace
+
+    def _inline_listcomp(self, listcomp):
+        """
+        Expands listcomp into loops filling a new Collection ahead of
+        the current statement, returning the Collection.
+
+        """
+        name = self._new_temp(vbast.Collection)
+        self._preamble.append(vbast.SetStatement(vbast.SimpleNameExpression(name),
+                                                 vbast.NewExpression(vbast.Collection)))
+
+        def add():
+            return [vbast.CallStatement(
+                vbast.MemberAccessExpression(vbast.SimpleNameExpression(name),
+                                             vbast.SimpleNameExpression('Add')),
+                [self.walk(listcomp.elt)])]
+        self._preamble.extend(self._comprehension_loops(listcomp.generators, add))
+
+        expression = vbast.SimpleNameExpression(name)
+        expression.set_vbtype(vbast.Collection)
+        return expression
+
+    def _assign_array_comprehension(self, name, listcomp):
+        policy = self._numeric_policy
+        length = self._array_length(name)
+        self._in_vbfunction.locals[name] = vbast.ArrayType(vbast.Variant)
+        self._in_vbfunction.locals[length.name] = policy.int_type
+
+        # A single generator can't produce more elements than its
+        # source, so when that is known the array never needs to grow.
+        size = self._known_length(listcomp.generators)
+        if size is None:
+            upper = policy.literal(MIN_ARRAY_CAPACITY - 1)
+        else:
+            upper = vbast.BinOp('+', size, policy.literal(MIN_ARRAY_CAPACITY - 1))
+
+        def append():
+            return self._append_to_array(name, self.walk(listcomp.elt), grow=size is None)
+
+        return [vbast.ReDimStatement(vbast.SimpleNameExpression(name), upper),
+                vbast.LetStatement(length, policy.literal(0))] + \
+               self._comprehension_loops(listcomp.generators, append)
+
+    def _known_length(self, generators):
+        if len(generators) != 1:
+            return None
+        iterable = generators[0].iter
+        if isinstance(iterable, _ast.Name):
+            if iterable.id in self._arrays:
+                return self._array_length(iterable.id)
+            return self._length(iterable, self.walk(iterable))
+        if _is_range_call(iterable) and all(isinstance(a, _ast.Num) for a in iterable.args):
+            return self._numeric_policy.literal(len(xrange(*[a.n for a in iterable.args])))
+        return None
+
+    def _comprehension_loops(self, generators, innermost, stop=None):
+        """
+        Returns nested loops and Ifs for the generators of a
+        comprehension, running the statements returned by innermost()
+        for each element. The statements returned by stop(), if given,
+        run after each nested loop, so that they can leave the loop
+        around it too.
+
+        """
+        generator = generators[0]
+        tests = [self._capture(lambda test=test: self.walk(test)) for test in generator.ifs]
+        if len(generators) > 1:
+            body = self._comprehension_loops(generators[1:], innermost, stop)
+        else:
+            preamble, body = self._capture(innermost)
+            body = preamble + body
+
+        # Nested Ifs, as VBA's And doesn't short-circuit.
+        for preamble, test in reversed(tests):
+            body = preamble + [vbast.IfStatement(test, body)]
+        if len(generators) > 1 and stop is not None:
+            body = body + stop()
+        return self._loop(generator.target, generator.iter, body)
+
+    def _capture(self, fcn):
+        """
+        Calls fcn, returning (preamble, value) where preamble holds
+        the statements that must run before value is used.
+
+        """
+        saved = self._preamble
+        self._preamble = []
+        try:
+            value = fcn()
+            return self._preamble, value
+        finally:
+            self._preamble = saved
+
     def _walk_block(self, block):
-        return sum([self.walk(c) for c in block], [])
+        statements = []
+        for c in block:
+            preamble, walked = self._capture(lambda: self.walk(c))
+            statements.extend(preamble)
+            statements.extend(walked)
+        return statements
+
+def _array_candidates(functiondef, inline_comprehensions):
+    """
+    Returns the names of the locals of functiondef that are only ever
+    assigned list literals, or inlined list comprehensions, and are
+    otherwise only indexed, appended to, iterated over or passed to
+    len() or a reduction. These never escape the function, so they
+    can be lowered to arrays.
+
+    """
+    parents = {}
+    rejected = set()
+    for node in ast.walk(functiondef):
+        for child in ast.iter_child_nodes(node):
+            parents[child] = node
+        # Comprehension helper functions take their variables as
+        # parameters.
+        if isinstance(node, _ast.ListComp) and not inline_comprehensions:
+            rejected.update(n.id for n in ast.walk(node) if isinstance(n, _ast.Name))
+
+    assigned = set()
+    for node in ast.walk(functiondef):
+        if not isinstance(node, _ast.Name):
+            continue
+        if not _is_array_use(node, parents, inline_comprehensions):
+            rejected.add(node.id)
+        elif isinstance(node.ctx, _ast.Store):
+            assigned.add(node.id)
+    return assigned - rejected
+
+def _written_ranges(functiondef, ranges):
+    """
+    Returns the names in ranges whose elements functiondef assigns.
+
+    """
+    written = []
+    for node in ast.walk(functiondef):
+        if isinstance(node, _ast.Assign):
+            targets = node.targets
+        elif isinstance(node, _ast.AugAssign):
+            targets = [node.target]
+        else:
+            continue
+        for target in targets:
+            while isinstance(target, _ast.Subscript):
+                target = target.value
+            if isinstance(target, _ast.Name) and target.id in ranges and target.id not in written:
+                written.append(target.id)
+    return [name for name in ranges if name in written]
+
+def _insert_before_exits(statements, inserted):
+    """
+    Inserts a copy of the statements in inserted before every Exit
+    Function or Exit Sub within statements.
+
+    """
+    i = 0
+    while i < len(statements):
+        statement = statements[i]
+        if isinstance(statement, EXIT_STATEMENTS):
+            statements[i:i] = copy.deepcopy(inserted)
+            i += len(inserted)
+        else:
+            for block in vbast.iter_blocks(statement):
+                _insert_before_exits(block, inserted)
+        i += 1
+
+def _udt_lists(functiondef, udts):
+    """
+    Returns the names of the locals of functiondef that are assigned
+    lists of, or appended, instances of the udt classes in udts.
+
+    """
+    instances = set()
+    def is_udt(node):
+        if isinstance(node, _ast.Name):
+            return node.id in instances
+        return isinstance(node, _ast.Call) and getattr(node.func, 'id', None) in udts
+
+    for node in ast.walk(functiondef):
+        if isinstance(node, _ast.Assign) and is_udt(node.value):
+            instances.update(t.id for t in node.targets if isinstance(t, _ast.Name))
+
+    names = set()
+    for node in ast.walk(functiondef):
+        if isinstance(node, _ast.Assign) and isinstance(node.value, _ast.List) and \
+                any(is_udt(e) for e in node.value.elts):
+            names.update(t.id for t in node.targets if isinstance(t, _ast.Name))
+        elif isinstance(node, _ast.Call) and isinstance(node.func, _ast.Attribute) and \
+                node.func.attr == 'append' and isinstance(node.func.value, _ast.Name) and \
+                len(node.args) == 1 and is_udt(node.args[0]):
+            names.add(node.func.value.id)
+    return names
+
+def _is_docstring(node):
+    return isinstance(node, _ast.Expr) and isinstance(node.value, _ast.Str)
+
+def _is_array_use(name, parents, inline_comprehensions):
+    parent = parents.get(name)
+    if isinstance(name.ctx, _ast.Store):
+        if not (isinstance(parent, _ast.Assign) and parent.targets == [name]):
+            return False
+        if isinstance(parent.value, _ast.ListComp) and inline_comprehensions:
+            # The array is filled in place, so it can't be read from
+            # while building it.
+            return not any(isinstance(n, _ast.Name) and n.id == name.id
+                           for n in ast.walk(parent.value))
+        return isinstance(parent.value, _ast.List)
+    if not isinstance(name.ctx, _ast.Load):
+        return False
+    if isinstance(parent, _ast.Subscript):
+        return parent.value is name and isinstance(parent.slice, _ast.Index)
+    if isinstance(parent, _ast.Attribute):
+        call = parents.get(parent)
+        return parent.attr == 'append' and isinstance(call, _ast.Call) and \
+               call.func is parent and len(call.args) == 1 and \
+               isinstance(parents.get(call), _ast.Expr)
+    if isinstance(parent, _ast.Call):
+        if not isinstance(parent.func, _ast.Name) or parent.keywords or \
+                not parent.args or parent.args[0] is not name:
+            return False
+        # len() or a reduction, sum() may also take a start value.
+        return parent.func.id in REDUCTIONS and \
+               len(parent.args) <= (2 if parent.func.id == 'sum' else 1)
+    if isinstance(parent, (_ast.For, _ast.comprehension)):
+        return parent.iter is name
+    return False
+
+# Python nodes that are cheap to evaluate and can't fail.
+CHEAP_NODES = (_ast.Name, _ast.Num, _ast.Str, _ast.Compare, _ast.BinOp, _ast.UnaryOp,
+               _ast.BoolOp, _ast.expr_context, _ast.operator, _ast.unaryop,
+               _ast.cmpop, _ast.boolop)
+
+def _is_none(node):
+    return isinstance(node, _ast.Name) and node.id == 'None'
+
+def _is_cheap(node):
+    for n in ast.walk(node):
+        if not isinstance(n, CHEAP_NODES):
+            return False
+        # Division by anything but a non-zero constant can fail.
+        if isinstance(n, _ast.BinOp) and isinstance(n.op, (_ast.Mod, _ast.Div, _ast.FloorDiv)) and \
+                not (isinstance(n.right, _ast.Num) and n.right.n):
+            return False
+    return True
+
+def _is_range_call(node):
+    return isinstance(node, _ast.Call) and isinstance(node.func, _ast.Name) and \
+           node.func.id in ('range', 'xrange') and 1 <= len(node.args) <= 3 and \
+           not (node.keywords or node.starargs or node.kwargs)
+
+def _constant_sign(node):
+    """
+    Returns the sign of a constant Python number expression, or
+    None if node isn't one.
+
+    """
+    if isinstance(node, _ast.Num):
+        return cmp(node.n, 0)
+    if isinstance(node, _ast.UnaryOp) and isinstance(node.op, _ast.USub):
+        sign = _constant_sign(node.operand)
+        if sign is not None:
+            return -sign
+    return None
 
 def build_ast_from_code(code):
     return compile(code, '<unknown>', 'exec', ast.PyCF_ONLY_AST)
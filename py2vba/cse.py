@@ -0,0 +1,319 @@
+"""
+Common subexpression elimination over a converted vbast module.
+
+Within each block, the statements are scanned in order, tracking the
+pure expressions they evaluate: arithmetic, comparisons and lookups
+into Collections and Dictionaries over the procedure's own locals and
+parameters. When one is evaluated again before anything could have
+changed its value, the earlier evaluation is moved into a temporary
+local, assigned just ahead of the statement that first needed it,
+and both uses read the temporary instead.
+
+An expression stops being available once a statement assigns one of
+its variables, passes one ByRef to a procedure or method, assigns one
+of its members, modifies a Collection or Dictionary it looks up, or,
+if it reads members or looks anything up, calls a procedure or method
+at all. Nested blocks start with whatever is available on entering
+them, less anything a loop changes on later iterations, and whatever
+they might change is unavailable after them.
+
+Runs after type inference, constant folding and the hoisting of member
+access, so that paths hoisted out of loops aren't split up first.
+
+"""
+import vbast
+import hoisting
+
+BOOLEAN_NAMES = ('True', 'False')
+
+OPERATORS = (vbast.BinOp, vbast.UnaryOp)
+LOOPS = (vbast.ForStatement, vbast.ForEachStatement)
+LITERALS = (vbast.IntegerLiteral, vbast.FloatLiteral, vbast.StringLiteral)
+
+def _dependencies(node, variables):
+    """
+    Returns a hoisting._Path describing what node depends on, or None
+    if node isn't a pure expression worth eliminating.
+
+    """
+    if not isinstance(node, OPERATORS) and hoisting.access_path(node) is None:
+        return None
+
+    names = set()
+    members = set()
+    indexed = False
+    pending = [node]
+    while pending:
+        n = pending.pop()
+        if isinstance(n, OPERATORS):
+            pending.extend(vbast.iter_child_nodes(n))
+        elif isinstance(n, LITERALS):
+            continue
+        elif isinstance(n, vbast.SimpleNameExpression) and n.name in BOOLEAN_NAMES:
+            continue
+        else:
+            path = hoisting.access_path(n)
+            if path is None:
+                if not isinstance(n, vbast.SimpleNameExpression):
+                    return None
+                path = hoisting._Path(set([n.name]), set(), False)
+            # Anything but a variable may be a function, e.g. Now.
+            if not path.names <= variables:
+                return None
+            names |= path.names
+            members |= path.members
+            indexed = indexed or path.indexed
+    return hoisting._Path(names, members, indexed)
+
+def _is_worthwhile(node):
+    # A single operation on variables and literals costs about as much
+    # as reading a temporary.
+    if isinstance(node, OPERATORS):
+        return any(not isinstance(n, LITERALS + (vbast.SimpleNameExpression,))
+                   for n in vbast.iter_child_nodes(node))
+    return True
+
+def _temp_type(node, dotted, operand):
+    """
+    Returns the type of the temporary holding node, or None if it
+    can't be held in one.
+
+    """
+    vbtype = node.vbtype()
+    if isinstance(vbtype, vbast.ArrayType):
+        return None
+    if isinstance(node, OPERATORS) or (operand and vbtype == vbast.Variant and not dotted):
+        # Operators besides Is neither give nor take objects.
+        return vbtype
+    return hoisting._hoisted_type(node, dotted)
+
+class _Available(object):
+    """
+    An expression evaluated by an earlier statement of the block.
+
+    """
+    __slots__ = ('node', 'path', 'statement', 'replace', 'dotted', 'operand', 'temp')
+
+    def __init__(self, node, path, statement, replace, dotted, operand):
+        self.node = node
+        self.path = path
+        self.statement = statement
+        self.replace = replace
+        self.dotted = dotted
+        self.operand = operand
+        self.temp = None
+
+class _AvailableSet(object):
+    """
+    The expressions available at a point of a block, by as_code(),
+    indexed by what they depend on so that a statement's effects kill
+    them without scanning every one.
+
+    """
+    def __init__(self):
+        self.by_key = {}
+        # name : keys of the expressions reading it
+        self.by_name = {}
+        # member : keys of the expressions reading it
+        self.by_member = {}
+        # Keys of the expressions looking up elements.
+        self.indexed = set()
+        # Keys of the expressions reading members or looking up
+        # elements, which any call may change.
+        self.reading = set()
+
+    def copy(self):
+        other = _AvailableSet()
+        other.by_key = dict(self.by_key)
+        other.by_name = dict((name, set(keys)) for name, keys in self.by_name.iteritems())
+        other.by_member = dict((member, set(keys)) for member, keys in self.by_member.iteritems())
+        other.indexed = set(self.indexed)
+        other.reading = set(self.reading)
+        return other
+
+    def get(self, key):
+        return self.by_key.get(key)
+
+    def add(self, key, available):
+        self.by_key[key] = available
+        path = available.path
+        for name in path.names:
+            self.by_name.setdefault(name, set()).add(key)
+        for member in path.members:
+            self.by_member.setdefault(member, set()).add(key)
+        if path.indexed:
+            self.indexed.add(key)
+        if path.indexed or path.members:
+            self.reading.add(key)
+
+    def kill(self, effects):
+        """
+        Removes every expression whose value effects may change.
+
+        """
+        killed = set()
+        for name in effects.assigned:
+            killed |= self.by_name.get(name, set())
+        for member in effects.fields:
+            killed |= self.by_member.get(member, set())
+        if effects.modifies_collections:
+            killed |= self.indexed
+        if effects.calls:
+            killed |= self.reading
+        for key in killed:
+            path = self.by_key.pop(key).path
+            for name in path.names:
+                self.by_name[name].discard(key)
+            for member in path.members:
+                self.by_member[member].discard(key)
+            self.indexed.discard(key)
+            self.reading.discard(key)
+
+def _setter(parent, field, index):
+    if index is None:
+        return lambda value: setattr(parent, field, value)
+    def replace(value):
+        getattr(parent, field)[index] = value
+    return replace
+
+def _expression_slots(statement):
+    """
+    Yields (node, parent, field, setter) for each expression statement
+    evaluates itself, leaving out its nested blocks, outermost first.
+
+    """
+    pending = []
+    for field in statement._fields:
+        value = getattr(statement, field)
+        if field in statement._blocks:
+            continue
+        if isinstance(value, vbast.ASTNode):
+            pending.append((value, statement, field, None))
+        elif isinstance(value, list):
+            pending.extend((v, statement, field, i) for i, v in enumerate(value)
+                           if isinstance(v, vbast.ASTNode))
+    pending.reverse()
+    while pending:
+        node, parent, field, index = pending.pop()
+        yield node, parent, field, _setter(parent, field, index)
+        children = []
+        for child_field in node._fields:
+            value = getattr(node, child_field)
+            if isinstance(value, vbast.ASTNode):
+                children.append((value, node, child_field, None))
+            elif isinstance(value, list):
+                children.extend((v, node, child_field, i) for i, v in enumerate(value)
+                                if isinstance(v, vbast.ASTNode))
+        pending.extend(reversed(children))
+
+class _BlockEliminator(object):
+    def __init__(self, procedure, selftype, procedures):
+        self.procedure = procedure
+        self.procedures = procedures
+        self.variables = set(procedure.locals) | set(procedure.parameters_names)
+        if selftype is not None:
+            self.variables.add('Me')
+        # Ahead of each statement, by id, the temporaries it needs.
+        self.before = {}
+
+    def eliminate(self, statements, available=None):
+        """
+        Eliminates the common subexpressions of a block, given the
+        expressions available on entering it.
+
+        """
+        available = available.copy() if available is not None else _AvailableSet()
+        # Temporaries are declared at the top of the procedure as they
+        # are found, so this may be growing.
+        for statement in list(statements):
+            own = [node for node, parent, field, replace in _expression_slots(statement)
+                   if parent is statement]
+            if not hoisting.Effects(own, self.procedures).calls:
+                self._visit(statement, available)
+
+            effects = hoisting.Effects([statement], self.procedures)
+            entering = available
+            if isinstance(statement, LOOPS):
+                # Later iterations see whatever earlier ones changed.
+                entering = available.copy()
+                entering.kill(effects)
+            for block in vbast.iter_blocks(statement):
+                self.eliminate(block, entering)
+
+            available.kill(effects)
+
+        result = []
+        for statement in statements:
+            result.extend(self.before.pop(id(statement), []))
+            result.append(statement)
+        statements[:] = result
+
+    def _visit(self, statement, available):
+        skipped = set()
+        for node, parent, field, replace in _expression_slots(statement):
+            if id(parent) in skipped:
+                # Within an expression already replaced.
+                skipped.add(id(node))
+                continue
+            if parent is statement and field in statement._targets:
+                # Assigned, or only evaluated in part.
+                continue
+            path = _dependencies(node, self.variables)
+            if path is None or not _is_worthwhile(node):
+                continue
+            key = node.as_code()
+            # Is only compares objects, just as only objects have members.
+            is_operand = isinstance(parent, vbast.BinOp) and parent.binop == 'Is'
+            dotted = hoisting._is_dotted(parent, field) or is_operand
+            operand = isinstance(parent, OPERATORS) and not is_operand
+            earlier = available.get(key)
+            if earlier is None:
+                available.add(key, _Available(node, path, statement, replace, dotted, operand))
+                continue
+            temp = self._temp(earlier, dotted, operand)
+            if temp is not None:
+                replace(temp)
+                skipped.add(id(node))
+
+    def _temp(self, earlier, dotted, operand):
+        """
+        Returns a reference to the temporary holding an available
+        expression, creating it on its second use.
+
+        """
+        if earlier.temp is None:
+            vbtype = _temp_type(earlier.node, earlier.dotted or dotted,
+                                earlier.operand or operand)
+            if vbtype is None:
+                return None
+            name = vbast.declare_local(self.procedure, vbtype)
+            if vbtype.is_object_type():
+                initializer = vbast.SetStatement(vbast.SimpleNameExpression(name), earlier.node)
+            else:
+                initializer = vbast.LetStatement(vbast.SimpleNameExpression(name), earlier.node)
+            earlier.temp = (name, vbtype)
+            earlier.replace(self._reference(earlier))
+            self._insert_before(earlier.statement, initializer)
+        return self._reference(earlier)
+
+    def _reference(self, available):
+        name, vbtype = available.temp
+        reference = vbast.SimpleNameExpression(name)
+        reference.set_vbtype(vbtype)
+        return reference
+
+    def _insert_before(self, statement, initializer):
+        # Temporaries other ones are computed from go first.
+        initializers = self.before.setdefault(id(statement), [])
+        position = 0
+        for i, other in enumerate(initializers):
+            if any(isinstance(n, vbast.SimpleNameExpression) and n.name == other.lexpression.name
+                   for n in vbast.walk(initializer.expression)):
+                position = i + 1
+        initializers.insert(position, initializer)
+
+def eliminate_common_subexpressions(module):
+    procedures = set(p.name for p, selftype in vbast.iter_procedures(module))
+    for procedure, selftype in vbast.iter_procedures(module):
+        if isinstance(procedure, (vbast.Function, vbast.Subroutine)):
+            _BlockEliminator(procedure, selftype, procedures).eliminate(procedure.statements)
@@ -1,14 +1,46 @@
+import os
+
 from py2vba import vbast
 from excelbt import vbproject
 
-def add_procedural_module_to_vbproject(project, module):
-    project.add_module(vbproject.Module(module.name, module.as_code()))
-    for support_module in module.support_modules:
-        if isinstance(support_module, vbast.ProceduralModule):
-            project.add_module(vbproject.Module(support_module.name, support_module.as_code()))
-        elif isinstance(support_module, vbast.ClassModule):
-            project.add_module(vbproject.ClassModule(support_module.name, support_module.as_code()))
+PROCEDURAL_MODULE_EXTENSION = '.bas'
+CLASS_MODULE_EXTENSION = '.cls'
 
+def iter_modules(module):
+    """
+    Yields module followed by all of its support modules in the
+    order they should be added to a VBA project.
+
+    """
+    yield module
+    for support_module in module.support_modules:
+        yield support_module
     if module.class_support_module:
-        project.add_module(vbproject.Module(module.class_support_module.name, module.class_support_module.as_code()))
+        yield module.class_support_module
+
+def add_procedural_module_to_vbproject(project, module):
+    for m in iter_modules(module):
+        if isinstance(m, vbast.ClassModule):
+            project.add_module(vbproject.ClassModule(m.name, m.as_code()))
+        else:
+            project.add_module(vbproject.Module(m.name, m.as_code()))
     return project
+
+def module_filename(module):
+    if isinstance(module, vbast.ClassModule):
+        return module.name + CLASS_MODULE_EXTENSION
+    return module.name + PROCEDURAL_MODULE_EXTENSION
+
+def write_procedural_module(directory, module):
+    """
+    Streams module and its support modules into .bas/.cls files
+    within directory. Returns the list of paths written.
+
+    """
+    paths = []
+    for m in iter_modules(module):
+        path = os.path.join(directory, module_filename(m))
+        with open(path, 'w') as f:
+            m.write(f)
+        paths.append(path)
+    return paths
@@ -0,0 +1,274 @@
+"""
+Constant folding over a converted vbast module.
+
+Operators whose operands are all literals are evaluated with VBA
+semantics, e.g. x(0 + 1) becomes x(1), as long as the result fits
+its VBA type. Additions of zero and multiplications by one are dropped
+from numeric expressions, and locals assigned a constant exactly once,
+before any other use, are replaced by that constant.
+
+Runs after type inference, which supplies the expression types that
+decide when an identity is safe to simplify.
+
+"""
+import math
+import operator
+
+from nodewalker import NodeWalker, visitor, result
+import vbast
+import inference
+
+NUMBER_LITERALS = (vbast.IntegerLiteral, vbast.FloatLiteral)
+LITERALS = NUMBER_LITERALS + (vbast.StringLiteral,)
+
+ARITHMETIC = {
+    '+' : operator.add,
+    '-' : operator.sub,
+    '*' : operator.mul,
+}
+
+COMPARISONS = {
+    '=' : operator.eq,
+    '<>' : operator.ne,
+    '<' : operator.lt,
+    '>' : operator.gt,
+    '<=' : operator.le,
+    '>=' : operator.ge,
+}
+
+def _truncated_divmod(a, b):
+    # VBA's \ and Mod round towards zero, Python's // and % towards
+    # negative infinity.
+    quotient = abs(a) // abs(b)
+    if (a < 0) != (b < 0):
+        quotient = -quotient
+    return quotient, a - b * quotient
+
+def _number(value, vbtype):
+    """
+    Returns a literal for value as vbtype, or None if VBA would
+    overflow computing it.
+
+    """
+    if vbtype in vbast.INTEGER_RANGES:
+        low, high = vbast.INTEGER_RANGES[vbtype]
+        if low <= value <= high:
+            return vbast.IntegerLiteral(value, vbtype)
+    elif vbtype == vbast.Double and not (math.isinf(value) or math.isnan(value)):
+        return vbast.FloatLiteral(value)
+    return None
+
+def _boolean(value):
+    name = vbast.SimpleNameExpression('True' if value else 'False')
+    name.set_vbtype(vbast.Boolean)
+    return name
+
+def _type_of(node):
+    vbtype = node.vbtype
+    return vbtype() if callable(vbtype) else vbtype
+
+def _is_number(node, value):
+    return isinstance(node, NUMBER_LITERALS) and node.value == value
+
+def _simplify(binop):
+    """
+    Drops x + 0, x - 0, x * 1 and 1 * x when doing so can't change
+    the type of the result.
+
+    """
+    left, right = binop.left, binop.right
+    if binop.binop == '+' and _is_number(left, 0):
+        left, right = right, left
+    elif binop.binop == '*' and _is_number(left, 1):
+        left, right = right, left
+    elif binop.binop not in ('+', '-', '*'):
+        return binop
+
+    identity = 1 if binop.binop == '*' else 0
+    vbtype = _type_of(left)
+    if _is_number(right, identity) and inference.is_numeric(vbtype) and \
+            inference.join(vbtype, right.vbtype()) == vbtype:
+        return left
+    return binop
+
+def fold_binop(binop):
+    left, right = binop.left, binop.right
+    op = binop.binop
+
+    if isinstance(left, vbast.StringLiteral) and isinstance(right, vbast.StringLiteral):
+        if op in ('+', '&'):
+            return vbast.StringLiteral(left.value + right.value)
+        if op in ('=', '<>'):
+            return _boolean(COMPARISONS[op](left.value, right.value))
+        return binop
+
+    if not (isinstance(left, NUMBER_LITERALS) and isinstance(right, NUMBER_LITERALS)):
+        return _simplify(binop)
+
+    vbtype = inference.join(left.vbtype(), right.vbtype())
+    folded = None
+    if op in COMPARISONS:
+        folded = _boolean(COMPARISONS[op](left.value, right.value))
+    elif op in ARITHMETIC:
+        folded = _number(ARITHMETIC[op](left.value, right.value), vbtype)
+    elif op in ('\\', 'Mod') and right.value and \
+            isinstance(left, vbast.IntegerLiteral) and isinstance(right, vbast.IntegerLiteral):
+        quotient, remainder = _truncated_divmod(left.value, right.value)
+        vbtype = vbast.Integer if vbtype == vbast.Integer else vbast.Long
+        folded = _number(quotient if op == '\\' else remainder, vbtype)
+    return folded or binop
+
+def fold_unaryop(unaryop):
+    operand = unaryop.operand
+    if unaryop.op == '-' and isinstance(operand, NUMBER_LITERALS):
+        return _number(-operand.value, operand.vbtype()) or unaryop
+    return unaryop
+
+class ExpressionFolder(NodeWalker):
+    """
+    Folds an expression tree bottom up, returning the folded
+    expression. Nodes are updated in place where possible.
+
+    constants maps local variable names to the literals they hold.
+
+    """
+    def __init__(self, constants):
+        super(ExpressionFolder, self).__init__(iterative=True)
+        self.constants = constants
+
+    @visitor(vbast.ASTNode)
+    def visit_node(self, node):
+        return node
+
+    @visitor(vbast.SimpleNameExpression)
+    def visit_name(self, name):
+        return self.constants.get(name.name, name)
+
+    @visitor(vbast.BinOp)
+    def visit_binop(self, binop):
+        binop.left = yield binop.left
+        binop.right = yield binop.right
+        yield result(fold_binop(binop))
+
+    @visitor(vbast.UnaryOp)
+    def visit_unaryop(self, unaryop):
+        unaryop.operand = yield unaryop.operand
+        yield result(fold_unaryop(unaryop))
+
+    @visitor(vbast.IndexExpression)
+    def visit_index(self, index):
+        # A name being called or indexed is never a constant.
+        if not isinstance(index.lexpression, vbast.SimpleNameExpression):
+            index.lexpression = yield index.lexpression
+        args = []
+        for arg in index.args:
+            args.append((yield arg))
+        index.args = args
+        yield result(index)
+
+    @visitor(vbast.MemberAccessExpression)
+    def visit_member_access(self, access):
+        access.lexpression = yield access.lexpression
+        yield result(access)
+
+    @visitor(vbast.ListLiteral)
+    def visit_list(self, literal):
+        elements = []
+        for element in literal.elements:
+            elements.append((yield element))
+        literal.elements = elements
+        yield result(literal)
+
+    @visitor(vbast.DictLiteral)
+    def visit_dict(self, literal):
+        items = []
+        for k, v in literal.items:
+            items.append(((yield k), (yield v)))
+        literal.items = items
+        yield result(literal)
+
+def _fold_statement(statement, folder):
+    for field in statement._fields:
+        if field in statement._blocks:
+            continue
+        value = getattr(statement, field)
+        if isinstance(value, vbast.SimpleNameExpression) and \
+                (field in statement._targets or isinstance(statement, vbast.CallStatement)):
+            # Assigned or called names stay as they are.
+            continue
+        if isinstance(value, vbast.ASTNode):
+            setattr(statement, field, folder.walk(value))
+        elif isinstance(value, list):
+            setattr(statement, field, [folder.walk(v) for v in value])
+    for block in vbast.iter_blocks(statement):
+        _fold_block(block, folder)
+
+def _fold_block(statements, folder):
+    for statement in statements:
+        _fold_statement(statement, folder)
+
+def _assigned_target(statement):
+    for field in statement._targets:
+        target = getattr(statement, field)
+        if isinstance(target, vbast.SimpleNameExpression):
+            return target.name
+    return None
+
+def _candidates(procedure):
+    """
+    Returns the locals of procedure that are assigned exactly once
+    and never passed by reference to anything that could change them.
+
+    """
+    # List comprehension helpers never assign to their parameters.
+    safe_callees = set(listcomp.name for listcomp in procedure.listcomps)
+    assignments = {}
+    passed = set()
+    for statement in procedure.statements:
+        for node in vbast.walk(statement):
+            name = _assigned_target(node)
+            if name:
+                assignments[name] = assignments.get(name, 0) + 1
+            if isinstance(node, vbast.IndexExpression):
+                callee, args = node.lexpression, node.args
+            elif isinstance(node, vbast.CallStatement):
+                callee, args = node.lexpression, node.parameters
+            else:
+                continue
+            if getattr(callee, 'name', None) in safe_callees:
+                continue
+            passed.update(a.name for a in args if isinstance(a, vbast.SimpleNameExpression))
+    return set(name for name in procedure.locals
+               if assignments.get(name) == 1 and name not in passed)
+
+def fold_procedure(procedure):
+    """
+    Folds the statements of procedure, propagating constant locals
+    and removing their now unused assignments and Dims.
+
+    """
+    candidates = _candidates(procedure)
+    folder = ExpressionFolder({})
+    referenced = set()
+    propagated = []
+    for statement in procedure.statements:
+        _fold_statement(statement, folder)
+        name = _assigned_target(statement)
+        if isinstance(statement, vbast.LetStatement) and name in candidates and \
+                name not in referenced and isinstance(statement.expression, LITERALS):
+            folder.constants[name] = statement.expression
+            propagated.append(statement)
+        referenced.update(node.name for node in vbast.walk(statement)
+                          if isinstance(node, vbast.SimpleNameExpression))
+
+    if propagated:
+        propagated = set(map(id, propagated))
+        procedure.statements = [s for s in procedure.statements if id(s) not in propagated and
+                                not (isinstance(s, vbast.DimDeclaration) and s.name in folder.constants)]
+        for name in folder.constants:
+            del procedure.locals[name]
+
+def fold_constants(module):
+    for procedure, selftype in vbast.iter_procedures(module):
+        if isinstance(procedure, (vbast.Function, vbast.Subroutine)):
+            fold_procedure(procedure)
@@ -0,0 +1,350 @@
+"""
+Hoisting of repeated member access chains over a converted vbast
+module.
+
+Every . on an Object or Variant is a late-bound call, so a chain such
+as c.employees(2).name costs one call per link each time it runs. An
+access path is a chain of member accesses, and of indexing into
+Collections and Dictionaries by constants or variables, on a local
+variable, parameter or Me.
+
+Paths used within a loop that nothing in the loop can change are
+cached in a typed local on the first iteration, so loops that never
+run never evaluate them. Consecutive statements outside of that
+which all access members of the same path become a With block, which
+evaluates the path once.
+
+A path can change when a variable it uses is assigned, when one of
+its members is assigned, when a Collection or Dictionary is modified
+if it indexes one or reads its members, and whenever a procedure of
+the module or a method is called.
+
+Runs after type inference, which tells Collections and Dictionaries
+apart from calls, and supplies the types of the locals.
+
+"""
+import copy
+
+import vbast
+
+INDEXABLE = (vbast.Collection, vbast.Dictionary)
+INDEX_LITERALS = (vbast.IntegerLiteral, vbast.StringLiteral)
+
+class _Path(object):
+    """
+    The variables and members an access path depends on.
+
+    """
+    __slots__ = ('names', 'members', 'indexed')
+
+    def __init__(self, names, members, indexed):
+        self.names = names
+        self.members = members
+        self.indexed = indexed
+
+def _is_indexable(expression):
+    return expression.vbtype() in INDEXABLE
+
+def access_path(node):
+    """
+    Returns a _Path if node is an access path of at least one link,
+    else None.
+
+    """
+    names = set()
+    members = set()
+    indexed = False
+    if not isinstance(node, (vbast.MemberAccessExpression, vbast.IndexExpression)):
+        return None
+    while True:
+        if isinstance(node, vbast.MemberAccessExpression):
+            members.add(node.right.name)
+            # e.g. the Count of a Collection.
+            indexed = indexed or _is_indexable(node.lexpression)
+            node = node.lexpression
+        elif isinstance(node, vbast.IndexExpression):
+            if len(node.args) != 1 or not _is_indexable(node.lexpression):
+                return None
+            arg = node.args[0]
+            if isinstance(arg, vbast.SimpleNameExpression):
+                names.add(arg.name)
+            elif not isinstance(arg, INDEX_LITERALS):
+                return None
+            indexed = True
+            node = node.lexpression
+        elif isinstance(node, vbast.SimpleNameExpression):
+            names.add(node.name)
+            return _Path(names, members, indexed)
+        else:
+            return None
+
+class Effects(object):
+    """
+    Everything a list of statements may change that an access path
+    could depend on.
+
+    """
+    def __init__(self, statements, procedures):
+        self.assigned = set()
+        self.fields = set()
+        self.modifies_collections = False
+        self.calls = False
+        for statement in statements:
+            for node in vbast.walk(statement):
+                self._add(node, procedures)
+
+    def _add(self, node, procedures):
+        for field in node._targets:
+            target = getattr(node, field)
+            if isinstance(target, vbast.SimpleNameExpression):
+                self.assigned.add(target.name)
+            elif isinstance(target, vbast.MemberAccessExpression):
+                self.fields.add(target.right.name)
+            else:
+                # An element of an array, Collection or Dictionary.
+                self.modifies_collections = True
+
+        if isinstance(node, vbast.IndexExpression):
+            callee, args = node.lexpression, node.args
+        elif isinstance(node, vbast.CallStatement):
+            callee, args = node.lexpression, node.parameters
+        else:
+            return
+        if isinstance(callee, vbast.SimpleNameExpression):
+            calls = callee.name in procedures
+        elif isinstance(callee, vbast.MemberAccessExpression):
+            # Indexing, or calling a method of, a Collection or
+            # Dictionary can't change anything else.
+            if _is_indexable(callee.lexpression):
+                calls = False
+                if isinstance(node, vbast.CallStatement):
+                    self.modifies_collections = True
+            else:
+                calls = not (isinstance(node, vbast.IndexExpression) and _is_indexable(callee))
+        else:
+            calls = True
+        if calls:
+            self.calls = True
+            # Variables are passed ByRef.
+            self.assigned.update(arg.name for arg in args
+                                 if isinstance(arg, vbast.SimpleNameExpression))
+
+    def changes(self, path):
+        return self.calls or bool(path.names & self.assigned) or \
+               bool(path.members & self.fields) or \
+               (path.indexed and self.modifies_collections)
+
+def _is_dotted(parent, field):
+    return isinstance(parent, vbast.MemberAccessExpression) and field == 'lexpression'
+
+def _replace_within(statements, replace):
+    """
+    Walks the expressions within statements top down, replacing
+    each node for which replace(node, parent, field) returns a new
+    node, without descending into the replacements.
+
+    """
+    pending = list(statements)
+    while pending:
+        parent = pending.pop()
+        for field in parent._fields:
+            value = getattr(parent, field)
+            if isinstance(value, vbast.ASTNode):
+                replacement = replace(value, parent, field)
+                if replacement is None:
+                    pending.append(value)
+                else:
+                    setattr(parent, field, replacement)
+            elif isinstance(value, list):
+                items = []
+                for item in value:
+                    if isinstance(item, vbast.ASTNode):
+                        replacement = replace(item, parent, field)
+                        if replacement is None:
+                            pending.append(item)
+                        else:
+                            item = replacement
+                    else:
+                        pending.extend(item)
+                    items.append(item)
+                setattr(parent, field, items)
+
+def _hoisted_type(node, dotted):
+    """
+    Returns the type of the local caching node, or None if it can't
+    be cached.
+
+    """
+    vbtype = node.vbtype()
+    if isinstance(vbtype, (vbast.ArrayType, vbast.UserDefinedType)):
+        # Copying a user-defined Type costs more than reading it.
+        return None
+    if vbtype.is_object_type():
+        return vbtype
+    if dotted:
+        # Anything with members is an object.
+        return vbast.Object
+    if vbtype == vbast.Variant:
+        return None
+    return vbtype
+
+class _Hoister(object):
+    def __init__(self, procedure, procedures):
+        self.procedure = procedure
+        self.procedures = procedures
+        # (loop, name of the flag telling if its cache is filled)
+        self.flags = []
+
+    def hoist_block(self, statements):
+        for statement in statements:
+            if isinstance(statement, (vbast.ForStatement, vbast.ForEachStatement)):
+                self.hoist_loop(statement)
+            for block in vbast.iter_blocks(statement):
+                self.hoist_block(block)
+        statements[:] = self.with_blocks(statements)
+
+    def hoist_loop(self, loop):
+        effects = Effects([loop], self.procedures)
+        if effects.calls:
+            return
+
+        # Paths are only cached if each iteration evaluates them
+        # anyway, before anything that could leave the loop.
+        evaluated = set()
+        for statement in loop.body:
+            if not isinstance(statement, SIMPLE_STATEMENTS):
+                break
+            evaluated.update(node.as_code() for node in vbast.walk(statement)
+                             if access_path(node) is not None)
+
+        occurrences = {}
+        def find(node, parent, field):
+            path = access_path(node)
+            if path is None or field in parent._targets or effects.changes(path):
+                return None
+            key = node.as_code()
+            if key not in evaluated or _hoisted_type(node, _is_dotted(parent, field)) is None:
+                return None
+            occurrences.setdefault(key, []).append((node, parent, field))
+            # Parts of a cached path needn't be cached themselves.
+            return node
+        _replace_within(loop.body, find)
+
+        cached = {}
+        def replace(node, parent, field):
+            key = node.as_code() if access_path(node) is not None else None
+            if key not in cached or field in parent._targets:
+                return None
+            name, vbtype = cached[key]
+            local = vbast.SimpleNameExpression(name)
+            local.set_vbtype(vbtype)
+            return local
+
+        # Shorter paths first, so that longer ones can start from them.
+        initializers = []
+        for key in sorted(occurrences, key=lambda k: (len(k), k)):
+            node = copy.deepcopy(occurrences[key][0][0])
+            dotted = any(_is_dotted(parent, field) for n, parent, field in occurrences[key])
+            vbtype = _hoisted_type(node, dotted)
+            if vbtype is None:
+                continue
+            name = vbast.declare_local(self.procedure, vbtype)
+            if vbtype.is_object_type():
+                initializer = vbast.SetStatement(vbast.SimpleNameExpression(name), node)
+            else:
+                initializer = vbast.LetStatement(vbast.SimpleNameExpression(name), node)
+            _replace_within([initializer], replace)
+            initializers.append(initializer)
+            cached[key] = (name, vbtype)
+        _replace_within(loop.body, replace)
+
+        if initializers:
+            # Filled on the first iteration, as the loop may not run.
+            flag = vbast.declare_local(self.procedure, vbast.Boolean)
+            test = vbast.UnaryOp('Not ', vbast.SimpleNameExpression(flag))
+            test.set_vbtype(vbast.Boolean)
+            loop.body.insert(0, vbast.IfStatement(test, initializers + [
+                vbast.LetStatement(vbast.SimpleNameExpression(flag),
+                                   vbast.SimpleNameExpression('True'))]))
+            self.flags.append((loop, flag))
+
+    def with_blocks(self, statements):
+        """
+        Returns statements with runs of simple statements accessing
+        members of the same path grouped into With blocks.
+
+        """
+        grouped = []
+        i = 0
+        while i < len(statements):
+            end, node = self._longest_run(statements, i)
+            if end - i < 2:
+                grouped.append(statements[i])
+                i += 1
+                continue
+
+            key = node.as_code()
+            def replace(n, parent, field):
+                if _is_dotted(parent, field) and n.as_code() == key:
+                    return vbast.WithObjectExpression()
+                return None
+            body = statements[i:end]
+            _replace_within(body, replace)
+            grouped.append(vbast.WithStatement(node, body))
+            i = end
+        return grouped
+
+    def _longest_run(self, statements, start):
+        best = (start, None)
+        for node, path in _dotted_paths(statements[start]):
+            key = node.as_code()
+            end = start + 1
+            while end < len(statements) and \
+                    not Effects([statements[end - 1]], self.procedures).changes(path) and \
+                    any(n.as_code() == key for n, p in _dotted_paths(statements[end])):
+                end += 1
+            if end > best[0] or (end == best[0] and len(key) > len(best[1].as_code())):
+                best = (end, node)
+        return best
+
+SIMPLE_STATEMENTS = (vbast.LetStatement, vbast.SetStatement, vbast.CallStatement)
+
+def _dotted_paths(statement):
+    """
+    Yields (node, _Path) for every access path within a simple
+    statement that has members accessed on it.
+
+    """
+    if not isinstance(statement, SIMPLE_STATEMENTS):
+        return
+    for node in vbast.walk(statement):
+        if isinstance(node, vbast.MemberAccessExpression):
+            path = access_path(node.lexpression)
+            if path is not None:
+                yield node.lexpression, path
+
+def hoist_procedure(procedure, procedures):
+    hoister = _Hoister(procedure, procedures)
+    hoister.hoist_block(procedure.statements)
+    # Each flag is cleared just before its loop, so that nested
+    # loops fill their cache afresh each time they run.
+    for loop, flag in hoister.flags:
+        _insert_before(procedure.statements, loop,
+                       vbast.LetStatement(vbast.SimpleNameExpression(flag),
+                                          vbast.SimpleNameExpression('False')))
+
+def _insert_before(statements, target, statement):
+    for i, s in enumerate(statements):
+        if s is target:
+            statements.insert(i, statement)
+            return True
+        for block in vbast.iter_blocks(s):
+            if _insert_before(block, target, statement):
+                return True
+    return False
+
+def hoist_member_access(module):
+    procedures = set(p.name for p, selftype in vbast.iter_procedures(module))
+    for procedure, selftype in vbast.iter_procedures(module):
+        if isinstance(procedure, (vbast.Function, vbast.Subroutine)):
+            hoist_procedure(procedure, procedures)
@@ -0,0 +1,378 @@
+"""
+Local type inference over a converted vbast module.
+
+Types flow from literals, annotated parameters, class constructors,
+class fields and function return types through assignments, operators
+and calls. Each local variable gets the join of the types of every
+value assigned to it, and each function without an annotated return
+type gets the join of the values it returns. Anything that can't be
+pinned to a single concrete type stays a Variant.
+
+"""
+from nodewalker import NodeWalker, visitor, result
+import vbast
+
+# Numeric types ordered by width. Joining two numeric types gives
+# the wider one.
+NUMERIC_TYPES = [vbast.Integer, vbast.Long, vbast.Currency, vbast.Double]
+
+ARITHMETIC_OPS = ('+', '-', '*')
+INTEGER_OPS = ('Mod', '\\')
+COMPARISON_OPS = ('=', '<>', '<', '>', '<=', '>=', 'Is', 'Like')
+LOGICAL_OPS = ('And', 'Or', 'Xor')
+
+BOOLEAN_NAMES = ('True', 'False')
+
+# Bound on whole-module passes, return types normally settle in two
+# or three.
+MAX_ITERATIONS = 20
+
+def is_numeric(vbtype):
+    return vbtype in NUMERIC_TYPES
+
+def join(a, b):
+    """
+    Least upper bound of two types, where None means no information
+    yet and Variant means conflicting information.
+
+    """
+    if a is None:
+        return b
+    if b is None or a == b:
+        return a
+    if is_numeric(a) and is_numeric(b):
+        return max(a, b, key=NUMERIC_TYPES.index)
+    return vbast.Variant
+
+def _is_concrete(vbtype):
+    return vbtype is not None and vbtype != vbast.Variant
+
+class _ModuleTypes(object):
+    """
+    Module wide type information: class fields and methods, and
+    the (possibly still being inferred) return type of every function.
+
+    """
+    def __init__(self, module):
+        self.functions = dict(module.function_namespace)
+        self.classes = {}
+        self.methods = {}
+        for support_module in module.support_modules:
+            if isinstance(support_module, vbast.ClassModule):
+                self.classes[support_module.name] = dict(
+                    (d.name, d.vbtype) for d in support_module.declarations
+                    if isinstance(d, vbast.PublicVariableDeclaration))
+                self.methods[support_module.name] = support_module.method_namespace
+        for declaration in module.declarations:
+            if isinstance(declaration, vbast.TypeDeclaration):
+                self.classes[declaration.name] = dict(declaration.fields)
+        if module.class_support_module:
+            for f in module.class_support_module.code:
+                self.functions.setdefault(f.name, f)
+
+        # Return types being inferred start out unknown.
+        self.rettypes = {}
+        for f in self.functions.itervalues():
+            self.rettypes[f.name] = None if _infers_rettype(f) else getattr(f, 'rettype', vbast.Variant)
+
+def _infers_rettype(function):
+    return isinstance(function, vbast.Function) and function.rettype == vbast.Variant
+
+class ExpressionTyper(NodeWalker):
+    """
+    Computes the type of a vbast expression given the types of the
+    variables in scope. Returns None when the type depends on
+    something that hasn't been inferred yet.
+
+    The type of every subexpression visited is remembered, so typing
+    each node of a tree in turn is linear in its size.
+
+    """
+    def __init__(self, moduletypes, env, selftype=None):
+        super(ExpressionTyper, self).__init__(iterative=True)
+        self._moduletypes = moduletypes
+        self._env = env
+        self._selftype = selftype
+        self._types = {}
+
+    def type_of(self, expression):
+        try:
+            return self._types[id(expression)]
+        except KeyError:
+            return self.walk(expression)
+
+    def _typed(self, node, vbtype):
+        self._types[id(node)] = vbtype
+        return result(vbtype)
+
+    @visitor(vbast.ASTNode)
+    def visit_node(self, node):
+        vbtype = getattr(node, 'vbtype', None)
+        if callable(vbtype):
+            return vbtype()
+        return vbast.Variant
+
+    @visitor(vbast.NewExpression)
+    def visit_new(self, new):
+        return new.vbtype
+
+    @visitor(vbast.SimpleNameExpression)
+    def visit_name(self, name):
+        if name.name in self._env:
+            return self._env[name.name]
+        if name.name == 'Me' and self._selftype:
+            return self._selftype
+        if name.name in BOOLEAN_NAMES:
+            return vbast.Boolean
+        return name.vbtype()
+
+    @visitor(vbast.BinOp)
+    def visit_binop(self, binop):
+        left = yield binop.left
+        right = yield binop.right
+        op = binop.binop
+        if op in COMPARISON_OPS:
+            vbtype = vbast.Boolean
+        elif left is None or right is None:
+            vbtype = None
+        elif op in LOGICAL_OPS and left == right == vbast.Boolean:
+            vbtype = vbast.Boolean
+        elif op in LOGICAL_OPS + ARITHMETIC_OPS and is_numeric(left) and is_numeric(right):
+            vbtype = join(left, right)
+        elif op == '+' and left == right == vbast.String:
+            vbtype = vbast.String
+        elif op in INTEGER_OPS and is_numeric(left) and is_numeric(right):
+            # Mod and \ round their operands to whole numbers.
+            vbtype = vbast.Integer if left == right == vbast.Integer else vbast.Long
+        else:
+            vbtype = vbast.Variant
+        yield self._typed(binop, vbtype)
+
+    @visitor(vbast.UnaryOp)
+    def visit_unaryop(self, unaryop):
+        operand = yield unaryop.operand
+        if operand is None or is_numeric(operand) or operand == vbast.Boolean:
+            yield self._typed(unaryop, operand)
+        else:
+            yield self._typed(unaryop, vbast.Variant)
+
+    @visitor(vbast.IndexExpression)
+    def visit_index(self, index):
+        vbtype = index.vbtype()
+        target = index.lexpression
+        if not _is_concrete(vbtype):
+            if isinstance(target, vbast.SimpleNameExpression):
+                # A call, unless the name is a variable being indexed.
+                if target.name in self._env:
+                    arraytype = self._env[target.name]
+                    if arraytype is None:
+                        vbtype = None
+                    elif isinstance(arraytype, vbast.ArrayType):
+                        vbtype = arraytype.element
+                elif target.name in self._moduletypes.rettypes:
+                    vbtype = self._moduletypes.rettypes[target.name]
+            elif isinstance(target, vbast.MemberAccessExpression):
+                owner = yield target.lexpression
+                method = self._lookup_method(owner, target)
+                if owner is None:
+                    vbtype = None
+                elif method:
+                    vbtype = method.rettype
+        yield self._typed(index, vbtype)
+
+    @visitor(vbast.MemberAccessExpression)
+    def visit_member_access(self, access):
+        owner = yield access.lexpression
+        fields = self._moduletypes.classes.get(getattr(owner, 'name', None), {})
+        method = self._lookup_method(owner, access)
+        if _is_concrete(access.vbtype()):
+            vbtype = access.vbtype()
+        elif owner is None:
+            vbtype = None
+        elif access.right.name in fields:
+            vbtype = fields[access.right.name]
+        elif method:
+            vbtype = method.rettype
+        else:
+            vbtype = vbast.Variant
+        yield self._typed(access, vbtype)
+
+    def _lookup_method(self, owner, access):
+        methods = self._moduletypes.methods.get(getattr(owner, 'name', None), {})
+        return methods.get(access.right.name)
+
+def _walk_body(procedure):
+    """
+    Yields every node within the statements of procedure, but not
+    those of its list comprehension helpers.
+
+    """
+    for statement in procedure.statements:
+        for node in vbast.walk(statement):
+            yield node
+
+def _assignments(function):
+    """
+    Yields (name, expression) for every assignment to a simple
+    name within function.
+
+    """
+    for node in _walk_body(function):
+        if isinstance(node, (vbast.LetStatement, vbast.SetStatement)):
+            if isinstance(node.lexpression, vbast.SimpleNameExpression):
+                yield node.lexpression.name, node.expression
+        elif isinstance(node, vbast.ForStatement):
+            yield node.target.name, node.ifrom
+            yield node.target.name, node.ito
+            if node.step is not None:
+                yield node.target.name, node.step
+
+def _element_assignments(function):
+    """
+    Yields (name, expression) for every assignment to an element
+    of a variable within function.
+
+    """
+    for node in _walk_body(function):
+        if isinstance(node, (vbast.LetStatement, vbast.SetStatement)):
+            target = node.lexpression
+            if isinstance(target, vbast.IndexExpression) and \
+                    isinstance(target.lexpression, vbast.SimpleNameExpression):
+                yield target.lexpression.name, node.expression
+
+def _foreach_targets(function):
+    return set(node.target.name for node in _walk_body(function)
+               if isinstance(node, vbast.ForEachStatement))
+
+class _FunctionInference(object):
+    def __init__(self, function, moduletypes, selftype):
+        self.function = function
+        self.moduletypes = moduletypes
+        self.selftype = selftype
+        self.params = dict((p.name.name, p.vbtype) for p in function.parameters)
+        # For Each control variables must remain Variants.
+        self.pinned = _foreach_targets(function)
+        self.assignments = list(_assignments(function))
+        # User-defined Types can't hold anything else, so they stay as
+        # declared.
+        self.locals = dict((name, vbtype if isinstance(vbtype, vbast.UserDefinedType) else None)
+                           for name, vbtype in function.locals.iteritems())
+        # Arrays are tracked by the type of their elements.
+        self.arrays = set(name for name, vbtype in function.locals.iteritems()
+                          if isinstance(vbtype, vbast.ArrayType))
+        self.assignments += [(name, expression) for name, expression
+                             in _element_assignments(function) if name in self.arrays]
+
+    def environment(self):
+        env = dict(self.params)
+        for name, vbtype in self.locals.iteritems():
+            if name in self.pinned:
+                vbtype = vbast.Variant
+            elif name in self.arrays and vbtype is not None:
+                vbtype = vbast.ArrayType(vbtype)
+            env[name] = vbtype
+        return env
+
+    def typer(self):
+        return ExpressionTyper(self.moduletypes, self.environment(), self.selftype)
+
+    def infer(self):
+        """
+        Refines local types until they stop changing, then returns
+        the joined type of every value returned.
+
+        """
+        changed = True
+        while changed:
+            changed = False
+            typer = self.typer()
+            for name, expression in self.assignments:
+                if name not in self.locals:
+                    continue
+                joined = join(self.locals[name], typer.type_of(expression))
+                if joined != self.locals[name]:
+                    self.locals[name] = joined
+                    changed = True
+
+        typer = self.typer()
+        rettype = None
+        for name, expression in self.assignments:
+            if name == self.function.name:
+                rettype = join(rettype, typer.type_of(expression))
+        return rettype
+
+    def apply(self):
+        function = self.function
+        env = self.environment()
+        for name in function.locals:
+            vbtype = self.locals[name] if name in self.arrays else env[name]
+            vbtype = vbtype if _is_concrete(vbtype) else vbast.Variant
+            if name in self.arrays:
+                vbtype = vbast.ArrayType(vbtype)
+            function.locals[name] = vbtype
+
+        for statement in function.statements:
+            if isinstance(statement, vbast.DimDeclaration) and statement.name in function.locals:
+                statement.vbtype = function.locals[statement.name]
+
+        typer = self.typer()
+        _retype_block(function.statements, typer)
+        for node in _walk_body(function):
+            if isinstance(node, vbast.Expression) and not isinstance(node, vbast.NewExpression):
+                vbtype = typer.type_of(node)
+                if _is_concrete(vbtype):
+                    node.set_vbtype(vbtype)
+
+def _retype_block(statements, typer):
+    """
+    Switches assignments between Let and Set to match the inferred
+    type of the value assigned.
+
+    """
+    for i, statement in enumerate(statements):
+        if isinstance(statement, (vbast.LetStatement, vbast.SetStatement)):
+            vbtype = typer.type_of(statement.expression)
+            if not _is_concrete(vbtype):
+                continue
+            if vbtype.is_object_type():
+                statement_type = vbast.SetStatement
+            else:
+                statement_type = vbast.LetStatement
+            if not isinstance(statement, statement_type):
+                statements[i] = statement_type(statement.lexpression, statement.expression)
+        for block in vbast.iter_blocks(statement):
+            _retype_block(block, typer)
+
+def infer_types(module):
+    """
+    Infers types for the locals and return types of every function
+    in module, updating Dim statements, signatures, Let/Set choices
+    and expression types in place.
+
+    """
+    moduletypes = _ModuleTypes(module)
+    inferences = [_FunctionInference(p, moduletypes, selftype)
+                  for p, selftype in vbast.iter_procedures(module)
+                  if isinstance(p, (vbast.Function, vbast.Subroutine))]
+
+    for _ in range(MAX_ITERATIONS):
+        changed = False
+        for inference in inferences:
+            function = inference.function
+            rettype = inference.infer()
+            if moduletypes.functions.get(function.name) is function and _infers_rettype(function):
+                joined = join(moduletypes.rettypes[function.name], rettype)
+                if joined != moduletypes.rettypes[function.name]:
+                    moduletypes.rettypes[function.name] = joined
+                    changed = True
+        if not changed:
+            break
+
+    for inference in inferences:
+        function = inference.function
+        if moduletypes.functions.get(function.name) is function and _infers_rettype(function):
+            rettype = moduletypes.rettypes[function.name]
+            if _is_concrete(rettype):
+                function.rettype = rettype
+    for inference in inferences:
+        inference.apply()
@@ -0,0 +1,248 @@
+"""
+Inlining of small pure functions over a converted vbast module.
+
+A module level function qualifies when its body is a single
+assignment to its return value, optionally followed by the Exit
+Function that visit_return emits, of an expression that only uses
+literals, operators, its parameters and calls to other qualifying
+functions, and is no bigger than MAX_INLINE_SIZE nodes. Recursive
+functions never qualify.
+
+Calls to qualifying functions are replaced by a copy of the
+function's expression with the arguments substituted for the
+parameters. Arguments and results are converted to the declared
+parameter and return types, as passing and returning them would.
+Arguments with side effects are only substituted when the parameter
+is used exactly once and no other argument has side effects, so
+every call still happens exactly once and in the same order.
+
+Runs after type inference, which supplies the argument types.
+
+"""
+import copy
+
+from nodewalker import NodeWalker, visitor, result
+import vbast
+
+# Largest function expression inlined, in vbast nodes.
+MAX_INLINE_SIZE = 16
+
+CONVERSIONS = {
+    vbast.Integer : 'CInt',
+    vbast.Long : 'CLng',
+    vbast.Currency : 'CCur',
+    vbast.Double : 'CDbl',
+    vbast.String : 'CStr',
+    vbast.Boolean : 'CBool',
+}
+
+PURE_NODES = (vbast.BinOp, vbast.UnaryOp, vbast.IntegerLiteral, vbast.FloatLiteral,
+              vbast.StringLiteral, vbast.SimpleNameExpression)
+
+BOOLEAN_NAMES = ('True', 'False')
+
+def _return_expression(function):
+    """
+    Returns the expression function returns, if its body consists
+    of nothing else.
+
+    """
+    statements = [s for s in function.statements if not isinstance(s, vbast.DimDeclaration)]
+    if function.locals or function.listcomps or not 1 <= len(statements) <= 2:
+        return None
+    if len(statements) == 2 and not isinstance(statements[1], vbast.ExitFunctionStatement):
+        return None
+    assign = statements[0]
+    if isinstance(assign, vbast.LetStatement) and \
+            isinstance(assign.lexpression, vbast.SimpleNameExpression) and \
+            assign.lexpression.name == function.name:
+        return assign.expression
+    return None
+
+def _is_pure(expression, parameters, callees):
+    for node in vbast.walk(expression):
+        if isinstance(node, vbast.IndexExpression):
+            name = getattr(node.lexpression, 'name', None)
+            if name not in callees or name in parameters:
+                return False
+        elif not isinstance(node, PURE_NODES):
+            return False
+        elif isinstance(node, vbast.SimpleNameExpression) and \
+                node.name not in parameters and node.name not in BOOLEAN_NAMES:
+            # Callee names are visited as part of their call.
+            if node.name not in callees:
+                return False
+    return True
+
+def _has_side_effects(expression):
+    return any(not isinstance(node, PURE_NODES) for node in vbast.walk(expression))
+
+def _size(expression):
+    return sum(1 for _ in vbast.walk(expression))
+
+def _convert(expression, vbtype):
+    """
+    Returns expression converted to vbtype, or None if that isn't
+    possible without a Set.
+
+    """
+    if vbtype == vbast.Variant or expression.vbtype() == vbtype:
+        return expression
+    if isinstance(expression, vbast.IntegerLiteral) and vbtype in vbast.INTEGER_RANGES:
+        low, high = vbast.INTEGER_RANGES[vbtype]
+        if low <= expression.value <= high:
+            return vbast.IntegerLiteral(expression.value, vbtype)
+    if vbtype not in CONVERSIONS:
+        return None
+    conversion = vbast.IndexExpression(vbast.SimpleNameExpression(CONVERSIONS[vbtype]),
+                                       [expression])
+    conversion.set_vbtype(vbtype)
+    return conversion
+
+def _substitute(expression, arguments):
+    """
+    Returns a copy of expression with a copy of arguments[name] in
+    place of each parameter name.
+
+    """
+    def replace(node):
+        if isinstance(node, vbast.SimpleNameExpression) and node.name in arguments:
+            return copy.deepcopy(arguments[node.name])
+        return node
+
+    expression = copy.deepcopy(expression)
+    # Collect the nodes first so that substituted arguments aren't
+    # themselves searched for parameter names.
+    for node in list(vbast.walk(expression)):
+        for field in node._fields:
+            value = getattr(node, field)
+            if isinstance(value, vbast.ASTNode):
+                setattr(node, field, replace(value))
+            elif isinstance(value, list):
+                setattr(node, field, [replace(v) if isinstance(v, vbast.ASTNode)
+                                      else tuple(map(replace, v)) for v in value])
+    return replace(expression)
+
+class _Inlinable(object):
+    __slots__ = ('function', 'expression', 'uses')
+
+    def __init__(self, function, expression):
+        self.function = function
+        self.expression = expression
+        self.uses = {}
+        for node in vbast.walk(expression):
+            if isinstance(node, vbast.SimpleNameExpression):
+                self.uses[node.name] = self.uses.get(node.name, 0) + 1
+
+    def inline(self, call):
+        """
+        Returns the expression to replace call with, or None if call
+        can't be inlined.
+
+        """
+        parameters = self.function.parameters
+        if len(call.args) != len(parameters):
+            return None
+        impure = set(id(arg) for arg in call.args if _has_side_effects(arg))
+        arguments = {}
+        for parameter, arg in zip(parameters, call.args):
+            name = parameter.name.name
+            if id(arg) in impure and (len(impure) > 1 or self.uses.get(name, 0) != 1):
+                return None
+            arguments[name] = _convert(arg, parameter.vbtype)
+            if arguments[name] is None:
+                return None
+        return _convert(_substitute(self.expression, arguments), self.function.rettype)
+
+class Inliner(NodeWalker):
+    """
+    Replaces calls to the functions in inlinable, a dict of
+    name : _Inlinable, throughout a node, in place. Names in shadowed,
+and the locals and parameters of the procedures walked, refer to
+variables rather than functions.
+
+    """
+    def __init__(self, inlinable, shadowed=()):
+        super(Inliner, self).__init__(iterative=True)
+        self.inlinable = inlinable
+        self.shadowed = frozenset(shadowed)
+
+    @visitor(vbast.ASTNode)
+    def visit_node(self, node):
+        outer = self.shadowed
+        if isinstance(node, vbast.Procedure):
+            self.shadowed = outer | set(getattr(node, 'locals', ())) | \
+                            set(node.parameters_names)
+        for field in node._fields:
+            value = getattr(node, field)
+            if isinstance(value, vbast.ASTNode):
+                setattr(node, field, (yield value))
+            elif isinstance(value, list):
+                items = []
+                for item in value:
+                    if isinstance(item, tuple):
+                        walked = []
+                        for element in item:
+                            walked.append((yield element))
+                        items.append(tuple(walked))
+                    else:
+                        items.append((yield item))
+                setattr(node, field, items)
+
+        if isinstance(node, vbast.IndexExpression):
+            name = getattr(node.lexpression, 'name', None)
+            target = self.inlinable.get(name) if name not in self.shadowed else None
+            if target:
+                node = target.inline(node) or node
+        self.shadowed = outer
+        yield result(node)
+
+def inlinable_functions(module):
+    """
+    Returns a list of the _Inlinable functions of module, each one
+    after the functions it calls. Their expressions have the calls
+    to earlier functions in the list already inlined.
+
+    """
+    expressions = {}
+    for function in module.code:
+        if isinstance(function, vbast.Function) and not function.rettype.is_object_type():
+            expression = _return_expression(function)
+            if expression is not None:
+                expressions[function.name] = expression
+
+    # Functions only calling already inlinable functions become
+    # inlinable in turn, so recursive ones never do.
+    ordered = []
+    inlinable = {}
+    changed = True
+    while changed:
+        changed = False
+        for function in module.code:
+            name = function.name
+            if name in inlinable or name not in expressions:
+                continue
+            parameters = set(function.parameters_names)
+            if not _is_pure(expressions[name], parameters, inlinable):
+                continue
+            expression = Inliner(inlinable, parameters).walk(expressions[name])
+            if _size(expression) <= MAX_INLINE_SIZE:
+                inlinable[name] = _Inlinable(function, expression)
+                ordered.append(inlinable[name])
+                changed = True
+    return ordered
+
+def inline_functions(module):
+    """
+    Inlines calls to small pure functions throughout module.
+
+    """
+    inlinable = dict((f.function.name, f) for f in inlinable_functions(module))
+    if not inlinable:
+        return
+    inliner = Inliner(inlinable)
+    inliner.walk(module)
+    for support_module in module.support_modules:
+        inliner.walk(support_module)
+    if module.class_support_module:
+        inliner.walk(module.class_support_module)
@@ -0,0 +1,267 @@
+"""
+Caching of constant list and dict literals over a converted vbast
+module.
+
+Each evaluation of a literal builds a new Collection or Dictionary,
+copying every element through the ParamArray of NewCollection or
+NewDictionary. A literal whose elements are all constants instead
+becomes a Private module level variable, built by the first statement
+that needs it:
+
+    If literal0_ Is Nothing Then Set literal0_ = NewCollection(1, 2, 3)
+
+Every evaluation after that then shares the one object, so a literal
+is only cached if nothing can change it or tell it apart from a new
+one. It must be iterated over, indexed, have its Count, Items, Keys
+or Exists read, or be passed to a runtime helper that only reads its
+arguments. It may also be assigned to a local that is only ever used
+in those ways. Looking up a missing key adds it to a Dictionary, so
+dict literals must only be indexed by constant keys they contain, or
+within an If testing the key is in the literal first.
+Identical literals in a module share a variable.
+
+Runs after constant folding, which reduces elements to literals.
+
+"""
+import vbast
+import cse
+
+BOOLEAN_NAMES = ('True', 'False')
+
+CONSTANTS = (vbast.IntegerLiteral, vbast.FloatLiteral, vbast.StringLiteral)
+
+# Members of Collections and Dictionaries that don't modify them.
+READ_MEMBERS = ('Count', 'Exists', 'Item', 'Items', 'Keys')
+
+# Runtime helpers that only read their arguments.
+READ_HELPERS = ('PyLen', 'PyToArray', 'PySorted', 'PyJoin', 'PyContains', 'PyMin', 'PyMax')
+
+def _is_constant(node):
+    if isinstance(node, vbast.UnaryOp):
+        node = node.operand
+    return isinstance(node, CONSTANTS) or \
+           (isinstance(node, vbast.SimpleNameExpression) and node.name in BOOLEAN_NAMES)
+
+def _is_constant_literal(node):
+    if isinstance(node, vbast.ListLiteral):
+        elements = node.elements
+    elif isinstance(node, vbast.DictLiteral):
+        elements = [element for item in node.items for element in item]
+    else:
+        return False
+    return bool(elements) and all(_is_constant(e) for e in elements)
+
+def _written(statements):
+    """
+    Returns the ids of the nodes whose elements or members the
+    statements assign.
+
+    """
+    written = set()
+    for statement in statements:
+        for node in vbast.walk(statement):
+            for field in node._targets:
+                target = getattr(node, field)
+                # Assigning a variable itself changes no object.
+                while isinstance(target, (vbast.IndexExpression, vbast.MemberAccessExpression)):
+                    target = target.lexpression
+                    written.add(id(target))
+    return written
+
+def _parents(statements):
+    """
+    Yields (node, parent, field) for every expression within
+    statements.
+
+    """
+    pending = [(s, None, None) for s in statements]
+    while pending:
+        node, parent, field = pending.pop()
+        if parent is not None:
+            yield node, parent, field
+        for child_field in node._fields:
+            value = getattr(node, child_field)
+            if isinstance(value, vbast.ASTNode):
+                pending.append((value, node, child_field))
+            elif isinstance(value, list):
+                for item in value:
+                    items = item if isinstance(item, tuple) else [item]
+                    pending.extend((i, node, child_field) for i in items
+                                   if isinstance(i, vbast.ASTNode))
+
+def _keys(literal):
+    """
+    Returns the as_code() of the keys of a dict literal, or None for
+    a list literal.
+
+    """
+    if isinstance(literal, vbast.DictLiteral):
+        return set(key.as_code() for key, value in literal.items)
+    return None
+
+def _guard(test):
+    """
+    Returns (Dictionary name, key) if test is d.Exists(key) for a
+    variable d and a variable or constant key, else None.
+
+    """
+    if isinstance(test, vbast.IndexExpression) and len(test.args) == 1 and \
+            isinstance(test.lexpression, vbast.MemberAccessExpression) and \
+            test.lexpression.right.name == 'Exists' and \
+            isinstance(test.lexpression.lexpression, vbast.SimpleNameExpression):
+        key = test.args[0]
+        if isinstance(key, vbast.SimpleNameExpression) or _is_constant(key):
+            return test.lexpression.lexpression.name, key
+    return None
+
+def _guarded_lookups(statements):
+    """
+    Returns the ids of the lookups d(key) within statements that only
+    run once d.Exists(key) is known to be True.
+
+    """
+    guarded = set()
+    for statement in statements:
+        for node in vbast.walk(statement):
+            if not isinstance(node, vbast.IfStatement) or _guard(node.test) is None:
+                continue
+            name, key = _guard(node.test)
+            lookups = set()
+            valid = True
+            for n, parent, field in _parents(node.body):
+                if not isinstance(n, vbast.SimpleNameExpression):
+                    continue
+                if n.name == name and field in parent._targets:
+                    valid = False
+                elif n.name == getattr(key, 'name', None):
+                    # Anywhere else the key might be changed, e.g.
+                    # ByRef.
+                    if not (isinstance(parent, vbast.IndexExpression) and
+                            getattr(parent.lexpression, 'name', None) == name and
+                            parent.args == [n]):
+                        valid = False
+                elif isinstance(parent, vbast.IndexExpression) and field == 'lexpression' and \
+                        n.name == name and len(parent.args) == 1 and \
+                        parent.args[0].as_code() == key.as_code():
+                    lookups.add(id(parent))
+            if valid:
+                guarded |= lookups
+    return guarded
+
+def _is_read(node, parent, field, written, keys=None, guarded=()):
+    """
+    Returns True if the Collection or Dictionary node evaluates to is
+    only read where it appears. keys are those of a Dictionary, which
+    it may only be indexed by, unless the lookup is in guarded.
+
+    """
+    if id(node) in written:
+        return False
+    if isinstance(parent, vbast.ForEachStatement):
+        return field == 'iterable'
+    if isinstance(parent, vbast.IndexExpression):
+        if field == 'lexpression':
+            return keys is None or id(parent) in guarded or \
+                   all(_is_constant(a) and a.as_code() in keys for a in parent.args)
+        return getattr(parent.lexpression, 'name', None) in READ_HELPERS
+    if isinstance(parent, vbast.MemberAccessExpression):
+        if keys is not None and parent.right.name == 'Item':
+            return False
+        return field == 'lexpression' and parent.right.name in READ_MEMBERS
+    return False
+
+class _ProcedureCacher(object):
+    def __init__(self, procedure, module_cacher):
+        self.procedure = procedure
+        self.module_cacher = module_cacher
+        self.written = _written(procedure.statements)
+        self.guarded = _guarded_lookups(procedure.statements)
+        # Assignments to a variable don't use its value.
+        self.uses = {}
+        for node, parent, field in _parents(procedure.statements):
+            if isinstance(node, vbast.SimpleNameExpression) and field not in parent._targets:
+                self.uses.setdefault(node.name, []).append((node, parent, field))
+
+    def _is_read_only_local(self, name, keys):
+        if name not in self.procedure.locals or name == self.procedure.name:
+            return False
+        return all(_is_read(node, parent, field, self.written, keys, self.guarded)
+                   for node, parent, field in self.uses.get(name, []))
+
+    def _is_cacheable(self, node, parent, field):
+        keys = _keys(node)
+        if _is_read(node, parent, field, self.written, keys):
+            return True
+        # Assigned to a local that is only read.
+        return isinstance(parent, (vbast.LetStatement, vbast.SetStatement)) and \
+               field == 'expression' and \
+               isinstance(parent.lexpression, vbast.SimpleNameExpression) and \
+               self._is_read_only_local(parent.lexpression.name, keys)
+
+    def cache_block(self, statements):
+        result = []
+        for statement in statements:
+            for node, parent, field, replace in list(cse._expression_slots(statement)):
+                if _is_constant_literal(node) and self._is_cacheable(node, parent, field):
+                    name, initializer = self.module_cacher.variable(node)
+                    result.append(initializer)
+                    reference = vbast.SimpleNameExpression(name)
+                    reference.set_vbtype(node.vbtype())
+                    replace(reference)
+            for block in vbast.iter_blocks(statement):
+                self.cache_block(block)
+            result.append(statement)
+        statements[:] = result
+
+class _ModuleCacher(object):
+    def __init__(self, module):
+        self.module = module
+        self.taken = set(procedure.name for procedure in module.code)
+        self.taken.update(getattr(d, 'name', None) for d in module.declarations)
+        # (type name, as_code() of a literal) : name of its variable
+        self.variables = {}
+
+    def variable(self, literal):
+        """
+        Returns the name of the variable holding literal, and the
+        statement initializing it.
+
+        """
+        key = (literal.vbtype().name, literal.as_code())
+        name = self.variables.get(key)
+        if name is None:
+            i = 0
+            while 'literal%d_' % (i,) in self.taken:
+                i += 1
+            name = 'literal%d_' % (i,)
+            self.taken.add(name)
+            self.variables[key] = name
+            self.module.declarations.append(
+                vbast.PrivateVariableDeclaration(name, literal.vbtype()))
+        test = vbast.BinOp('Is', vbast.SimpleNameExpression(name),
+                           vbast.SimpleNameExpression('Nothing'))
+        test.set_vbtype(vbast.Boolean)
+        return name, vbast.IfStatement(
+            test, [vbast.SetStatement(vbast.SimpleNameExpression(name), literal)])
+
+def _procedures(module):
+    pending = list(reversed(module.code))
+    while pending:
+        procedure = pending.pop()
+        yield procedure
+        pending.extend(reversed(procedure.listcomps))
+
+def cache_constant_literals(module):
+    """
+    Replaces the constant list and dict literals of module, and of
+    its support modules, with lazily built module level variables.
+
+    """
+    modules = [module] + module.support_modules
+    if module.class_support_module:
+        modules.append(module.class_support_module)
+    for m in modules:
+        cacher = _ModuleCacher(m)
+        for procedure in _procedures(m):
+            if isinstance(procedure, (vbast.Function, vbast.Subroutine)):
+                _ProcedureCacher(procedure, cacher).cache_block(procedure.statements)
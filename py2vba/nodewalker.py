@@ -1,3 +1,5 @@
+import inspect
+
 class NodeWalkerError(Exception):
     pass
 
@@ -7,12 +9,129 @@ def visitor(node):
         return fcn
     return visitor_decorator
 
+class result(object):
+    """
+    Yielded by a generator visitor to hand its final value back
+    to the walker.
+
+    A visitor written as a generator yields each child node it
+    wants walked and receives the child's value back from the
+    yield expression, e.g.
+
+        @visitor(_ast.BinOp)
+        def visit_binop(self, binop):
+            left = yield binop.left
+            right = yield binop.right
+            yield result(BinOp(left, right))
+
+    Generator visitors can be driven from an explicit stack, so
+    they work on arbitrarily deep trees.
+
+    """
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+def _profiled_handler(profile, handler, is_generator):
+    name = handler.__name__
+    if not is_generator:
+        def profiled(walker, node):
+            profile.enter(name)
+            try:
+                return handler(walker, node)
+            finally:
+                profile.exit()
+        return profiled
+
+    def profiled(walker, node):
+        profile.enter(name)
+        try:
+            visit = handler(walker, node)
+            value = None
+            while True:
+                request = visit.send(value)
+                if request.__class__ is result:
+                    break
+                value = yield request
+        except:
+            profile.exit()
+            raise
+        profile.exit()
+        yield request
+    return profiled
+
 class NodeWalker(object):
-    def __init__(self):
-        self._visitor_map = dict((x.handles_node, x) for x in self.__class__.__dict__.values() if hasattr(x, 'handles_node'))
+    def __init__(self, iterative=False, profile=None):
+        cls = self.__class__
+        if '_handler_cache' not in cls.__dict__:
+            cls._visitor_map = dict((x.handles_node, (x, inspect.isgeneratorfunction(x)))
+                                    for x in cls.__dict__.values() if hasattr(x, 'handles_node'))
+            cls._handler_cache = {}
+        if iterative:
+            self.walk = self._walk_iterative
+        if profile is not None:
+            # Instrumented handlers live on the instance so that
+            # unprofiled walkers keep dispatching to the originals.
+            self._visitor_map = dict((node, (_profiled_handler(profile, handler, is_generator), is_generator))
+                                     for node, (handler, is_generator) in cls._visitor_map.iteritems())
+            self._handler_cache = {}
 
-    def walk(self, node):
-        for cls in node.__class__.__mro__:
+    def _lookup_handler(self, node):
+        """
+        Returns the (handler, is_generator) pair for node, resolving
+        and caching it per node class on first use.
+
+        """
+        nodecls = node.__class__
+        try:
+            return self._handler_cache[nodecls]
+        except KeyError:
+            pass
+        for cls in nodecls.__mro__:
             if cls in self._visitor_map:
-                return self._visitor_map[cls](self, node)
+                handler = self._handler_cache[nodecls] = self._visitor_map[cls]
+                return handler
         raise NodeWalkerError('Cannot find walker handler associated with %r.' % (node,))
+
+    def walk(self, node):
+        handler, is_generator = self._lookup_handler(node)
+        if not is_generator:
+            return handler(self, node)
+
+        visit = handler(self, node)
+        value = None
+        while True:
+            request = visit.send(value)
+            if request.__class__ is result:
+                return request.value
+            value = self.walk(request)
+
+    def _walk_iterative(self, node):
+        """
+        Walks node using an explicit stack of suspended generator
+        visitors rather than Python frames.
+
+        """
+        handler, is_generator = self._lookup_handler(node)
+        if not is_generator:
+            return handler(self, node)
+
+        lookup_handler = self._lookup_handler
+        stack = [handler(self, node)]
+        value = None
+        while True:
+            request = stack[-1].send(value)
+            if request.__class__ is result:
+                stack.pop()
+                value = request.value
+                if not stack:
+                    return value
+                continue
+
+            handler, is_generator = lookup_handler(request)
+            if is_generator:
+                stack.append(handler(self, request))
+                value = None
+            else:
+                value = handler(self, request)
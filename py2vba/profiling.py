@@ -0,0 +1,127 @@
+"""
+Opt-in instrumentation for conversions.
+
+A Profile records call counts, cumulative time and self time for
+each NodeWalker visitor, plus the time spent in each conversion
+phase:
+
+    profile = Profile()
+    with profile.phase('parse'):
+        tree = convert.build_ast_from_code(code)
+    with profile.phase('walk'):
+        module = convert.PythonASTWalker(profile=profile).walk(tree)
+    with profile.phase('emit'):
+        module.write(f)
+    profile.dump(sys.stderr)
+
+Walkers created without a profile are not instrumented at all.
+
+"""
+import contextlib
+import timeit
+
+PHASES = ('parse', 'walk', 'emit')
+
+class HandlerStats(object):
+    __slots__ = ('calls', 'cumulative', 'self_time', '_active')
+
+    def __init__(self):
+        self.calls = 0
+        self.cumulative = 0.0
+        self.self_time = 0.0
+        self._active = 0
+
+    def __getstate__(self):
+        return (self.calls, self.cumulative, self.self_time)
+
+    def __setstate__(self, state):
+        self.calls, self.cumulative, self.self_time = state
+        self._active = 0
+
+class Profile(object):
+    def __init__(self, timer=timeit.default_timer):
+        self.handlers = {}
+        self.phases = {}
+        self._timer = timer
+        # One [stats, start, child time] frame per handler in progress.
+        self._frames = []
+
+    def __getstate__(self):
+        return (self.handlers, self.phases)
+
+    def __setstate__(self, state):
+        self.handlers, self.phases = state
+        self._timer = timeit.default_timer
+        self._frames = []
+
+    def enter(self, name):
+        stats = self.handlers.get(name)
+        if stats is None:
+            stats = self.handlers[name] = HandlerStats()
+        stats.calls += 1
+        stats._active += 1
+        self._frames.append([stats, self._timer(), 0.0])
+
+    def exit(self):
+        stats, start, child_time = self._frames.pop()
+        elapsed = self._timer() - start
+        stats.self_time += elapsed - child_time
+        stats._active -= 1
+        # Only the outermost activation of a recursive handler counts
+        # towards its cumulative time.
+        if not stats._active:
+            stats.cumulative += elapsed
+        if self._frames:
+            self._frames[-1][2] += elapsed
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        start = self._timer()
+        try:
+            yield
+        finally:
+            self.phases[name] = self.phases.get(name, 0.0) + self._timer() - start
+
+    def merge(self, other):
+        """
+        Adds the statistics recorded by other, e.g. in a worker
+        process, to this profile.
+
+        """
+        for name, stats in other.handlers.iteritems():
+            mine = self.handlers.get(name)
+            if mine is None:
+                mine = self.handlers[name] = HandlerStats()
+            mine.calls += stats.calls
+            mine.cumulative += stats.cumulative
+            mine.self_time += stats.self_time
+        for name, elapsed in other.phases.iteritems():
+            self.phases[name] = self.phases.get(name, 0.0) + elapsed
+
+    def as_dict(self):
+        return {
+            'phases' : dict(self.phases),
+            'handlers' : dict((name, {'calls' : s.calls,
+                                      'cumulative' : s.cumulative,
+                                      'self' : s.self_time})
+                              for name, s in self.handlers.iteritems()),
+        }
+
+    def report(self, limit=None):
+        lines = ['%-10s %12s' % ('phase', 'seconds')]
+        ordered = [p for p in PHASES if p in self.phases] + \
+                  sorted(p for p in self.phases if p not in PHASES)
+        for name in ordered:
+            lines.append('%-10s %12.6f' % (name, self.phases[name]))
+
+        lines.append('')
+        lines.append('%-28s %10s %12s %12s %12s' % ('handler', 'calls', 'cumulative', 'self', 'self/call'))
+        handlers = sorted(self.handlers.iteritems(), key=lambda item: -item[1].self_time)
+        for name, stats in handlers[:limit]:
+            lines.append('%-28s %10d %12.6f %12.6f %12.9f' % (
+                name, stats.calls, stats.cumulative, stats.self_time,
+                stats.self_time / stats.calls))
+        return '\n'.join(lines)
+
+    def dump(self, fileobj, limit=None):
+        fileobj.write(self.report(limit) + '\n')
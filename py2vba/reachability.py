@@ -0,0 +1,85 @@
+"""
+Whole-module reachability over a converted vbast module.
+
+Top-level functions declared with vbmeta(entry=True) are the roots.
+Everything they can reach, by calling a function, constructing a
+class or naming a class as a type, is kept. Unreachable functions,
+class modules, user-defined Types and constructor helpers are removed
+before any further passes run or code is emitted. Modules without
+entry points are left as they are. Procedures marked implicit_root,
+such as vectorized functions and their wrappers, are roots too, but
+only in modules that have entry points.
+
+Methods can be called on any object, so every method of a reachable
+class counts as reachable.
+
+"""
+import vbast
+
+def _type_name(vbtype):
+    if isinstance(vbtype, vbast.ArrayType):
+        vbtype = vbtype.element
+    return vbtype.name
+
+def _references(node):
+    """
+    Yields every name node, or any node within it, refers to,
+    including the names of the types it uses.
+
+    """
+    for n in vbast.walk(node):
+        if isinstance(n, vbast.SimpleNameExpression):
+            yield n.name
+        elif isinstance(n, (vbast.Parameter, vbast.DimDeclaration,
+                            vbast.PublicVariableDeclaration, vbast.NewExpression)):
+            yield _type_name(n.vbtype)
+        elif isinstance(n, vbast.Function):
+            yield _type_name(n.rettype)
+        elif isinstance(n, vbast.TypeDeclaration):
+            for name, vbtype in n.fields:
+                yield _type_name(vbtype)
+
+def reachable_names(module, entries):
+    """
+    Returns the names of the module level procedures, classes and
+    constructors reachable from the procedures in entries.
+
+    """
+    definitions = dict((p.name, p) for p in module.code)
+    definitions.update((m.name, m) for m in module.support_modules
+                       if isinstance(m, vbast.ClassModule))
+    if module.class_support_module:
+        definitions.update((f.name, f) for f in module.class_support_module.code)
+    definitions.update((d.name, d) for d in module.declarations
+                       if isinstance(d, vbast.TypeDeclaration))
+
+    reached = set(p.name for p in entries)
+    pending = list(entries)
+    while pending:
+        for name in _references(pending.pop()):
+            if name in definitions and name not in reached:
+                reached.add(name)
+                pending.append(definitions[name])
+    return reached
+
+def prune_unreachable(module):
+    """
+    Removes everything in module that its entry points can't reach.
+
+    """
+    if not any(p.entry for p in module.code):
+        return
+
+    reached = reachable_names(module, [p for p in module.code if p.entry or p.implicit_root])
+    module.code = [p for p in module.code if p.name in reached]
+    module.function_namespace = dict((name, f) for name, f in module.function_namespace.iteritems()
+                                     if name in reached)
+    module.support_modules = [m for m in module.support_modules
+                              if not isinstance(m, vbast.ClassModule) or m.name in reached]
+    module.declarations = [d for d in module.declarations
+                           if not isinstance(d, vbast.TypeDeclaration) or d.name in reached]
+    support = module.class_support_module
+    if support:
+        support.code = [f for f in support.code if f.name in reached]
+        if not support.code:
+            module.class_support_module = None
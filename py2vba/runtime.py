@@ -0,0 +1,406 @@
+"""
+VBA runtime library backing Python builtins.
+
+Each helper is a Private VBA routine that can be emitted on its own,
+along with the helpers it depends on. Converted code refers to helpers
+by name, and link() adds only the ones a module actually references to
+the end of that module:
+
+    runtime.link(module)
+
+Helpers are Private so that every module, class modules included,
+carries its own copy and never clashes with another module's.
+
+"""
+import vbast
+
+# Bumped whenever the code of any helper changes.
+RUNTIME_VERSION = 1
+
+class Helper(object):
+    """
+    A named VBA routine and the names of the helpers it calls.
+
+    """
+    __slots__ = ('name', 'code', 'requires', 'vbtype')
+
+    def __init__(self, name, code, requires=(), vbtype=vbast.Variant):
+        self.name = name
+        self.code = code.strip('\n')
+        self.requires = requires
+        self.vbtype = vbtype
+
+HELPERS = [
+    Helper(vbast.COLLECTION_LITERAL_HELPER, """
+Private Function NewCollection(ParamArray params() As Variant) As Collection
+    Dim p As Variant
+
+    Set NewCollection = New Collection
+    For Each p In params
+        NewCollection.Add p
+    Next p
+End Function
+""", vbtype=vbast.Collection),
+
+    Helper(vbast.DICT_LITERAL_HELPER, """
+Private Function NewDictionary(ParamArray params() As Variant) As Dictionary
+    Dim i As Long
+
+    Debug.Assert (UBound(params) + 1) Mod 2 = 0
+    Set NewDictionary = New Dictionary
+    For i = LBound(params) To UBound(params) Step 2
+        NewDictionary.Add params(i), params(i + 1)
+    Next i
+End Function
+""", vbtype=vbast.Dictionary),
+
+    Helper('PyLen', """
+Private Function PyLen(x As Variant) As Long
+    If IsArray(x) Then
+        PyLen = UBound(x) - LBound(x) + 1
+    ElseIf IsObject(x) Then
+        PyLen = x.Count
+    Else
+        PyLen = Len(x)
+    End If
+End Function
+""", vbtype=vbast.Long),
+
+    Helper('PyRange', """
+Private Function PyRange(ByVal start As Long, ByVal finish As Long, ByVal increment As Long) As Collection
+    Dim i As Long
+
+    If increment = 0 Then Err.Raise 5, "range", "range() step argument must not be zero"
+    Set PyRange = New Collection
+    If increment > 0 Then
+        For i = start To finish - 1 Step increment
+            PyRange.Add i
+        Next i
+    Else
+        For i = start To finish + 1 Step increment
+            PyRange.Add i
+        Next i
+    End If
+End Function
+""", vbtype=vbast.Collection),
+
+    Helper('PyToArray', """
+Private Function PyToArray(items As Variant) As Variant
+    Dim values() As Variant
+    Dim item As Variant
+    Dim i As Long
+
+    If IsArray(items) Then
+        PyToArray = items
+        Exit Function
+    End If
+    If items.Count = 0 Then
+        PyToArray = Array()
+        Exit Function
+    End If
+    ' Dictionaries give their keys, like iterating a dict.
+    ReDim values(0 To items.Count - 1)
+    For Each item In items
+        If IsObject(item) Then
+            Set values(i) = item
+        Else
+            values(i) = item
+        End If
+        i = i + 1
+    Next item
+    PyToArray = values
+End Function
+"""),
+
+    Helper('PySortArray', """
+Private Sub PySortArray(values As Variant, ByVal lo As Long, ByVal hi As Long)
+    Dim i As Long
+    Dim j As Long
+    Dim pivot As Variant
+    Dim swap As Variant
+
+    ' Quicksort down to short runs, which insertion sort finishes.
+    Do While hi - lo > 12
+        pivot = values((lo + hi) \\ 2)
+        i = lo
+        j = hi
+        Do While i <= j
+            Do While values(i) < pivot
+                i = i + 1
+            Loop
+            Do While pivot < values(j)
+                j = j - 1
+            Loop
+            If i <= j Then
+                swap = values(i)
+                values(i) = values(j)
+                values(j) = swap
+                i = i + 1
+                j = j - 1
+            End If
+        Loop
+        ' Recursing into the smaller part bounds the stack depth.
+        If j - lo < hi - i Then
+            PySortArray values, lo, j
+            lo = i
+        Else
+            PySortArray values, i, hi
+            hi = j
+        End If
+    Loop
+    For i = lo + 1 To hi
+        swap = values(i)
+        j = i - 1
+        Do While j >= lo
+            If values(j) <= swap Then Exit Do
+            values(j + 1) = values(j)
+            j = j - 1
+        Loop
+        values(j + 1) = swap
+    Next i
+End Sub
+"""),
+
+    Helper('PySorted', """
+Private Function PySorted(items As Variant, Optional ByVal reverse As Boolean = False) As Collection
+    Dim values As Variant
+    Dim i As Long
+
+    values = PyToArray(items)
+    Set PySorted = New Collection
+    If UBound(values) < LBound(values) Then Exit Function
+    PySortArray values, LBound(values), UBound(values)
+    If reverse Then
+        For i = UBound(values) To LBound(values) Step -1
+            PySorted.Add values(i)
+        Next i
+    Else
+        For i = LBound(values) To UBound(values)
+            PySorted.Add values(i)
+        Next i
+    End If
+End Function
+""", requires=('PyToArray', 'PySortArray'), vbtype=vbast.Collection),
+
+    Helper('PyJoin', """
+Private Function PyJoin(ByVal separator As String, items As Variant) As String
+    PyJoin = Join(PyToArray(items), separator)
+End Function
+""", requires=('PyToArray',), vbtype=vbast.String),
+
+    Helper('PyContains', """
+Private Function PyContains(container As Variant, item As Variant) As Boolean
+    Dim element As Variant
+
+    If IsObject(container) Then
+        If TypeOf container Is Dictionary Then
+            PyContains = container.Exists(item)
+            Exit Function
+        End If
+    ElseIf Not IsArray(container) Then
+        PyContains = InStr(1, container, item, vbBinaryCompare) > 0
+        Exit Function
+    End If
+    ' Elements are compared by value.
+    For Each element In container
+        If element = item Then
+            PyContains = True
+            Exit Function
+        End If
+    Next element
+End Function
+""", vbtype=vbast.Boolean),
+
+    Helper('PyIsNone', """
+Private Function PyIsNone(x As Variant) As Boolean
+    If IsObject(x) Then
+        PyIsNone = x Is Nothing
+    Else
+        PyIsNone = IsEmpty(x) Or IsNull(x)
+    End If
+End Function
+""", vbtype=vbast.Boolean),
+
+    Helper('PyTruth', """
+Private Function PyTruth(x As Variant) As Boolean
+    If IsObject(x) Then
+        If x Is Nothing Then
+            PyTruth = False
+        ElseIf TypeOf x Is Collection Or TypeOf x Is Dictionary Then
+            PyTruth = x.Count > 0
+        Else
+            PyTruth = True
+        End If
+    ElseIf IsEmpty(x) Or IsNull(x) Then
+        PyTruth = False
+    ElseIf IsArray(x) Then
+        PyTruth = UBound(x) >= LBound(x)
+    ElseIf VarType(x) = vbString Then
+        PyTruth = Len(x) > 0
+    Else
+        PyTruth = CBool(x)
+    End If
+End Function
+""", vbtype=vbast.Boolean),
+
+    Helper('PyRangeValues', """
+Private Function PyRangeValues(cells As Variant) As Variant
+    Dim values As Variant
+    Dim value As Variant
+
+    If IsObject(cells) Then
+        If cells.Cells.CountLarge > 1 Then
+            PyRangeValues = cells.Value2
+            Exit Function
+        End If
+        ' The Value2 of a single cell isn't an array.
+        value = cells.Value2
+    ElseIf IsArray(cells) Then
+        PyRangeValues = cells
+        Exit Function
+    Else
+        ' A single value, e.g. typed into a formula.
+        value = cells
+    End If
+    ReDim values(1 To 1, 1 To 1)
+    values(1, 1) = value
+    PyRangeValues = values
+End Function
+""", vbtype=vbast.RangeData),
+
+    Helper('PyCacheLevel', """
+Private Function PyCacheLevel(cache As Dictionary, ParamArray keys() As Variant) As Dictionary
+    Dim level As Dictionary
+    Dim i As Long
+
+    ' One Dictionary per argument but the last, so that keys are
+    ' compared exactly.
+    Set level = cache
+    For i = LBound(keys) To UBound(keys)
+        If Not level.Exists(keys(i)) Then
+            level.Add keys(i), New Dictionary
+        End If
+        Set level = level(keys(i))
+    Next i
+    Set PyCacheLevel = level
+End Function
+""", vbtype=vbast.Dictionary),
+
+    Helper('PyExtreme', """
+Private Function PyExtreme(ByVal name As String, ByVal sign As Long, values As Variant) As Variant
+    Dim items As Variant
+    Dim item As Variant
+    Dim best As Variant
+    Dim first As Boolean
+
+    items = values
+    ' A single argument is the iterable to search.
+    If UBound(values) = LBound(values) Then
+        If IsObject(values(LBound(values))) Then
+            Set items = values(LBound(values))
+        ElseIf IsArray(values(LBound(values))) Then
+            items = values(LBound(values))
+        End If
+    End If
+
+    first = True
+    For Each item In items
+        If first Then
+            best = item
+            first = False
+        ElseIf sign < 0 Then
+            If item < best Then best = item
+        ElseIf item > best Then
+            best = item
+        End If
+    Next item
+    If first Then Err.Raise 5, name, name & "() arg is an empty sequence"
+    PyExtreme = best
+End Function
+"""),
+
+    Helper('PyMin', """
+Private Function PyMin(ParamArray values() As Variant) As Variant
+    Dim args As Variant
+
+    args = values
+    PyMin = PyExtreme("min", -1, args)
+End Function
+""", requires=('PyExtreme',)),
+
+    Helper('PyMax', """
+Private Function PyMax(ParamArray values() As Variant) As Variant
+    Dim args As Variant
+
+    args = values
+    PyMax = PyExtreme("max", 1, args)
+End Function
+""", requires=('PyExtreme',)),
+]
+
+HELPER_NAMES = dict((helper.name, helper) for helper in HELPERS)
+
+def call(name, args):
+    """
+    Returns an expression calling the runtime helper name with args.
+
+    """
+    helper = HELPER_NAMES[name]
+    expression = vbast.IndexExpression(vbast.SimpleNameExpression(name), args)
+    expression.set_vbtype(helper.vbtype)
+    return expression
+
+def referenced_helpers(module):
+    """
+    Returns the names of the helpers called from the code of module,
+    not counting helpers only called by other helpers.
+
+    """
+    names = set()
+    for node in vbast.walk(module):
+        if isinstance(node, vbast.ListLiteral):
+            names.add(vbast.COLLECTION_LITERAL_HELPER)
+        elif isinstance(node, vbast.DictLiteral):
+            names.add(vbast.DICT_LITERAL_HELPER)
+        elif isinstance(node, vbast.SimpleNameExpression) and node.name in HELPER_NAMES:
+            names.add(node.name)
+    return names
+
+def required_helpers(names):
+    """
+    Returns the helpers named in names along with everything they
+    depend on, in library order.
+
+    """
+    required = set()
+    pending = list(names)
+    while pending:
+        name = pending.pop()
+        if name not in required:
+            required.add(name)
+            pending.extend(HELPER_NAMES[name].requires)
+    return [helper for helper in HELPERS if helper.name in required]
+
+def runtime_code(helpers):
+    header = "' py2vba runtime v%d: %s" % (RUNTIME_VERSION, ', '.join(h.name for h in helpers))
+    return '\n'.join([header] + ['\n' + helper.code for helper in helpers])
+
+def _link_module(module):
+    # Module level names, e.g. a user function called PyLen, take
+    # precedence over the runtime.
+    defined = set(procedure.name for procedure in module.code)
+    helpers = required_helpers(referenced_helpers(module) - defined)
+    if helpers:
+        module.raw_code.append(runtime_code(helpers))
+
+def link(module):
+    """
+    Appends the runtime helpers used by module, and by each of its
+    support modules, to that module.
+
+    """
+    _link_module(module)
+    for support_module in module.support_modules:
+        _link_module(support_module)
+    if module.class_support_module:
+        _link_module(module.class_support_module)
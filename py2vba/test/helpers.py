@@ -76,13 +76,13 @@ def lift_python_function(code, fname, context):
 
     return lifted
 
-def vbast_from_pycode(code):
+def vbast_from_pycode(code, **options):
     pyast = convert.build_ast_from_code(code)
-    walker = convert.PythonASTWalker()
+    walker = convert.PythonASTWalker(**options)
     return walker.walk(pyast)
 
-def lift_code_to_py_and_vba_functions(CODE, fname, pyenviron, xl, workbook):
-    ast = vbast_from_pycode(CODE)
+def lift_code_to_py_and_vba_functions(CODE, fname, pyenviron, xl, workbook, **options):
+    ast = vbast_from_pycode(CODE, **options)
     pyfcn = lift_python_function(CODE, fname, pyenviron)
     vbafcn = lift_vba_function(xl, workbook, ast, fname)
 
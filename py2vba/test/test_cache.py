@@ -0,0 +1,103 @@
+import os
+
+from py2vba import cache
+from py2vba.convert import build_ast_from_code
+
+CODE = '''
+def callee(x):
+    return x + 1
+
+def caller(x):
+    return callee(x) * 2
+
+def unrelated(x):
+    return x
+'''
+
+FINGERPRINT = ('types', 'options')
+
+def keys_for(code, fingerprint=FINGERPRINT):
+    module = build_ast_from_code(code)
+    return dict((node.name, key) for node, key
+                in zip(module.body, cache.definition_keys(module, fingerprint)))
+
+def test_keys_are_stable():
+    assert keys_for(CODE) == keys_for(CODE)
+
+def test_callee_body_invalidates_caller():
+    before = keys_for(CODE)
+    after = keys_for(CODE.replace('x + 1', 'x + 2'))
+
+    assert before['callee'] != after['callee']
+    assert before['caller'] != after['caller']
+    assert before['unrelated'] == after['unrelated']
+
+def test_callee_signature_invalidates_caller():
+    before = keys_for(CODE)
+    after = keys_for(CODE.replace('def callee(x):', 'def callee(x, y=1):'))
+
+    assert before['callee'] != after['callee']
+    assert before['caller'] != after['caller']
+    assert before['unrelated'] == after['unrelated']
+
+def test_reordering():
+    before = keys_for(CODE)
+    # Moving an unrelated definition changes nothing.
+    after = keys_for('''
+def unrelated(x):
+    return x
+
+def callee(x):
+    return x + 1
+
+def caller(x):
+    return callee(x) * 2
+''')
+    assert before == after
+
+    # Defining the callee after its caller does.
+    after = keys_for('''
+def caller(x):
+    return callee(x) * 2
+
+def callee(x):
+    return x + 1
+
+def unrelated(x):
+    return x
+''')
+    assert before['callee'] == after['callee']
+    assert before['caller'] != after['caller']
+    assert before['unrelated'] == after['unrelated']
+
+def test_fingerprint_invalidates_everything():
+    before = keys_for(CODE)
+    after = keys_for(CODE, ('types', 'other options'))
+
+    for name in before:
+        assert before[name] != after[name]
+
+def test_prune_evicts_least_recently_used(tmpdir):
+    c = cache.ConversionCache(str(tmpdir), max_entries=2)
+    for i, key in enumerate(['a', 'b', 'c']):
+        c.put(key, i)
+        os.utime(c._path(key), (i, i))
+    # Reading an entry marks it as recently used.
+    assert c.get('a') == 0
+
+    c.prune()
+
+    assert c.get('a') == 0
+    assert c.get('b') is None
+    assert c.get('c') == 2
+
+def test_prune_bounds_bytes(tmpdir):
+    c = cache.ConversionCache(str(tmpdir))
+    for i, key in enumerate(['a', 'b', 'c']):
+        c.put(key, 'x' * 100)
+        os.utime(c._path(key), (i, i))
+    c.max_bytes = 2 * os.path.getsize(c._path('a'))
+
+    c.prune()
+
+    assert sorted(os.listdir(str(tmpdir))) == ['b.pickle', 'c.pickle']
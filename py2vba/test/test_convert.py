@@ -1,10 +1,11 @@
 import py.test
 
 from py2vba import vbast
-from py2vba.convert import vbmeta
-from py2vba.vbast import Integer, String, Collection
+from py2vba.convert import vbmeta, vbcache
+from py2vba.vbast import Integer, Long, Double, String, Boolean, Collection, RangeData
 
-from helpers import lift_code_to_py_and_vba_functions
+from helpers import lift_code_to_py_and_vba_functions, lift_python_function, \
+    lift_vba_function, vbast_from_pycode
 
 def test_basic_function(xl, workbook):
     CODE = '''
@@ -250,3 +251,491 @@ def test():
         pyobj = pyresult[i]
         vbaobj = vbaresult.Item(i+1)
         assert pyobj == vbaobj
+
+def test_inferred_object_assignment(xl, workbook):
+    CODE = '''
+def names():
+    return ['James', 'Bob']
+
+@vbmeta(rettype=String)
+def test():
+    n = names()
+    return n[1]
+'''
+    pyfcn, vbafcn = lift_code_to_py_and_vba_functions(CODE, 'test', globals(), xl, workbook)
+
+    pyresult = pyfcn()
+    vbaresult = vbafcn()
+
+    assert pyresult == vbaresult
+
+def test_native_width_numbers(xl, workbook):
+    CODE = '''
+@vbmeta(rettype=Double)
+def test():
+    total = 0
+    for i in range(0, 1000):
+        total += i * 100
+    return total * 0.5 + 2.25
+'''
+    pyfcn, vbafcn = lift_code_to_py_and_vba_functions(CODE, 'test', globals(), xl, workbook)
+
+    pyresult = pyfcn()
+    vbaresult = vbafcn()
+
+    assert pyresult == vbaresult
+
+def test_wide_literals(xl, workbook):
+    CODE = '''
+@vbmeta(n=Integer, rettype=Long)
+def test(n):
+    return n * 1000 + n * 40000
+'''
+    pyfcn, vbafcn = lift_code_to_py_and_vba_functions(CODE, 'test', globals(), xl, workbook)
+
+    pyresult = pyfcn(50)
+    vbaresult = vbafcn(50)
+
+    assert pyresult == vbaresult
+
+def test_range_loops(xl, workbook):
+    CODE = '''
+@vbmeta(rettype=Long)
+def test():
+    start = 10
+    total = 0
+    for i in range(start):
+        total += i * 1
+    for i in range(start, 0, -2):
+        total += i * 3 + 0
+    return total
+'''
+    pyfcn, vbafcn = lift_code_to_py_and_vba_functions(CODE, 'test', globals(), xl, workbook)
+
+    pyresult = pyfcn()
+    vbaresult = vbafcn()
+
+    assert pyresult == vbaresult
+
+def test_list_arrays(xl, workbook):
+    CODE = '''
+@vbmeta(n=Long, rettype=Long)
+def test(n):
+    a = []
+    for i in range(n):
+        a.append(i * 2)
+    total = 0
+    for i in range(len(a)):
+        total += a[i]
+    for x in a:
+        total += x
+    return total + a[-1]
+'''
+    pyfcn, vbafcn = lift_code_to_py_and_vba_functions(CODE, 'test', globals(), xl, workbook,
+                                                      list_arrays=True)
+
+    pyresult = pyfcn(100)
+    vbaresult = vbafcn(100)
+
+    assert pyresult == vbaresult
+
+def test_inline_list_comprehension(xl, workbook):
+    CODE = '''
+@vbmeta(n=Long, rettype=Long)
+def test(n):
+    a = [i * j for i in range(n) for j in range(i) if j > 1 if i % 2 == 0]
+    b = [v + 1 for v in a]
+    total = 0
+    for v in b:
+        total += v
+    return total + len(b)
+'''
+    pyfcn, vbafcn = lift_code_to_py_and_vba_functions(CODE, 'test', globals(), xl, workbook,
+                                                      list_arrays=True, inline_comprehensions=True)
+
+    pyresult = pyfcn(20)
+    vbaresult = vbafcn(20)
+
+    assert pyresult == vbaresult
+
+def test_fused_reductions(xl, workbook):
+    CODE = '''
+@vbmeta(n=Long, rettype=Long)
+def test(n):
+    total = sum(i * i for i in range(n) if i % 3 == 0)
+    largest = max(i % 7 for i in range(n))
+    count = len([i for i in range(n) if i > 4])
+    if any(i > 10 for i in range(n)) and all(i >= 0 for i in range(n)):
+        total += 1
+    # Dividing by zero unless both loops stop at i = 1.
+    if any(7 % (5 - i) > 2 for i in range(1, n) for j in range(2)):
+        total += 2
+    return total + largest + count
+'''
+    pyfcn, vbafcn = lift_code_to_py_and_vba_functions(CODE, 'test', globals(), xl, workbook)
+
+    pyresult = pyfcn(20)
+    vbaresult = vbafcn(20)
+
+    assert pyresult == vbaresult
+
+def test_short_circuit(xl, workbook):
+    CODE = '''
+@vbmeta(x=Long, rettype=Boolean)
+def divides(x):
+    return x != 0 and 12 % x == 0
+
+def expensive(x):
+    return x * 2
+
+def big(x):
+    return x is not None and expensive(x) > 3
+
+def fallback():
+    return 'none'
+
+@vbmeta(rettype=Long)
+def test():
+    d = {'a' : 1}
+    count = 0
+    for x in range(-3, 4):
+        if divides(x) or x == 0 and d['a'] > 0:
+            count += 1
+    for x in [None, 1, 5]:
+        if big(x):
+            count += 10
+    # Strings are tested for truth like in Python.
+    for s in ['', 'ab']:
+        count += 100 * len(s or fallback())
+    return count
+'''
+    pyfcn, vbafcn = lift_code_to_py_and_vba_functions(CODE, 'test', globals(), xl, workbook)
+
+    pyresult = pyfcn()
+    vbaresult = vbafcn()
+
+    assert pyresult == vbaresult
+
+def test_runtime_builtins(xl, workbook):
+    CODE = '''
+@vbmeta(n=Long, rettype=Long)
+def test(n):
+    names = ['bob', 'al', 'cy', 'dee']
+    d = {'al' : 1}
+    count = len(', '.join(sorted(names)))
+    for name in sorted(names, reverse=True):
+        if name in d or 'e' in name:
+            count += 1
+    r = range(n)
+    if 3 not in r:
+        count += 100
+    return count + max(n, 3) + min(len(r), 2)
+'''
+    pyfcn, vbafcn = lift_code_to_py_and_vba_functions(CODE, 'test', globals(), xl, workbook)
+
+    pyresult = pyfcn(2)
+    vbaresult = vbafcn(2)
+
+    assert pyresult == vbaresult
+
+def test_entry_points(xl, workbook):
+    # unused() wouldn't compile under Option Explicit, so this
+    # only passes if it is pruned.
+    CODE = '''
+def unused():
+    return undefined_name
+
+class Unused(object):
+    def __init__(self, x):
+        self.x = x
+
+@vbmeta(x=Long, rettype=Long)
+def twice(x):
+    return x * 2
+
+@vbmeta(entry=True, x=Long, rettype=Long)
+def test(x):
+    return twice(x) + 1
+'''
+    pyfcn, vbafcn = lift_code_to_py_and_vba_functions(CODE, 'test', globals(), xl, workbook)
+
+    pyresult = pyfcn(20)
+    vbaresult = vbafcn(20)
+
+    assert pyresult == vbaresult
+
+def test_inline_functions(xl, workbook):
+    CODE = '''
+@vbmeta(x=Long, y=Long, rettype=Long)
+def add(x, y):
+    return x + y
+
+@vbmeta(x=Long, rettype=Long)
+def square(x):
+    return x * x
+
+@vbmeta(n=Integer, rettype=Long)
+def test(n):
+    total = 0
+    for i in range(n):
+        total = add(total, add(i, n) + square(square(i) - n))
+    return total
+'''
+    pyfcn, vbafcn = lift_code_to_py_and_vba_functions(CODE, 'test', globals(), xl, workbook)
+
+    pyresult = pyfcn(50)
+    vbaresult = vbafcn(50)
+
+    assert pyresult == vbaresult
+
+def test_inline_shadowed_names(xl, workbook):
+    CODE = '''
+@vbmeta(x=Long, rettype=Long)
+def shadow(x):
+    return x * 2
+
+@vbmeta(shadow=Collection, rettype=Long)
+def user(shadow):
+    return shadow[0]
+
+@vbmeta(n=Long, rettype=Long)
+def test(n):
+    shadow = [n, 6]
+    return shadow[1] + user(shadow)
+'''
+    pyfcn, vbafcn = lift_code_to_py_and_vba_functions(CODE, 'test', globals(), xl, workbook)
+
+    pyresult = pyfcn(5)
+    vbaresult = vbafcn(5)
+
+    assert pyresult == vbaresult
+
+def test_hoist_member_access(xl, workbook):
+    CODE = '''
+class Item(object):
+    @vbmeta(price=Long)
+    def __init__(self, price):
+        self.price = price
+
+class Basket(object):
+    @vbmeta(items=Collection)
+    def __init__(self, items):
+        self.items = items
+
+@vbmeta(n=Long, rettype=Long)
+def test(n):
+    b = Basket([Item(3), Item(5)])
+    total = 0
+    for i in range(n):
+        total += b.items[0].price * i + b.items[1].price
+    b.items[0].price = 7
+    b.items[0].price += total
+    return b.items[0].price
+'''
+    pyfcn, vbafcn = lift_code_to_py_and_vba_functions(CODE, 'test', globals(), xl, workbook)
+
+    pyresult = pyfcn(10)
+    vbaresult = vbafcn(10)
+
+    assert pyresult == vbaresult
+
+def test_common_subexpressions(xl, workbook):
+    CODE = '''
+@vbmeta(n=Long, rettype=Long)
+def test(n):
+    d = {'a': 2, 'b': 3}
+    total = 0
+    for i in range(n):
+        total += (i + n) * d['a'] - (i + n) * d['a'] % 3
+        if d['b'] > 2:
+            total += d['a'] * d['b']
+        d['a'] = i
+    items = [n]
+    e = {'k': items}
+    if e['k'] is d or e['k'] is items:
+        total += 100
+    return total + (n + 1) * d['a']
+'''
+    pyfcn, vbafcn = lift_code_to_py_and_vba_functions(CODE, 'test', globals(), xl, workbook)
+
+    pyresult = pyfcn(10)
+    vbaresult = vbafcn(10)
+
+    assert pyresult == vbaresult
+
+def test_user_defined_types(xl, workbook):
+    CODE = '''
+@vbmeta(udt=True)
+class Point(object):
+    @vbmeta(x=Long, y=Long)
+    def __init__(self, x, y):
+        self.x = x
+        self.y = y
+
+@vbmeta(p=Point, rettype=Long)
+def norm1(p):
+    return p.x + p.y
+
+@vbmeta(n=Long, rettype=Long)
+def test(n):
+    points = []
+    for i in range(n):
+        points.append(Point(i, 2 * i))
+    total = 0
+    for p in points:
+        total += norm1(p)
+    return total + points[1].y
+'''
+    pyfcn, vbafcn = lift_code_to_py_and_vba_functions(CODE, 'test', globals(), xl, workbook)
+
+    pyresult = pyfcn(20)
+    vbaresult = vbafcn(20)
+
+    assert pyresult == vbaresult
+
+def test_range_data(xl, workbook):
+    CODE = '''
+@vbmeta(data=RangeData, factor=Double, rettype=Double)
+def scale(data, factor):
+    t = 0.0
+    for r in range(len(data)):
+        for c in range(len(data[r])):
+            data[r][c] *= factor
+            t += data[r][c] * (c + 1)
+    return t + data[-1][-1]
+'''
+    pyfcn, vbafcn = lift_code_to_py_and_vba_functions(CODE, 'scale', globals(), xl, workbook)
+
+    cells = workbook.Worksheets(1).Range('A1:C4')
+    values = [[r * 3 + c for c in range(3)] for r in range(4)]
+    cells.Value2 = values
+
+    pyresult = pyfcn(values, 2.0)
+    vbaresult = vbafcn(cells, 2.0)
+
+    assert pyresult == vbaresult
+    assert [list(row) for row in cells.Value2] == values
+
+def test_vectorize(xl, workbook):
+    CODE = '''
+@vbmeta(vectorize=True, price=Double, qty=Long, rettype=Double)
+def cost(price, qty):
+    if qty > 10:
+        return price * qty - 5
+    return price * qty
+
+# Doesn't call cost, which must still be kept for cost_vec.
+@vbmeta(entry=True, rettype=Long)
+def report():
+    return 1
+'''
+    pyfcn = lift_python_function(CODE, 'cost', globals())
+    vbafcn = lift_vba_function(xl, workbook, vbast_from_pycode(CODE), 'cost_vec')
+
+    sheet = workbook.Worksheets(1)
+    prices = [1.5, 2.0, 0.25, 4.0]
+    qtys = [3, 12, 40, 0]
+    sheet.Range('A1:A4').Value2 = [[p] for p in prices]
+    sheet.Range('B1:B4').Value2 = [[q] for q in qtys]
+
+    vbaresult = vbafcn(sheet.Range('A1:A4'), sheet.Range('B1:B4'))
+
+    assert [row[0] for row in vbaresult] == [pyfcn(p, q) for p, q in zip(prices, qtys)]
+    assert [row[0] for row in vbafcn(2.5, 4)] == [pyfcn(2.5, 4)]
+
+def test_vectorize_without_entry_points(xl, workbook):
+    CODE = '''
+@vbmeta(vectorize=True, x=Double, rettype=Double)
+def tax(x):
+    return x * 0.25
+
+@vbmeta(x=Double, rettype=Double)
+def other(x):
+    return x + 1
+'''
+    module = vbast_from_pycode(CODE)
+
+    # Nothing is pruned, and tax stays a scalar worksheet function.
+    assert [p.name for p in module.code if isinstance(p, vbast.Function)
+            and p.scope == vbast.PUBLIC] == ['tax', 'tax_vec', 'other']
+    vbafcn = lift_vba_function(xl, workbook, module, 'tax')
+
+    assert vbafcn(2.0) == 0.5
+
+def test_fast_mode(xl, workbook):
+    CODE = '''
+@vbmeta(entry=True, fast_mode=True, n=Long)
+def pick(n):
+    c = [n, n * 2, n * 3]
+    return c[n]
+'''
+    pyfcn, vbafcn = lift_code_to_py_and_vba_functions(CODE, 'pick', globals(), xl, workbook)
+
+    settings = (xl.ScreenUpdating, xl.Calculation, xl.EnableEvents)
+    assert pyfcn(1) == vbafcn(1)
+    assert (xl.ScreenUpdating, xl.Calculation, xl.EnableEvents) == settings
+
+    # Errors still reach the caller, after the settings are restored.
+    py.test.raises(IndexError, pyfcn, 5)
+    py.test.raises(Exception, vbafcn, 5)
+    assert (xl.ScreenUpdating, xl.Calculation, xl.EnableEvents) == settings
+
+def test_vbcache(xl, workbook):
+    CODE = '''
+@vbcache()
+@vbmeta(n=Long, rettype=Long)
+def fib(n):
+    if n < 2:
+        return n
+    return fib(n - 1) + fib(n - 2)
+
+@vbcache(maxsize=2)
+@vbmeta(a=Long, b=Long, rettype=Long)
+def mix(a, b):
+    return fib(a) * 1000 + b
+'''
+    pyfcn, vbafcn = lift_code_to_py_and_vba_functions(CODE, 'mix', globals(), xl, workbook)
+
+    # Repeated and evicted arguments alike.
+    for a, b in [(20, 1), (20, 2), (20, 1), (3, 1), (20, 1), (3, 2)]:
+        assert pyfcn(a, b) == vbafcn(a, b)
+
+def test_cache_literals(xl, workbook):
+    CODE = '''
+@vbmeta(rettype=Double)
+def rate(code):
+    rates = {'A' : 0.5, 'B' : 1.5}
+    if code in rates:
+        return rates[code]
+    return 0.0
+
+@vbmeta(n=Long)
+def grow(n):
+    xs = [1, 2, 3]
+    xs.append(n)
+    return len(xs)
+
+@vbmeta(rettype=Double)
+def run():
+    t = 0.0
+    for code in ['A', 'B', 'C', 'A']:
+        t += rate(code)
+    return t + grow(4) + grow(5)
+'''
+    pyfcn, vbafcn = lift_code_to_py_and_vba_functions(CODE, 'run', globals(), xl, workbook)
+
+    # Calling again reuses the cached literals, unlike the mutated one.
+    assert pyfcn() == vbafcn()
+    assert pyfcn() == vbafcn()
+
+def test_cache_literals_unguarded_lookups():
+    CODE = '''
+@vbmeta(code=String, rettype=Double)
+def rate(code):
+    rates = {'A' : 0.5, 'B' : 1.5}
+    return rates[code] + rates['A']
+'''
+    # A missing code would be added to a shared Dictionary.
+    module = vbast_from_pycode(CODE)
+
+    assert not [d for d in module.declarations if isinstance(d, vbast.PrivateVariableDeclaration)]
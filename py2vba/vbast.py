@@ -10,33 +10,45 @@ GLOBAL = 'Global'
 
 STATIC = 'Static'
 
-COLLECTION_LITERAL_HELPERS = """
-Private Function NewCollection(ParamArray params() As Variant) As Collection
-    Dim p As Variant
-    
-    Set NewCollection = New Collection
-    For Each p In params
-        NewCollection.Add p
-    Next p
-End Function
-
-Private Function NewDictionary(ParamArray params() As Variant) As Dictionary
-    Dim k, v As Variant
-    Dim i As Integer
-    
-    Debug.Assert (UBound(params) + 1) Mod 2 = 0
-    Set NewDictionary = New Dictionary
-    For i = LBound(params) To UBound(params) Step 2
-        NewDictionary.Add params(i), params(i + 1)
-    Next i
-End Function
-"""
-
+# Runtime helpers building list and dict literals, see runtime.py.
 DICT_LITERAL_HELPER = 'NewDictionary'
 COLLECTION_LITERAL_HELPER = 'NewCollection'
 
-def indent(items):
-    return ['\t' + item for item in items]
+class CodeWriter(object):
+    """
+    Streams lines of VBA code into a file-like sink, tracking
+    the current indent depth.
+
+    """
+    def __init__(self, sink, indent_string='\t'):
+        self._sink = sink
+        self._indent_string = indent_string
+        self._prefix = ''
+        self._depth = 0
+        self._separator = ''
+
+    def line(self, text):
+        write = self._sink.write
+        write(self._separator)
+        write(self._prefix)
+        write(text)
+        self._separator = '\n'
+
+    def lines(self, texts):
+        for text in texts:
+            self.line(text)
+
+    def indent(self):
+        self._depth += 1
+        self._prefix = self._indent_string * self._depth
+
+    def dedent(self):
+        assert self._depth > 0, 'Unbalanced CodeWriter.dedent().'
+        self._depth -= 1
+        self._prefix = self._indent_string * self._depth
+
+class _ChunkSink(list):
+    write = list.append
 
 class VBType(object):
     _is_object_type = False
@@ -45,6 +57,20 @@ class VBType(object):
     def is_object_type(cls):
         return cls._is_object_type
 
+    # Types compare by name so that copies, e.g. those restored from
+    # the conversion cache, are interchangeable with the originals.
+    def __eq__(self, other):
+        return self.__class__ is other.__class__ and self.name == other.name
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self.__class__, self.name))
+
+    def __repr__(self):
+        return '%s(%r)' % (self.__class__.__name__, self.name)
+
 class ValueType(VBType):
     _is_object_type = False
 
@@ -59,48 +85,219 @@ class NamedObjectType(ObjectType):
     def __init__(self, name):
         self.name = name
 
+class UserDefinedType(NamedValueType):
+    """
+    A record declared with a Type statement. Values are copied on
+    assignment and can't be stored in Variants or Collections.
+
+    """
+
 Dictionary = NamedObjectType('Dictionary')
 Collection = NamedObjectType('Collection')
 Object = NamedObjectType('Object')
 Integer = NamedValueType('Integer')
+Long = NamedValueType('Long')
+Currency = NamedValueType('Currency')
+Double = NamedValueType('Double')
 String = NamedValueType('String')
+Boolean = NamedValueType('Boolean')
+
+# Inclusive bounds of the VBA whole number types.
+INTEGER_RANGES = {
+    Integer : (-2 ** 15, 2 ** 15 - 1),
+    Long : (-2 ** 31, 2 ** 31 - 1),
+}
+
+# Type declaration characters forcing the type of a literal.
+TYPE_SUFFIXES = {
+    Integer : '%',
+    Long : '&',
+    Currency : '@',
+    Double : '#',
+}
+
+def literal_type(value):
+    """
+    Returns the type VBA gives a whole number literal: Integer if
+    it fits, else Long, else Double.
+
+    """
+    for vbtype in (Integer, Long):
+        low, high = INTEGER_RANGES[vbtype]
+        if low <= value <= high:
+            return vbtype
+    return Double
+
+class ArrayType(ValueType):
+    """
+    A dynamic, 0-based array of element.
+
+    """
+    def __init__(self, element):
+        self.element = element
+        self.name = element.name + '()'
 
 class VariantType(VBType):
     name = 'Variant'
 
 Variant = VariantType()
 
+class RangeDataType(VBType):
+    """
+    The cells of a worksheet Range, as the 2-D, 1-based array read
+    from its Value2. Held in a Variant.
+
+    """
+    name = 'Variant'
+
+RangeData = RangeDataType()
+
 BUILTIN_TYPES = [
     Dictionary, Object, Integer, Variant,
-    Collection, String
+    Collection, String, Boolean,
+    Long, Currency, Double
 ]
 
 class ASTNode(object):
+    __slots__ = ()
+
+    # Attributes holding child nodes, or lists of child nodes.
+    _fields = ()
+    # Attributes holding nested lists of statements.
+    _blocks = ()
+    # Attributes holding the variable a statement assigns to.
+    _targets = ()
+
+    def emit(self, writer):
+        """
+        Writes the VBA code for this node and child nodes
+        to a CodeWriter, one line at a time.
+
+        """
+        raise NotImplementedError()
+
     def as_code(self):
         """
         Returns the VBA code for this node and child nodes
         as a list of lines.
 
         """
-        raise NotImplementedError()
+        chunks = _ChunkSink()
+        self.emit(CodeWriter(chunks))
+        return ''.join(chunks).split('\n')
+
+def iter_child_nodes(node):
+    for field in node._fields:
+        value = getattr(node, field)
+        if isinstance(value, ASTNode):
+            yield value
+        elif isinstance(value, list):
+            for item in value:
+                if isinstance(item, ASTNode):
+                    yield item
+                elif isinstance(item, tuple):
+                    for element in item:
+                        yield element
+
+def walk(node):
+    """
+    Yields node and all of its descendants.
 
-    def _reduce_as_code(self, nodes):
-        return sum([node.as_code() for node in nodes], [])
+    """
+    pending = [node]
+    while pending:
+        node = pending.pop()
+        yield node
+        pending.extend(iter_child_nodes(node))
+
+def iter_blocks(node):
+    """
+    Yields every statement list nested directly within node.
+
+    """
+    for block in node._blocks:
+        yield getattr(node, block)
+
+def iter_procedures(module):
+    """
+    Yields (procedure, type of Me) for every procedure in module,
+    including class methods and list comprehension helpers.
+
+    """
+    procedures = [(f, None) for f in module.code]
+    for support_module in module.support_modules:
+        if isinstance(support_module, ClassModule):
+            procedures += [(f, support_module.vbtype()) for f in support_module.code]
+    if module.class_support_module:
+        procedures += [(f, None) for f in module.class_support_module.code]
+
+    pending = procedures[::-1]
+    while pending:
+        procedure, selftype = pending.pop()
+        yield procedure, selftype
+        pending.extend((listcomp, None) for listcomp in reversed(procedure.listcomps))
+
+def declare_local(procedure, vbtype, prefix='tmp'):
+    """
+    Adds a new local of vbtype, along with its Dim, to a procedure
+    that has already been converted, returning its name.
+
+    """
+    taken = set(procedure.locals) | set(procedure.parameters_names)
+    i = 0
+    while '%s%d_' % (prefix, i) in taken:
+        i += 1
+    name = '%s%d_' % (prefix, i)
+    procedure.locals[name] = vbtype
+
+    dims = 0
+    while dims < len(procedure.statements) and \
+            isinstance(procedure.statements[dims], DimDeclaration):
+        dims += 1
+    procedure.statements.insert(dims, DimDeclaration(name, vbtype))
+    return name
+
+def _emit_all(writer, nodes):
+    for node in nodes:
+        node.emit(writer)
+
+def _emit_block(writer, nodes):
+    writer.indent()
+    _emit_all(writer, nodes)
+    writer.dedent()
 
 class Module(ASTNode):
     """
     Top level module.
 
     """
+    __slots__ = ()
+
     @property
     def attributes(self):
         raise NotImplementedError()
 
-    def _gen_module_header(self):
-        return ['Attribute %s = "%s"' % (name, value) for
-                    (name, value) in self.attributes]
+    def _emit_module_header(self, writer):
+        for name, value in self.attributes:
+            writer.line('Attribute %s = "%s"' % (name, value))
+
+    def write(self, fileobj):
+        """
+        Streams the VBA code for this module into fileobj.
+
+        """
+        self.emit(CodeWriter(fileobj))
+
+    def as_code(self):
+        chunks = _ChunkSink()
+        self.write(chunks)
+        return ''.join(chunks)
 
 class ProceduralModule(Module):
+    __slots__ = ('name', 'directives', 'declarations', 'code', 'function_namespace',
+                 'raw_code', 'support_modules', 'class_support_module')
+    _fields = ('directives', 'declarations', 'code')
+
     def __init__(self, name):
         self.name = name
         self.directives = []
@@ -115,12 +312,14 @@ class ProceduralModule(Module):
     def attributes(self):
         return [('VB_Name', self.name)]
 
-    def as_code(self):
-        return '\n'.join(self._gen_module_header() + ['', 'Option Explicit'] +
-                         self._reduce_as_code(self.directives) + 
-                         self._reduce_as_code(self.declarations) +
-                         self._reduce_as_code(self.code) +
-                         self.raw_code)
+    def emit(self, writer):
+        self._emit_module_header(writer)
+        writer.line('')
+        writer.line('Option Explicit')
+        _emit_all(writer, self.directives)
+        _emit_all(writer, self.declarations)
+        _emit_all(writer, self.code)
+        writer.lines(self.raw_code)
 
 CLASS_HEADER = ["""VERSION 1.0 CLASS
 BEGIN
@@ -129,12 +328,16 @@ END
 """]
 
 class ClassModule(Module):
+    __slots__ = ('name', 'directives', 'declarations', 'code', 'method_namespace', 'raw_code')
+    _fields = ('directives', 'declarations', 'code')
+
     def __init__(self, name):
         self.name = name
         self.directives = []
         self.declarations = []
         self.code = []
         self.method_namespace = {}
+        self.raw_code = []
 
     @property
     def attributes(self):
@@ -144,28 +347,39 @@ class ClassModule(Module):
                 ('VB_PredeclaredId', 'False'),
                 ('VB_Exposed', 'False')]
 
-    def as_code(self):
-        return '\n'.join(CLASS_HEADER + 
-                         self._gen_module_header() + [''] +
-                         self._reduce_as_code(self.declarations) +
-                         self._reduce_as_code(self.directives) +
-                         self._reduce_as_code(self.code))
+    def emit(self, writer):
+        writer.lines(CLASS_HEADER)
+        self._emit_module_header(writer)
+        writer.line('')
+        _emit_all(writer, self.declarations)
+        _emit_all(writer, self.directives)
+        _emit_all(writer, self.code)
+        writer.lines(self.raw_code)
 
     def vbtype(self):
         return NamedObjectType(self.name)
 
 class ModuleDirective(ASTNode):
-    pass
+    __slots__ = ()
 
 class OptionExplicitDirective(ModuleDirective):
-    def as_code(self):
-        return ['Option Explicit']
+    __slots__ = ()
+
+    def emit(self, writer):
+        writer.line('Option Explicit')
 
 class Procedure(ASTNode):
+    __slots__ = ('name', 'parameters', 'listcomps', 'entry', 'implicit_root')
+
     def __init__(self, name, parameters):
         self.name = name
         self.parameters = parameters
         self.listcomps = []
+        # Called from outside the converted code, e.g. as a macro.
+        self.entry = False
+        # Kept alongside the entry points of a module that has any,
+        # without making it one.
+        self.implicit_root = False
 
     @property
     def parameters_names(self):
@@ -175,6 +389,10 @@ class Procedure(ASTNode):
         return {p.name.name : p.vbtype for p in self.parameters}[pname]
 
 class Subroutine(Procedure):
+    __slots__ = ('scope', 'static', 'statements', 'locals')
+    _fields = ('parameters', 'statements', 'listcomps')
+    _blocks = ('statements',)
+
     def __init__(self, name, parameters, statements, scope=PUBLIC, static=False):
         super(Subroutine, self).__init__(name, parameters)
         self.scope = scope
@@ -182,17 +400,21 @@ class Subroutine(Procedure):
         self.statements = statements
         self.locals = {}
 
-    def as_code(self):
-        paramlist = ', '.join(self._reduce_as_code(self.parameters))
+    def emit(self, writer):
+        paramlist = ', '.join(p.as_code() for p in self.parameters)
         scope = self.scope
         if self.static:
             scope += ' ' + STATIC
-        return (['%s Sub %s(%s)' % (scope, self.name, paramlist)] +
-                indent(self._reduce_as_code(self.statements)) +  
-                ['End Sub'] +
-                self._reduce_as_code(self.listcomps))
+        writer.line('%s Sub %s(%s)' % (scope, self.name, paramlist))
+        _emit_block(writer, self.statements)
+        writer.line('End Sub')
+        _emit_all(writer, self.listcomps)
 
 class Function(Procedure):
+    __slots__ = ('rettype', 'scope', 'static', 'statements', 'locals')
+    _fields = ('parameters', 'statements', 'listcomps')
+    _blocks = ('statements',)
+
     def __init__(self, name, parameters, rettype, statements=None, scope=PUBLIC, static=False):
         super(Function, self).__init__(name, parameters)
         self.rettype = rettype
@@ -201,157 +423,376 @@ class Function(Procedure):
         self.statements = statements or []
         self.locals = {}
 
-    def as_code(self):
-        paramlist = ', '.join(self._reduce_as_code(self.parameters))
+    def emit(self, writer):
+        paramlist = ', '.join(p.as_code() for p in self.parameters)
         scope = self.scope
         if self.static:
             scope += ' ' + STATIC
-        return (['%s Function %s(%s) As %s' % (scope, self.name, paramlist, self.rettype.name)] +
-                indent(self._reduce_as_code(self.statements)) +  
-                ['End Function'] + 
-                self._reduce_as_code(self.listcomps))
+        writer.line('%s Function %s(%s) As %s' % (scope, self.name, paramlist, self.rettype.name))
+        _emit_block(writer, self.statements)
+        writer.line('End Function')
+        _emit_all(writer, self.listcomps)
 
 class ExitSubStatement(ASTNode):
-    def as_code(self):
-        return ['Exit Sub']
+    __slots__ = ()
+
+    def emit(self, writer):
+        writer.line('Exit Sub')
 
 class ExitFunctionStatement(ASTNode):
-    def as_code(self):
-        return ['Exit Function']
+    __slots__ = ()
+
+    def emit(self, writer):
+        writer.line('Exit Function')
+
+class ExitForStatement(ASTNode):
+    __slots__ = ()
+
+    def emit(self, writer):
+        writer.line('Exit For')
 
 class Parameter(ASTNode):
+    __slots__ = ('name', 'vbtype')
+    _fields = ('name',)
+
     def __init__(self, name, vbtype=Variant):
         self.name = name
         self.vbtype = vbtype
 
     def as_code(self):
-        return ['%s As %s' % (self.name.as_code(), self.vbtype.name)]
+        return '%s As %s' % (self.name.as_code(), self.vbtype.name)
 
     def __repr__(self):
         return 'Parameter(%r, %r)' % (self.name, self.vbtype)
 
 class Statement(ASTNode):
-    pass
+    __slots__ = ()
 
 class CallStatement(Statement):
+    __slots__ = ('lexpression', 'parameters')
+    _fields = ('lexpression', 'parameters')
+
     def __init__(self, lexpression, parameters):
         self.lexpression = lexpression
         self.parameters = parameters
 
-    def as_code(self):
-        return ['%s %s' % (self.lexpression.as_code(), ', '.join(p.as_code() for p in self.parameters))]
+    def emit(self, writer):
+        code = self.lexpression.as_code()
+        if self.parameters:
+            code += ' ' + ', '.join(p.as_code() for p in self.parameters)
+        writer.line(code)
 
 class IfStatement(Statement):
+    __slots__ = ('test', 'body', 'elseifblocks', 'orelse')
+    _fields = ('test', 'body', 'orelse')
+    _blocks = ('body', 'orelse')
+
     def __init__(self, test, body, elseifblocks=None, orelse=None):
         self.test = test
         self.body = body
         self.elseifblocks = elseifblocks or []
         self.orelse = orelse or []
 
-    def as_code(self):
-        code = ['If %s Then' % (self.test.as_code(),)]
-        code += indent(self._reduce_as_code(self.body))
+    def emit(self, writer):
+        writer.line('If %s Then' % (self.test.as_code(),))
+        _emit_block(writer, self.body)
         if self.orelse:
-            code += ['Else']
-            code += indent(self._reduce_as_code(self.orelse))
-        code += ['End If']
-        return code
+            writer.line('Else')
+            _emit_block(writer, self.orelse)
+        writer.line('End If')
 
 class ForStatement(Statement):
-    def __init__(self, target, body, ifrom, ito):
+    __slots__ = ('target', 'body', 'ifrom', 'ito', 'step')
+    _fields = ('target', 'ifrom', 'ito', 'step', 'body')
+    _blocks = ('body',)
+    _targets = ('target',)
+
+    def __init__(self, target, body, ifrom, ito, step=None):
         self.target = target
         self.body = body
         self.ifrom = ifrom
         self.ito = ito
-
-    def as_code(self):
-        code = ['For %s = %s To %s' % (self.target.as_code(),
-                                       self.ifrom.as_code(),
-                                       self.ito.as_code())]
-        code += indent(self._reduce_as_code(self.body))
-        code += ['Next %s' % (self.target.as_code(),)]
-        return code
+        self.step = step
+
+    def emit(self, writer):
+        code = 'For %s = %s To %s' % (self.target.as_code(),
+                                      self.ifrom.as_code(),
+                                      self.ito.as_code())
+        if self.step is not None:
+            code += ' Step %s' % (self.step.as_code(),)
+        writer.line(code)
+        _emit_block(writer, self.body)
+        writer.line('Next %s' % (self.target.as_code(),))
 
 class ForEachStatement(Statement):
+    __slots__ = ('target', 'iterable', 'body')
+    _fields = ('target', 'iterable', 'body')
+    _blocks = ('body',)
+    _targets = ('target',)
+
     def __init__(self, target, iterable, body):
         self.target = target
         self.iterable = iterable
         self.body = body
 
-    def as_code(self):
-        code = ['For Each %s In %s' % (self.target.as_code(),
-                                       self.iterable.as_code())]
-        code += indent(self._reduce_as_code(self.body))
-        code += ['Next %s' % (self.target.as_code(),)]
-        return code
+    def emit(self, writer):
+        writer.line('For Each %s In %s' % (self.target.as_code(),
+                                           self.iterable.as_code()))
+        _emit_block(writer, self.body)
+        writer.line('Next %s' % (self.target.as_code(),))
+
+class ReDimStatement(Statement):
+    """
+    Sizes target from base to upper, and from base to columns along
+    a second dimension if given.
+
+    """
+    __slots__ = ('target', 'upper', 'preserve', 'columns', 'base')
+    _fields = ('target', 'upper', 'columns')
+    _targets = ('target',)
+
+    def __init__(self, target, upper, preserve=False, columns=None, base=0):
+        self.target = target
+        self.upper = upper
+        self.preserve = preserve
+        self.columns = columns
+        self.base = base
+
+    def emit(self, writer):
+        bounds = '%d To %s' % (self.base, self.upper.as_code())
+        if self.columns is not None:
+            bounds += ', %d To %s' % (self.base, self.columns.as_code())
+        writer.line('ReDim %s%s(%s)' % ('Preserve ' if self.preserve else '',
+                                        self.target.as_code(), bounds))
+
+class WithStatement(Statement):
+    __slots__ = ('expression', 'body')
+    _fields = ('expression', 'body')
+    _blocks = ('body',)
+
+    def __init__(self, expression, body):
+        self.expression = expression
+        self.body = body
+
+    def emit(self, writer):
+        writer.line('With %s' % (self.expression.as_code(),))
+        _emit_block(writer, self.body)
+        writer.line('End With')
+
+class OnErrorStatement(Statement):
+    """
+    Jumps to label when an error occurs, or with no label, lets
+    errors propagate to the caller again.
+
+    """
+    __slots__ = ('label',)
+
+    def __init__(self, label=None):
+        self.label = label
+
+    def emit(self, writer):
+        writer.line('On Error GoTo %s' % (self.label or '0',))
+
+class LineLabel(Statement):
+    __slots__ = ('name',)
+
+    def __init__(self, name):
+        self.name = name
+
+    def emit(self, writer):
+        # Labels start the line whatever the indentation.
+        writer.dedent()
+        writer.line('%s:' % (self.name,))
+        writer.indent()
 
 class Declaration(ASTNode):
-    pass
+    __slots__ = ()
 
 class DimDeclaration(Declaration):
+    __slots__ = ('name', 'vbtype', 'static')
+
     def __init__(self, name, vbtype, static=False):
         self.name = name
         self.vbtype = vbtype
         self.static = static
 
-    def as_code(self):
-        return ['Dim %s As %s' % (self.name, self.vbtype.name)]
+    def emit(self, writer):
+        # Static locals keep their value between calls.
+        keyword = STATIC if self.static else 'Dim'
+        if isinstance(self.vbtype, ArrayType):
+            writer.line('%s %s() As %s' % (keyword, self.name, self.vbtype.element.name))
+        else:
+            writer.line('%s %s As %s' % (keyword, self.name, self.vbtype.name))
 
 class PublicVariableDeclaration(Declaration):
+    __slots__ = ('name', 'vbtype')
+
     def __init__(self, name, vbtype):
         self.name = name
         self.vbtype = vbtype
 
-    def as_code(self):
-        return ['Public %s as %s' % (self.name, self.vbtype.name)]
+    def emit(self, writer):
+        writer.line('Public %s as %s' % (self.name, self.vbtype.name))
+
+class PrivateVariableDeclaration(Declaration):
+    __slots__ = ('name', 'vbtype')
+
+    def __init__(self, name, vbtype):
+        self.name = name
+        self.vbtype = vbtype
+
+    def emit(self, writer):
+        writer.line('Private %s As %s' % (self.name, self.vbtype.name))
+
+class TypeDeclaration(Declaration):
+    """
+    A Public Type declaring the fields of a UserDefinedType, as a
+    list of (name, type).
+
+    """
+    __slots__ = ('name', 'fields')
+
+    def __init__(self, name, fields):
+        self.name = name
+        self.fields = fields
+
+    def vbtype(self):
+        return UserDefinedType(self.name)
+
+    def emit(self, writer):
+        writer.line('Public Type %s' % (self.name,))
+        writer.indent()
+        for name, vbtype in self.fields:
+            if isinstance(vbtype, ArrayType):
+                writer.line('%s() As %s' % (name, vbtype.element.name))
+            else:
+                writer.line('%s As %s' % (name, vbtype.name))
+        writer.dedent()
+        writer.line('End Type')
 
 class LetStatement(Statement):
+    __slots__ = ('lexpression', 'expression')
+    _fields = ('lexpression', 'expression')
+    _targets = ('lexpression',)
+
     def __init__(self, lexpression, expression):
         self.lexpression = lexpression
         self.expression = expression
 
-    def as_code(self):
-        return ['%s = %s' % (''.join(self.lexpression.as_code()),
-                             ''.join(self.expression.as_code()))]
+    def emit(self, writer):
+        writer.line('%s = %s' % (''.join(self.lexpression.as_code()),
+                                 ''.join(self.expression.as_code())))
 
 class SetStatement(Statement):
+    __slots__ = ('lexpression', 'expression')
+    _fields = ('lexpression', 'expression')
+    _targets = ('lexpression',)
+
     def __init__(self, lexpression, expression):
         self.lexpression = lexpression
         self.expression = expression
 
-    def as_code(self):
-        return ['Set %s = %s' % (''.join(self.lexpression.as_code()),
-                                 ''.join(self.expression.as_code()))]
+    def emit(self, writer):
+        writer.line('Set %s = %s' % (''.join(self.lexpression.as_code()),
+                                     ''.join(self.expression.as_code())))
 
 class Expression(ASTNode):
-    _vbtype = VariantType
+    __slots__ = ('_vbtype',)
 
     def set_vbtype(self, vbtype):
         self._vbtype = vbtype
 
     def vbtype(self):
-        return self._vbtype
+        # Unset until set_vbtype() is called, which leaves the slot
+        # empty on the vast majority of nodes.
+        try:
+            return self._vbtype
+        except AttributeError:
+            return Variant
+
+# VBA operator precedence, higher binds tighter.
+BINOP_PRECEDENCE = {
+    '^' : 12,
+    '*' : 10, '/' : 10,
+    '\\' : 9,
+    'Mod' : 8,
+    '+' : 7, '-' : 7,
+    '&' : 6,
+    '=' : 5, '<>' : 5, '<' : 5, '>' : 5, '<=' : 5, '>=' : 5, 'Is' : 5, 'Like' : 5,
+    'And' : 3,
+    'Or' : 2,
+    'Xor' : 1,
+}
+
+UNARYOP_PRECEDENCE = {
+    '-' : 11,
+    'Not ' : 4,
+}
+
+ATOM_PRECEDENCE = 100
+
+def _precedence(expression):
+    if isinstance(expression, BinOp):
+        return BINOP_PRECEDENCE[expression.binop]
+    elif isinstance(expression, UnaryOp):
+        return UNARYOP_PRECEDENCE[expression.op]
+    elif isinstance(expression, (IntegerLiteral, FloatLiteral)) and expression.value < 0:
+        return UNARYOP_PRECEDENCE['-']
+    return ATOM_PRECEDENCE
+
+def _parenthesize(code, precedence, required):
+    if precedence < required:
+        return '(%s)' % (code,)
+    return code
 
 class BinOp(Expression):
+    __slots__ = ('binop', 'left', 'right')
+    _fields = ('left', 'right')
+
     def __init__(self, binop, left, right):
         self.binop = binop
         self.left = left
         self.right = right
 
     def as_code(self):
-        return '%s %s %s' % (self.left.as_code(),
-                             self.binop,
-                             self.right.as_code())
+        # Walk down the left spine iteratively so that long operator
+        # chains, e.g. a + b + ... + z, don't exhaust the Python stack.
+        spine = []
+        node = self
+        while isinstance(node, BinOp):
+            spine.append(node)
+            node = node.left
+
+        code = node.as_code()
+        precedence = _precedence(node)
+        for binop in reversed(spine):
+            required = BINOP_PRECEDENCE[binop.binop]
+            code = '%s %s %s' % (_parenthesize(code, precedence, required),
+                                 binop.binop,
+                                 _parenthesize(binop.right.as_code(),
+                                               _precedence(binop.right),
+                                               required + 1))
+            precedence = required
+        return code
+
 class UnaryOp(Expression):
+    __slots__ = ('op', 'operand')
+    _fields = ('operand',)
+
     def __init__(self, op, operand):
         self.op = op
         self.operand = operand
 
     def as_code(self):
         return '%s%s' % (self.op,
-                         self.operand.as_code())
+                         _parenthesize(self.operand.as_code(),
+                                       _precedence(self.operand),
+                                       UNARYOP_PRECEDENCE[self.op]))
 
 class IndexExpression(Expression):
+    __slots__ = ('lexpression', 'args')
+    _fields = ('lexpression', 'args')
+
     def __init__(self, lexpression, args):
         self.lexpression = lexpression
         self.args = args
@@ -361,6 +802,8 @@ class IndexExpression(Expression):
                            ', '.join(a.as_code() for a in self.args))
 
 class SimpleNameExpression(Expression):
+    __slots__ = ('name',)
+
     def __init__(self, name):
         self.name = name
 
@@ -368,6 +811,8 @@ class SimpleNameExpression(Expression):
         return self.name
 
 class ValueExpression(Expression):
+    __slots__ = ('code',)
+
     def __init__(self, code):
         self.code = code
 
@@ -375,13 +820,28 @@ class ValueExpression(Expression):
         return self.code
 
 class LExpression(Expression):
+    __slots__ = ('name',)
+
     def __init__(self, name):
         self.name = name
 
     def as_code(self):
         return [self.name]
 
+class WithObjectExpression(Expression):
+    """
+    The object of the enclosing With block, so that member access
+    on it is written as .name.
+
+    """
+    __slots__ = ()
+
+    def as_code(self):
+        return ''
+
 class NewExpression(Expression):
+    __slots__ = ('vbtype',)
+
     def __init__(self, vbtype):
         self.vbtype = vbtype
 
@@ -389,6 +849,9 @@ class NewExpression(Expression):
         return 'New %s' % (self.vbtype.name,)
 
 class MemberAccessExpression(Expression):
+    __slots__ = ('lexpression', 'right')
+    _fields = ('lexpression', 'right')
+
     def __init__(self, lexpression, right):
         self.lexpression = lexpression
         self.right = right
@@ -397,6 +860,8 @@ class MemberAccessExpression(Expression):
         return '%s.%s' % (self.lexpression.as_code(), self.right.as_code())
 
 class StringLiteral(ASTNode):
+    __slots__ = ('value',)
+
     def __init__(self, value):
         self.value = value
 
@@ -407,16 +872,49 @@ class StringLiteral(ASTNode):
         return String
 
 class IntegerLiteral(ASTNode):
-    def __init__(self, value):
+    __slots__ = ('value', '_vbtype')
+
+    def __init__(self, value, vbtype=None):
+        self.value = value
+        self._vbtype = vbtype or literal_type(value)
+
+    def as_code(self):
+        code = '%d' % (self.value,)
+        # VBA types a literal by its value alone, so e.g. n * 1000
+        # overflows for an Integer n unless 1000 is written 1000&.
+        if self._vbtype != literal_type(self.value):
+            code += TYPE_SUFFIXES.get(self._vbtype, '')
+        return code
+
+    def vbtype(self):
+        return self._vbtype
+
+class FloatLiteral(ASTNode):
+    __slots__ = ('value', '_vbtype')
+
+    def __init__(self, value, vbtype=Double):
+        if value != value or value in (float('inf'), float('-inf')):
+            raise ValueError('VBA has no literal for %r.' % (value,))
         self.value = value
+        self._vbtype = vbtype
 
     def as_code(self):
-        return '%d' % (self.value,)
+        code = repr(float(self.value)).upper()
+        if code.endswith('.0'):
+            code = code[:-2]
+        if self._vbtype == Currency:
+            return code + '@'
+        if '.' in code or 'E' in code:
+            return code
+        return code + '#'
 
     def vbtype(self):
-        return Integer
+        return self._vbtype
 
 class DictLiteral(ASTNode):
+    __slots__ = ('items',)
+    _fields = ('items',)
+
     def __init__(self, items):
        self.items = items
 
@@ -430,6 +928,9 @@ class DictLiteral(ASTNode):
                 args).as_code()
 
 class ListLiteral(ASTNode):
+    __slots__ = ('elements',)
+    _fields = ('elements',)
+
     def __init__(self, elements):
         self.elements = elements
 
@@ -0,0 +1,253 @@
+"""
+Wrapper procedures generated around converted functions, as asked for
+by their vbmeta() flags.
+
+vectorize=True adds a NAME_vec worksheet function taking a column
+Range, or a value already read from one, for each parameter. It calls
+the function once per row, from a single UDF call, and returns a
+one column array of the results to spill. When the function is small
+enough, inlining replaces the call with its body.
+
+fast_mode=True converts the function as NAME_body_ and adds a NAME
+macro around it that switches off screen updating, automatic
+calculation and events while it runs, restoring them afterwards even
+if it fails.
+
+vbcache() likewise converts the function as NAME_body_ and adds a
+NAME function around it that remembers the result for each set of
+arguments in a Static Dictionary, so recursive calls are remembered
+too.
+
+"""
+import copy
+
+import vbast
+import runtime
+
+VECTORIZED_SUFFIX = '_vec'
+# Appended to the names of functions that fast_mode or vbcache wrap.
+BODY_SUFFIX = '_body_'
+
+# Application settings fast_mode switches off, with the locals they
+# are saved in, their types and the value they are switched to.
+FAST_MODE_SETTINGS = (
+    ('ScreenUpdating', 'screen_updating_', vbast.Boolean, 'False'),
+    ('Calculation', 'calculation_', vbast.Long, 'xlCalculationManual'),
+    ('EnableEvents', 'enable_events_', vbast.Boolean, 'False'),
+)
+
+# Properties of Err kept while the settings are restored.
+ERROR_FIELDS = (
+    ('Number', 'error_number_', vbast.Long),
+    ('Source', 'error_source_', vbast.String),
+    ('Description', 'error_description_', vbast.String),
+)
+
+def _one():
+    return vbast.IntegerLiteral(1)
+
+def _name(name):
+    return vbast.SimpleNameExpression(name)
+
+def _index(name, args, vbtype=None):
+    expression = vbast.IndexExpression(_name(name), args)
+    if vbtype is not None:
+        expression.set_vbtype(vbtype)
+    return expression
+
+def _member(owner, name, vbtype=None):
+    expression = vbast.MemberAccessExpression(_name(owner), _name(name))
+    if vbtype is not None:
+        expression.set_vbtype(vbtype)
+    return expression
+
+def _index_member(owner, name, args):
+    return vbast.IndexExpression(_member(owner, name), args)
+
+def _rows(values):
+    return _index('UBound', [_name(values), _one()], vbast.Long)
+
+def vectorized(function):
+    """
+    Returns a Function applying function to each row of Ranges
+    passed in place of its parameters.
+
+    """
+    if not function.parameters:
+        raise ValueError('Cannot vectorize %s, it has no parameters.' % (function.name,))
+    for p in function.parameters:
+        if p.vbtype.is_object_type() or \
+                isinstance(p.vbtype, (vbast.RangeDataType, vbast.UserDefinedType)):
+            raise ValueError('Cannot vectorize %s, parameter %s is not a single value.' %
+                             (function.name, p.name.name))
+    if function.rettype.is_object_type():
+        raise ValueError('Cannot vectorize %s, it returns an object.' % (function.name,))
+
+    name = function.name + VECTORIZED_SUFFIX
+    wrapper = vbast.Function(name, [vbast.Parameter(_name(p.name.name))
+                                    for p in function.parameters],
+                             vbast.Variant)
+    # Worksheet formulas call both from outside the converted code.
+    wrapper.implicit_root = True
+    function.implicit_root = True
+
+    row, rows, results = 'row_', 'rows_', 'results_'
+    wrapper.locals.update({row : vbast.Long, rows : vbast.Long, results : vbast.Variant})
+
+    reads = []
+    checks = []
+    arguments = []
+    loads = []
+    for i, p in enumerate(function.parameters):
+        values = p.name.name + '_values_'
+        argument = p.name.name + '_'
+        wrapper.locals[values] = vbast.RangeData
+        wrapper.locals[argument] = p.vbtype
+        reads.append(vbast.LetStatement(_name(values),
+                                        runtime.call('PyRangeValues', [_name(p.name.name)])))
+        if i:
+            checks.append(vbast.IfStatement(
+                vbast.BinOp('<>', _rows(values), _name(rows)),
+                [vbast.CallStatement(
+                    vbast.MemberAccessExpression(_name('Err'), _name('Raise')),
+                    [vbast.IntegerLiteral(5), vbast.StringLiteral(name),
+                     vbast.StringLiteral('Arguments must have the same number of rows.')])]))
+        # Converted to the parameter's type as it is loaded.
+        element = _index(values, [_name(row), _one()], p.vbtype)
+        loads.append(vbast.LetStatement(_name(argument), element))
+        arguments.append(_name(argument))
+
+    first = function.parameters[0].name.name + '_values_'
+    call = _index(function.name, arguments, function.rettype)
+    wrapper.statements = [vbast.DimDeclaration(n, t) for n, t in sorted(wrapper.locals.iteritems())]
+    wrapper.statements += reads
+    wrapper.statements.append(vbast.LetStatement(_name(rows), _rows(first)))
+    wrapper.statements += checks
+    wrapper.statements += [
+        vbast.ReDimStatement(_name(results), _name(rows), columns=_one(), base=1),
+        vbast.ForStatement(
+            _name(row),
+            loads + [vbast.LetStatement(_index(results, [_name(row), _one()]), call)],
+            _one(), _name(rows)),
+        vbast.LetStatement(_name(name), _name(results)),
+    ]
+    return wrapper
+
+def _assign(target, expression, vbtype):
+    if vbtype.is_object_type():
+        return vbast.SetStatement(target, expression)
+    return vbast.LetStatement(target, expression)
+
+def _takes_over(wrapper, function):
+    # Only the wrapper is called from outside.
+    wrapper.entry = function.entry
+    function.entry = False
+    function.scope = vbast.PRIVATE
+
+def fast_mode(function, name):
+    """
+    Returns a Function named name calling function with screen
+    updating, calculation and events switched off.
+
+    """
+    wrapper = vbast.Function(name, copy.deepcopy(function.parameters), function.rettype)
+    _takes_over(wrapper, function)
+
+    saves = []
+    switches = []
+    restores = []
+    for setting, saved, vbtype, value in FAST_MODE_SETTINGS:
+        wrapper.locals[saved] = vbtype
+        saves.append(vbast.LetStatement(_name(saved), _member('Application', setting, vbtype)))
+        switches.append(vbast.LetStatement(_member('Application', setting), _name(value)))
+        restores.append(vbast.LetStatement(_member('Application', setting), _name(saved)))
+
+    # Err is kept aside, as restoring the settings may reset it.
+    reads = []
+    for field, error, vbtype in ERROR_FIELDS:
+        wrapper.locals[error] = vbtype
+        reads.append(vbast.LetStatement(_name(error), _member('Err', field, vbtype)))
+    errors = [_name(error) for field, error, vbtype in ERROR_FIELDS]
+
+    call = _index(function.name, [_name(n) for n in wrapper.parameters_names], function.rettype)
+    run = _assign(_name(name), call, function.rettype)
+
+    label = 'restore_'
+    wrapper.statements = [vbast.DimDeclaration(n, t) for n, t in sorted(wrapper.locals.iteritems())]
+    wrapper.statements += saves
+    wrapper.statements.append(vbast.OnErrorStatement(label))
+    wrapper.statements += switches
+    wrapper.statements.append(run)
+    # Only reached without an error. Turning the handler off stops a
+    # failure to restore a setting from jumping back to it.
+    wrapper.statements.append(vbast.OnErrorStatement())
+    wrapper.statements.append(vbast.LineLabel(label))
+    wrapper.statements += reads
+    wrapper.statements += restores
+    wrapper.statements.append(vbast.IfStatement(
+        vbast.BinOp('<>', errors[0], vbast.IntegerLiteral(0)),
+        [vbast.CallStatement(_member('Err', 'Raise'), errors)]))
+    return wrapper
+
+def cached(function, name, maxsize=None):
+    """
+    Returns a Function named name returning the results of function,
+    calling it only for arguments it hasn't seen yet. Once it has
+    maxsize results, if given, they are all dropped.
+
+    """
+    for p in function.parameters:
+        if p.vbtype.is_object_type() or \
+                isinstance(p.vbtype, (vbast.ArrayType, vbast.UserDefinedType)):
+            raise ValueError('Cannot cache %s, parameter %s is not a single value.' %
+                             (name, p.name.name))
+    if any(isinstance(vbtype, vbast.RangeDataType) for vbtype in function.locals.itervalues()):
+        raise ValueError('Cannot cache %s, it takes worksheet data.' % (name,))
+
+    wrapper = vbast.Function(name, copy.deepcopy(function.parameters), function.rettype)
+    _takes_over(wrapper, function)
+
+    cache, level, size, value = 'cache_', 'level_', 'cache_size_', 'result_'
+    arguments = [_name(n) for n in wrapper.parameters_names]
+    wrapper.locals.update({cache : vbast.Dictionary, value : function.rettype})
+    declarations = [vbast.DimDeclaration(cache, vbast.Dictionary, static=True)]
+    if maxsize:
+        wrapper.locals[size] = vbast.Long
+        declarations.append(vbast.DimDeclaration(size, vbast.Long, static=True))
+
+    # Functions of several arguments keep a Dictionary per argument
+    # but the last, functions of none a single result.
+    key = arguments[-1] if arguments else vbast.StringLiteral('')
+    find = []
+    if len(arguments) > 1:
+        wrapper.locals[level] = vbast.Dictionary
+        find.append(vbast.SetStatement(
+            _name(level), runtime.call('PyCacheLevel', [_name(cache)] + arguments[:-1])))
+    else:
+        level = cache
+    declarations += [vbast.DimDeclaration(n, t) for n, t in sorted(wrapper.locals.iteritems())
+                     if n not in (cache, size)]
+
+    def entry():
+        return _index(level, [copy.deepcopy(key)], function.rettype)
+
+    wrapper.statements = declarations
+    wrapper.statements.append(vbast.IfStatement(
+        vbast.BinOp('Is', _name(cache), _name('Nothing')),
+        [vbast.SetStatement(_name(cache), vbast.NewExpression(vbast.Dictionary))]))
+    wrapper.statements += find
+    wrapper.statements.append(vbast.IfStatement(
+        _index_member(level, 'Exists', [copy.deepcopy(key)]),
+        [_assign(_name(name), entry(), function.rettype), vbast.ExitFunctionStatement()]))
+    wrapper.statements.append(_assign(_name(value), _index(function.name, arguments,
+                                                           function.rettype), function.rettype))
+    if maxsize:
+        wrapper.statements.append(vbast.IfStatement(
+            vbast.BinOp('>=', _name(size), vbast.IntegerLiteral(maxsize, vbast.Long)),
+            [vbast.CallStatement(_member(cache, 'RemoveAll'), []),
+             vbast.LetStatement(_name(size), vbast.IntegerLiteral(0, vbast.Long))] + copy.deepcopy(find)))
+        wrapper.statements.append(vbast.LetStatement(
+            _name(size), vbast.BinOp('+', _name(size), vbast.IntegerLiteral(1, vbast.Long))))
+    wrapper.statements.append(_assign(entry(), _name(value), function.rettype))
+    wrapper.statements.append(_assign(_name(name), _name(value), function.rettype))
+    return wrapper
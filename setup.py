@@ -10,4 +10,7 @@ setup(name='py2vba',
       url='https://bitbucket.org/brotchie/py2vba',
       packages=['py2vba'],
       requires=['excelbt'],
+      entry_points={
+          'console_scripts' : ['py2vba = py2vba.cli:main'],
+      },
      )